@@ -0,0 +1,59 @@
+"""
+The Passport message corpus of the test suite, for benchmarks.
+The messages are read from test/conftest.py as literals, without importing it (and pytest with it).
+"""
+import ast
+import os
+import re
+import sys
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+from pos_proxy.passport_handler import PassportHandler
+
+CONFTEST = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'test', 'conftest.py')
+
+_ROOT_TAG = re.compile(rb'<([A-Za-z_][\w.-]*)')
+
+
+def load_constants(path: str = CONFTEST) -> dict:
+    """
+    Returns all module level constants of a python file that are plain literals, by name.
+    """
+    with open(path, 'rb') as source:
+        tree = ast.parse(source.read(), path)
+
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                constants[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return constants
+
+
+def message_type_name(message: bytes) -> str:
+    """
+    Returns a label for a message: its root XML tag, or BinaryEcho.
+    """
+    handler = PassportHandler()
+    if handler.is_binary_echo(message):
+        return 'BinaryEcho'
+    match = _ROOT_TAG.search(message, 28)
+    return match.group(1).decode() if match else 'Unknown'
+
+
+def load_messages(path: str = CONFTEST) -> dict:
+    """
+    Returns the valid Passport messages of the corpus (messages with bad CRCs are left out), by constant name.
+    """
+    handler = PassportHandler()
+    messages = {}
+    for name, value in load_constants(path).items():
+        if not isinstance(value, bytes) or not value.startswith(b'POSLOYALTY'):
+            continue
+        try:
+            handler.parse_message(value)
+        except Exception:
+            continue
+        messages[name] = value
+    return messages
@@ -0,0 +1,209 @@
+"""
+Simulated loyalty hosts for benchmarking the proxy offline.
+
+Runs any number of hosts in one process, e.g. two hosts with a 5ms lognormal service time, one reset in a hundred requests:
+    python benchmarks/host_simulator.py --ports 17991,17992 --latency lognormal:0.005:0.5 --reset 0.01
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import sys
+from xml.sax.saxutils import escape
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+from pos_proxy.client import MessageHandlingType
+from pos_proxy.passport_handler import PassportHandler
+
+
+def fixed(seconds: float):
+    return lambda rng: seconds
+
+
+def lognormal(median: float, sigma: float):
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+def bimodal(fast: float, slow: float, slow_ratio: float):
+    """
+    Mostly fast, with a slow tail of slow_ratio of the requests.
+    """
+    return lambda rng: slow if rng.random() < slow_ratio else fast
+
+
+LATENCY_DISTRIBUTIONS = {'fixed': fixed, 'lognormal': lognormal, 'bimodal': bimodal}
+
+
+def parse_latency(spec: str):
+    """
+    Parses a service time distribution like fixed:0.005, lognormal:0.005:0.5 (median, sigma) or bimodal:0.002:0.2:0.01 (fast, slow, slow ratio).
+    Returns:
+        a function sampling a service time in seconds from a random.Random
+    """
+    name, *parameters = spec.split(':')
+    return LATENCY_DISTRIBUTIONS[name](*[float(parameter) for parameter in parameters])
+
+
+class Faults(object):
+    """
+    Probabilities, per request, that the host misbehaves instead of answering:
+        reset - abort the connection
+        half_write - write half of the response, then close the connection
+        stall - hold the response for stall_time seconds (forever if None) while the connection stays open
+    """
+    def __init__(self, reset = 0.0, half_write = 0.0, stall = 0.0, stall_time = None):
+        self.reset = reset
+        self.half_write = half_write
+        self.stall = stall
+        self.stall_time = stall_time
+
+    def draw(self, rng) -> str:
+        """
+        Returns the fault to inject for one request (reset, half_write or stall), or None to answer normally.
+        """
+        draw = rng.random()
+        for fault in ('reset', 'half_write', 'stall'):
+            draw -= getattr(self, fault)
+            if draw < 0:
+                return fault
+        return None
+
+
+class LoyaltyHostSimulator:
+    """
+    A loyalty host that reads complete Passport frames, however the TCP stream splits or coalesces them, and answers each request
+    with a valid response carrying its POSSequenceID after a sampled service time. Requests that get no response (Begin/EndCustomer)
+    are only counted, binary echoes are echoed. Requests on a connection are served concurrently, up to concurrency
+    requests at a time over the whole host (unlimited if None), so responses may come back out of order.
+    """
+    def __init__(self, port, host = '127.0.0.1', latency = fixed(0), faults = None, concurrency = None, response_padding = 0, seed = None):
+        self.host = host
+        self.port = port
+        self.handler = PassportHandler()
+        self.latency = latency
+        self.faults = faults if faults is not None else Faults()
+        self.response_padding = response_padding
+        self.requests = 0
+        self.responses = 0
+        self.injected = {'reset': 0, 'half_write': 0, 'stall': 0}
+        self.writers = []
+        self._rng = random.Random(seed)
+        self._slots = asyncio.Semaphore(concurrency) if concurrency else None
+        self._server = None
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    async def listen(self):
+        self._server = await asyncio.start_server(self.__on_connection, host = self.host, port = self.port)
+        self._logger.info('Simulating loyalty host on port %s' % self.port)
+        return self
+
+    async def close(self):
+        for writer in self.writers:
+            if writer.is_closing() is False:
+                writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def build_response(self, request) -> bytes:
+        """
+        Builds a CRC'd response to a parsed request: the request's root tag with Request replaced by Response,
+        echoing its POSSequenceID and LoyaltySequenceID.
+        """
+        if self.handler.is_binary_echo(request.message):
+            return self.handler.build_echo()
+
+        xml = bytes(request.message[28:])
+        root = xml[1:xml.find(b'>')].split()[0].decode()
+        root = root[:-len('Request')] + 'Response' if root.endswith('Request') else root
+        header = '<POSSequenceID>{}</POSSequenceID>'.format(escape(request.pos_sequence_id or ''))
+        if request.loyalty_sequence_id is not None:
+            header += '<LoyaltySequenceID>{}</LoyaltySequenceID>'.format(escape(request.loyalty_sequence_id))
+        body = '<{0}><ResponseHeader>{1}</ResponseHeader><Result>Success</Result>{2}</{0}>'.format(root, header, ' ' * self.response_padding)
+        return self.handler.build_message(body.encode())
+
+    async def respond(self, request, writer: asyncio.StreamWriter):
+        if request.handling_type == MessageHandlingType.MULTICAST_NO_RESPONSE:
+            return
+        fault = self.faults.draw(self._rng)
+        if fault is not None:
+            self.injected[fault] += 1
+        if fault == 'reset':
+            writer.transport.abort()
+            return
+
+        response = self.build_response(request)
+        if self._slots is not None:
+            async with self._slots:
+                await asyncio.sleep(self.latency(self._rng))
+        else:
+            await asyncio.sleep(self.latency(self._rng))
+
+        if fault == 'half_write':
+            writer.write(response[:len(response) // 2])
+            writer.close()
+            return
+        if fault == 'stall':
+            if self.faults.stall_time is None:
+                return
+            await asyncio.sleep(self.faults.stall_time)
+        if not writer.is_closing():
+            writer.write(response)
+            self.responses += 1
+
+    async def __on_connection(self, reader, writer):
+        self.writers.append(writer)
+        responding = set()
+        try:
+            while True:
+                request = await self.handler.read_message(reader)
+                self.requests += 1
+                task = asyncio.create_task(self.respond(request, writer))
+                responding.add(task)
+                task.add_done_callback(responding.discard)
+        except Exception:
+            pass #connection closed or garbage received
+        finally:
+            for task in responding:
+                task.cancel()
+            self.writers.remove(writer)
+            writer.close()
+
+
+async def run_hosts(ports: list, **kwargs) -> list:
+    """
+    Starts one simulated host per port in the running loop, all with the same settings.
+    """
+    return [await LoyaltyHostSimulator(port, **kwargs).listen() for port in ports]
+
+
+async def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ports', required = True, help = 'comma separated ports, one host per port')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--latency', default = 'fixed:0', type = parse_latency, help = 'service time distribution, e.g. fixed:0.005, lognormal:0.005:0.5, bimodal:0.002:0.2:0.01')
+    parser.add_argument('--concurrency', type = int, help = 'requests served at a time per host (default: unlimited)')
+    parser.add_argument('--reset', type = float, default = 0.0, help = 'probability of resetting the connection instead of answering')
+    parser.add_argument('--half-write', type = float, default = 0.0, help = 'probability of writing half a response and closing')
+    parser.add_argument('--stall', type = float, default = 0.0, help = 'probability of holding a response')
+    parser.add_argument('--stall-time', type = float, help = 'seconds a stalled response is held (default: forever)')
+    parser.add_argument('--response-padding', type = int, default = 0, help = 'extra bytes per response')
+    parser.add_argument('--seed', type = int)
+    args = parser.parse_args(argv)
+
+    hosts = await run_hosts([int(port) for port in args.ports.split(',')], host = args.host, latency = args.latency, concurrency = args.concurrency,
+                            faults = Faults(args.reset, args.half_write, args.stall, args.stall_time), response_padding = args.response_padding, seed = args.seed)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for host in hosts:
+            await host.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,236 @@
+"""
+Load generator: opens many simulated POS lanes against a DispatcherServer, replays the test corpus at a target rate
+and reports throughput and latency percentiles per message type.
+
+By default the proxy and simulated loyalty hosts run in a child process, so the generator does not compete with them for the loop:
+    python benchmarks/load_generator.py --lanes 20 --rate 200 --duration 30
+    python benchmarks/load_generator.py --config site.proxy --host-option FastScan=no
+Against a proxy that is already running (its loyalty hosts must be running too):
+    python benchmarks/load_generator.py --target 127.0.0.1:16999 --lanes 20 --rate 100
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+sys.path.append(os.path.realpath(os.path.dirname(__file__)))
+from pos_proxy.client import MessageHandlingType, read_all_message_bytes
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.passport_handler import PassportHandler
+from corpus import load_messages, message_type_name
+from host_simulator import Faults, parse_latency, run_hosts
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return float('nan')
+    rank = max(int(math.ceil(p / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+class LatencyRecorder:
+    """
+    Collects latencies (seconds) and errors per message type.
+    """
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, message_type: str, latency: float):
+        self.latencies.setdefault(message_type, []).append(latency)
+
+    def error(self, message_type: str):
+        self.errors[message_type] = self.errors.get(message_type, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        report = {}
+        for message_type in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies.get(message_type, []))
+            row = {'count': len(values), 'errors': self.errors.get(message_type, 0), 'throughput': len(values) / elapsed if elapsed > 0 else 0.0}
+            for p in PERCENTILES:
+                row['p{}'.format(p).replace('.', '')] = percentile(values, p) * 1000
+            report[message_type] = row
+        return report
+
+
+def format_report(report: dict, elapsed: float) -> str:
+    columns = ['count', 'errors', 'throughput'] + ['p{}'.format(p).replace('.', '') for p in PERCENTILES]
+    lines = ['{:<32}'.format('message type (latency in ms)') + ''.join('{:>12}'.format(column) for column in columns)]
+    for message_type, row in report.items():
+        lines.append('{:<32}'.format(message_type) + ''.join('{:>12.2f}'.format(row[column]) if isinstance(row[column], float) else '{:>12}'.format(row[column]) for column in columns))
+    total = sum(row['count'] for row in report.values())
+    lines.append('{} messages in {:.1f}s, {:.1f} msg/s'.format(total, elapsed, total / elapsed if elapsed > 0 else 0.0))
+    return '\n'.join(lines)
+
+
+async def read_response(handler: PassportHandler, reader: asyncio.StreamReader) -> bytes:
+    """
+    Reads one framed response without parsing the XML, to keep the generator's own CPU use low.
+    """
+    xml_length, header = await handler.read_and_process_header(reader)
+    return header + await read_all_message_bytes(reader, xml_length)
+
+
+async def run_lane(lane: int, host: str, port: int, mix: list, interval: float, start: float, stop: float, recorder: LatencyRecorder, response_timeout: float):
+    """
+    One POS lane: sends the mix round robin, one request at a time, on an open-loop schedule of one message per interval.
+    Latency counts from the scheduled send time, so a slow proxy can't hide queueing by slowing the generator down.
+    """
+    handler = PassportHandler()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        sent = 0
+        while True:
+            scheduled = start + sent * interval
+            if scheduled >= stop:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            message_type, message, expects_response = mix[(lane + sent) % len(mix)]
+            sent += 1
+            try:
+                writer.write(message)
+                await writer.drain()
+                if expects_response:
+                    await asyncio.wait_for(read_response(handler, reader), response_timeout)
+            except Exception:
+                recorder.error(message_type)
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port) #the proxy closes lanes it could not serve
+                continue
+            recorder.record(message_type, time.perf_counter() - scheduled)
+    finally:
+        writer.close()
+
+
+async def generate_load(host: str, port: int, lanes: int, rate: float, duration: float, messages: dict, response_timeout: float = 30) -> (dict, float):
+    """
+    Runs the lanes and returns the report and the elapsed time.
+    """
+    handler = PassportHandler()
+    mix = [(message_type_name(message), message, handler.parse_message(message).handling_type != MessageHandlingType.MULTICAST_NO_RESPONSE) for message in messages.values()]
+    interval = lanes / rate
+    recorder = LatencyRecorder()
+    start = time.perf_counter() + 0.5 #time to connect all lanes
+    stop = start + duration
+    await asyncio.gather(*[run_lane(lane, host, port, mix, interval, start + interval * lane / lanes, stop, recorder, response_timeout) for lane in range(lanes)])
+    elapsed = time.perf_counter() - start
+    return recorder.report(elapsed), elapsed
+
+
+def default_config(port: int, host_ports: list) -> configparser.ConfigParser:
+    """
+    A proxy configuration like the tests' multi client one: the first host serves 4250605 cards (and is the default), the second 4250705.
+    """
+    config = configparser.ConfigParser()
+    config['HOST'] = {'Port': str(port), 'PosType': 'PASSPORT'}
+    masks = ['4250605', '4250705']
+    for index, host_port in enumerate(host_ports):
+        config['CLIENT-{}'.format(index + 1)] = {'Remote': '127.0.0.1', 'Port': str(host_port), 'CardMasks': masks[index] if index < len(masks) else 'none'}
+    return config
+
+
+def simulated_host_ports(config: configparser.ConfigParser) -> list:
+    return [config[section].getint('Port') for section in config.sections() if section not in ['HOST', 'DEFAULT'] and config[section]['Remote'] in ('127.0.0.1', 'localhost')]
+
+
+async def serve(config: configparser.ConfigParser, ready, host_settings: dict):
+    hosts = await run_hosts(simulated_host_ports(config), latency = parse_latency(host_settings['latency']),
+                            faults = Faults(host_settings['reset'], host_settings['half_write'], host_settings['stall'], host_settings['stall_time']))
+    server = await DispatcherServer(config, session_handler = None).listen()
+    ready.set()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+        for host in hosts:
+            await host.close()
+
+
+def serve_process(config_dict: dict, ready, log_level: str, host_settings: dict):
+    logging.basicConfig(level = log_level)
+    config = configparser.ConfigParser()
+    config.read_dict(config_dict)
+    asyncio.run(serve(config, ready, host_settings))
+
+
+def parse_options(options: list) -> dict:
+    return dict(option.split('=', 1) for option in options)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lanes', type = int, default = 20, help = 'concurrent POS connections')
+    parser.add_argument('--rate', type = float, default = 100, help = 'target messages per second over all lanes')
+    parser.add_argument('--duration', type = float, default = 10, help = 'seconds to generate load for')
+    parser.add_argument('--target', help = 'host:port of a running proxy, instead of starting one with simulated hosts')
+    parser.add_argument('--config', help = '.proxy file for the started proxy, clients on localhost get simulated hosts')
+    parser.add_argument('--port', type = int, default = 17990, help = 'listening port of the started proxy, without --config')
+    parser.add_argument('--hosts', type = int, default = 2, help = 'simulated loyalty hosts, without --config')
+    parser.add_argument('--host-option', action = 'append', default = [], metavar = 'KEY=VALUE', help = 'extra [HOST] setting for the started proxy')
+    parser.add_argument('--client-option', action = 'append', default = [], metavar = 'KEY=VALUE', help = 'extra setting for every client section of the started proxy')
+    parser.add_argument('--latency', default = 'fixed:0', help = 'service time distribution of the simulated hosts, e.g. fixed:0.005, lognormal:0.005:0.5, bimodal:0.002:0.2:0.01')
+    parser.add_argument('--reset', type = float, default = 0.0, help = 'probability that a simulated host resets the connection instead of answering')
+    parser.add_argument('--half-write', type = float, default = 0.0, help = 'probability that a simulated host writes half a response and closes')
+    parser.add_argument('--stall', type = float, default = 0.0, help = 'probability that a simulated host holds a response')
+    parser.add_argument('--stall-time', type = float, help = 'seconds a stalled response is held (default: forever)')
+    parser.add_argument('--proxy-log-level', default = 'CRITICAL', help = 'log level of the started proxy (lanes closing at the end are logged as errors)')
+    parser.add_argument('--messages', help = 'comma separated corpus constant names to replay (default: all valid messages)')
+    parser.add_argument('--json', help = 'also write the report to this file')
+    args = parser.parse_args(argv)
+
+    messages = load_messages()
+    if args.messages:
+        messages = {name: messages[name] for name in args.messages.split(',')}
+
+    process = None
+    if args.target:
+        host, port = args.target.rsplit(':', 1)
+        port = int(port)
+    else:
+        if args.config:
+            config = configparser.ConfigParser()
+            config.read(args.config)
+        else:
+            config = default_config(args.port, [args.port + 1 + index for index in range(args.hosts)])
+        config['HOST'].update(parse_options(args.host_option))
+        for section in config.sections():
+            if section not in ['HOST', 'DEFAULT']:
+                config[section].update(parse_options(args.client_option))
+        host, port = '127.0.0.1', config['HOST'].getint('Port')
+        parse_latency(args.latency) #fail early on a bad distribution
+        host_settings = {'latency': args.latency, 'reset': args.reset, 'half_write': args.half_write, 'stall': args.stall, 'stall_time': args.stall_time}
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target = serve_process, args = ({section: dict(config[section]) for section in config.sections()}, ready, args.proxy_log_level.upper(), host_settings), daemon = True)
+        process.start()
+        if not ready.wait(30):
+            raise RuntimeError('Proxy did not start')
+
+    try:
+        report, elapsed = asyncio.run(generate_load(host, port, args.lanes, args.rate, args.duration, messages))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    print(format_report(report, elapsed))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'lanes': args.lanes, 'rate': args.rate, 'elapsed': elapsed, 'types': report}, output, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Replay: sends the requests of capture files (see the Capture setting of DispatcherServer) to a proxy again, one
+connection per captured POS connection, and reports throughput and latency percentiles per message type.
+
+Requests keep their original pacing by default, scaled with --speed; --speed 0 sends each request as soon as the
+previous one on its connection is answered. Rotated capture files are read in the order given, oldest first:
+    python benchmarks/replay.py capture/16999-1234.cap.1 capture/16999-1234.cap
+    python benchmarks/replay.py --speed 0 --config site.proxy capture/16999-1234.cap
+Against a proxy that is already running (its loyalty hosts must be running too):
+    python benchmarks/replay.py --target 127.0.0.1:16999 --speed 2 capture/16999-1234.cap
+"""
+import argparse
+import asyncio
+import configparser
+import json
+import multiprocessing
+import os
+import sys
+import time
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+sys.path.append(os.path.realpath(os.path.dirname(__file__)))
+from pos_proxy.capture import REQUEST, read_capture
+from pos_proxy.client import MessageHandlingType
+from pos_proxy.passport_handler import PassportHandler
+from corpus import message_type_name
+from host_simulator import parse_latency
+from load_generator import LatencyRecorder, default_config, format_report, parse_options, read_response, serve_process
+
+
+def load_lanes(file_names: list) -> (dict, int):
+    """
+    Reads the requests of capture files.
+    Returns:
+        lanes - the (timestamp_ns, message) of every request, by the POS connection it came from
+        first_ns - the timestamp of the first request
+    """
+    lanes = {}
+    for file_name in file_names:
+        for record in read_capture(file_name):
+            if record.direction == REQUEST:
+                lanes.setdefault(record.lane, []).append((record.timestamp_ns, record.message))
+    first_ns = min((requests[0][0] for requests in lanes.values()), default = 0)
+    return lanes, first_ns
+
+
+async def replay_lane(host: str, port: int, requests: list, first_ns: int, speed: float, start: float, recorder: LatencyRecorder, response_timeout: float):
+    """
+    One captured POS connection: sends its requests in order, one at a time. When paced (speed > 0) a request is sent at its
+    captured time (relative to the first request of the capture) divided by speed, and its latency counts from then, as
+    in load_generator; otherwise it counts from the send.
+    """
+    handler = PassportHandler()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for timestamp_ns, message in requests:
+            if speed > 0:
+                scheduled = start + (timestamp_ns - first_ns) / 1e9 / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+
+            message_type = message_type_name(message)
+            try:
+                writer.write(message)
+                await writer.drain()
+                if handler.parse_message(message).handling_type != MessageHandlingType.MULTICAST_NO_RESPONSE:
+                    await asyncio.wait_for(read_response(handler, reader), response_timeout)
+            except Exception:
+                recorder.error(message_type)
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port) #the proxy closes lanes it could not serve
+                continue
+            recorder.record(message_type, time.perf_counter() - scheduled)
+    finally:
+        writer.close()
+
+
+async def replay(host: str, port: int, lanes: dict, first_ns: int, speed: float = 1.0, response_timeout: float = 30) -> (dict, float):
+    """
+    Replays all lanes at once and returns the report and the elapsed time.
+    """
+    recorder = LatencyRecorder()
+    start = time.perf_counter() + 0.5 #time to connect all lanes
+    await asyncio.gather(*[replay_lane(host, port, requests, first_ns, speed, start, recorder, response_timeout) for requests in lanes.values()])
+    elapsed = time.perf_counter() - start
+    return recorder.report(elapsed), elapsed
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('captures', nargs = '+', help = 'capture files, oldest first')
+    parser.add_argument('--speed', type = float, default = 1.0, help = 'pacing relative to the capture, e.g. 2 for twice as fast; 0 for as fast as the proxy answers')
+    parser.add_argument('--target', help = 'host:port of a running proxy, instead of starting one with simulated hosts')
+    parser.add_argument('--config', help = '.proxy file for the started proxy, clients on localhost get simulated hosts')
+    parser.add_argument('--port', type = int, default = 17990, help = 'listening port of the started proxy, without --config')
+    parser.add_argument('--hosts', type = int, default = 2, help = 'simulated loyalty hosts, without --config')
+    parser.add_argument('--host-option', action = 'append', default = [], metavar = 'KEY=VALUE', help = 'extra [HOST] setting for the started proxy')
+    parser.add_argument('--latency', default = 'fixed:0', help = 'service time distribution of the simulated hosts, see load_generator.py')
+    parser.add_argument('--response-timeout', type = float, default = 30, help = 'seconds to wait for each response')
+    parser.add_argument('--proxy-log-level', default = 'CRITICAL', help = 'log level of the started proxy')
+    parser.add_argument('--json', help = 'also write the report to this file')
+    args = parser.parse_args(argv)
+
+    lanes, first_ns = load_lanes(args.captures)
+
+    process = None
+    if args.target:
+        host, port = args.target.rsplit(':', 1)
+        port = int(port)
+    else:
+        if args.config:
+            config = configparser.ConfigParser()
+            config.read(args.config)
+        else:
+            config = default_config(args.port, [args.port + 1 + index for index in range(args.hosts)])
+        config['HOST'].update(parse_options(args.host_option))
+        host, port = '127.0.0.1', config['HOST'].getint('Port')
+        parse_latency(args.latency) #fail early on a bad distribution
+        host_settings = {'latency': args.latency, 'reset': 0.0, 'half_write': 0.0, 'stall': 0.0, 'stall_time': None}
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target = serve_process, args = ({section: dict(config[section]) for section in config.sections()}, ready, args.proxy_log_level.upper(), host_settings), daemon = True)
+        process.start()
+        if not ready.wait(30):
+            raise RuntimeError('Proxy did not start')
+
+    try:
+        report, elapsed = asyncio.run(replay(host, port, lanes, first_ns, args.speed, args.response_timeout))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    print(format_report(report, elapsed))
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'captures': args.captures, 'lanes': len(lanes), 'speed': args.speed, 'elapsed': elapsed, 'types': report}, output, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
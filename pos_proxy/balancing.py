@@ -0,0 +1,86 @@
+import itertools
+
+
+class FirstBalancer(object):
+    """
+    Keeps the clients of a group in configuration order: the first one takes all requests, the others are only failed over to.
+    All balancers order the available clients of a group; the first is sent the request, the rest follow for failover and hedging.
+    """
+    def order(self, clients: list) -> list:
+        return list(clients)
+
+
+class RoundRobinBalancer(object):
+    """
+    Starts with the next client on every request.
+    """
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def order(self, clients: list) -> list:
+        if not clients:
+            return []
+        start = next(self._counter) % len(clients)
+        return clients[start:] + clients[:start]
+
+
+class WeightedBalancer(object):
+    """
+    Smooth weighted round robin over the clients' weight: a client of weight 3 starts 3 times as many requests as one of
+    weight 1, interleaved rather than in bursts.
+    """
+    def __init__(self):
+        self._current = {}
+
+    def order(self, clients: list) -> list:
+        if not clients:
+            return []
+        total = 0
+        for client in clients:
+            weight = max(getattr(client, 'weight', 1), 0)
+            self._current[client] = self._current.get(client, 0) + weight
+            total += weight
+        chosen = max(clients, key = lambda client: self._current[client])
+        self._current[chosen] -= total
+        return [chosen] + [client for client in clients if client is not chosen]
+
+
+class LeastOutstandingBalancer(object):
+    """
+    Starts with the client with the fewest requests in flight (its outstanding count), configuration order on ties.
+    """
+    def order(self, clients: list) -> list:
+        return sorted(clients, key = lambda client: getattr(client, 'outstanding', 0))
+
+
+class LatencyEwmaBalancer(object):
+    """
+    Starts with the client with the lowest moving average of recent response times (see LatencyTracker.ewma),
+    clients without any answered request yet first so they get measured.
+    """
+    def order(self, clients: list) -> list:
+        def ewma(client):
+            latencies = getattr(client, 'latencies', None)
+            return latencies.ewma if latencies is not None and latencies.ewma is not None else 0.0
+        return sorted(clients, key = ewma)
+
+
+BALANCERS = {
+    'first': FirstBalancer,
+    'round_robin': RoundRobinBalancer,
+    'weighted': WeightedBalancer,
+    'least_outstanding': LeastOutstandingBalancer,
+    'latency_ewma': LatencyEwmaBalancer,
+}
+
+
+def create_balancer(name: str):
+    """
+    Returns a new balancer of the given kind: first, round_robin, weighted, least_outstanding or latency_ewma.
+    Raises:
+        ValueError - for an unknown kind
+    """
+    try:
+        return BALANCERS[name.strip().lower()]()
+    except KeyError:
+        raise ValueError("Unknown Balancer {}".format(name))
@@ -0,0 +1,168 @@
+import asyncio
+import collections
+import os
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .logging_setup import get_context_logger
+
+#A capture file starts with the magic, followed by records of:
+#length of the rest of the record, direction, wall clock time (ns), lane (UUID of the POS connection), length of upstream,
+#then upstream (host:port that answered, empty for requests) and the message as sent over the wire
+CAPTURE_MAGIC = b'POSCAP01'
+_RECORD = struct.Struct('<IBQ16sB')
+
+REQUEST = 1 #from a POS
+RESPONSE = 2 #to a POS
+
+CaptureRecord = collections.namedtuple('CaptureRecord', ['direction', 'timestamp_ns', 'lane', 'upstream', 'message'])
+
+
+def read_capture(file_name):
+    """
+    Yields the CaptureRecords of a capture file in the order they were written. A record cut short (the proxy stopped
+    while writing it) ends the file.
+    Raises:
+        ValueError - if the file is not a capture
+    """
+    with open(file_name, 'rb') as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{} is not a capture file".format(file_name))
+        while True:
+            head = capture.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            length, direction, timestamp_ns, lane, upstream_length = _RECORD.unpack(head)
+            body = capture.read(length - _RECORD.size + 4)
+            if len(body) < length - _RECORD.size + 4:
+                return
+            yield CaptureRecord(direction, timestamp_ns, uuid.UUID(bytes = lane), body[:upstream_length].decode(), body[upstream_length:])
+
+
+class CaptureWriter(object):
+    """
+    Appends the requests and responses of POS connections to a capture file (see read_capture), for replaying them later.
+    record only adds the record to a buffer; the buffer is written every flush_interval seconds, or as soon as it holds
+    buffer_size bytes, by a worker thread of its own, so the event loop never waits for the disk.
+    The file is rotated (to file_name.1, .2, ... up to backup_count) before it would grow past max_bytes.
+    Records are dropped (and counted in dropped) while max_pending bytes are waiting to be written. Only one write runs at
+    a time; failed writes are logged and counted in write_errors, and their records are lost.
+    """
+    def __init__(self, file_name, max_bytes = 64 * 1024 * 1024, backup_count = 5, flush_interval = 1, buffer_size = 256 * 1024, max_pending = 16 * 1024 * 1024):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.write_errors = 0
+        self.__pending = []
+        self.__pending_bytes = 0
+        self.__flushing = None
+        self.__flush_task = None
+        self.__worker = None
+        self.__file = None
+        self.uuid = uuid.uuid4()
+        self._logger = get_context_logger(self, self.uuid)
+
+    def open(self):
+        self.__worker = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'Capture')
+        self.__worker.submit(self.__open_file).result() #startup only, before any traffic
+        self.__flush_task = asyncio.create_task(self.flush_periodically())
+        self._logger.info('Capturing to {}'.format(self.file_name))
+        return self
+
+    def close(self):
+        if self.__worker is None:
+            return
+        self.__flush_task.cancel()
+        self.__worker.submit(self.__write_batch, self.__take_pending()).result()
+        self.__worker.submit(self.__close_file).result()
+        self.__worker.shutdown()
+        self.__worker = None
+
+    def record(self, direction: int, lane: uuid.UUID, upstream: str, message):
+        """
+        Adds a message to the capture.
+        Input:
+            direction - REQUEST or RESPONSE
+            lane - the ID of the POS connection
+            upstream - host:port the response came from, empty for requests
+        """
+        if self.__pending_bytes >= self.max_pending:
+            self.dropped += 1
+            return
+        upstream_bytes = upstream.encode()
+        length = _RECORD.size - 4 + len(upstream_bytes) + len(message)
+        self.__pending.append(_RECORD.pack(length, direction, time.time_ns(), lane.bytes, len(upstream_bytes)) + upstream_bytes + bytes(message))
+        self.__pending_bytes += length + 4
+        if self.__pending_bytes >= self.buffer_size:
+            self.__start_flush()
+
+    def __take_pending(self):
+        batch = self.__pending
+        self.__pending = []
+        self.__pending_bytes = 0
+        return batch
+
+    async def flush(self):
+        """
+        Writes all buffered records to the file.
+        """
+        await asyncio.get_running_loop().run_in_executor(self.__worker, self.__write_batch, self.__take_pending())
+
+    def __start_flush(self) -> asyncio.Task:
+        """
+        Starts writing the buffered records in the background, unless a write is running already (which returns instead).
+        """
+        if self.__flushing is None:
+            self.__flushing = asyncio.create_task(self.flush())
+            self.__flushing.add_done_callback(self.__flush_done)
+        return self.__flushing
+
+    def __flush_done(self, task):
+        if self.__flushing is task:
+            self.__flushing = None
+        if not task.cancelled() and task.exception() is not None:
+            self.write_errors += 1
+            self._logger.error('Could not write capture.', exc_info = task.exception())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.wait([self.__start_flush()]) #errors are reported by __flush_done
+
+    #The methods below run on the worker thread only, which owns the file
+
+    def __open_file(self):
+        if os.path.dirname(self.file_name):
+            os.makedirs(os.path.dirname(self.file_name), exist_ok = True)
+        self.__file = open(self.file_name, 'ab')
+        if self.__file.tell() == 0:
+            self.__file.write(CAPTURE_MAGIC)
+
+    def __close_file(self):
+        self.__file.close()
+        self.__file = None
+
+    def __rotate(self):
+        self.__file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            source = '{}.{}'.format(self.file_name, index)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.file_name, index + 1))
+        if self.backup_count > 0:
+            os.replace(self.file_name, self.file_name + '.1')
+        else:
+            os.remove(self.file_name)
+        self.__file = open(self.file_name, 'ab')
+        self.__file.write(CAPTURE_MAGIC)
+
+    def __write_batch(self, batch):
+        for record in batch:
+            if self.__file.tell() > len(CAPTURE_MAGIC) and self.__file.tell() + len(record) > self.max_bytes:
+                self.__rotate()
+            self.__file.write(record)
+        self.__file.flush()
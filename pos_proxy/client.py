@@ -1,9 +1,11 @@
 import asyncio
+import collections
 import time
-import logging
-import binascii
 from uuid import uuid4
 from enum import Enum
+from .health import RemoteHealth
+from .framing import open_framed_connection
+from .logging_setup import get_context_logger, HexDump
 
 
 class TimeoutNotExpiredError(Exception):
@@ -22,7 +24,7 @@ class MessageHandlingType(Enum):
     MULTICAST_NO_RESPONSE = 5
 
 
-async def read_all_message_bytes(reader: asyncio.StreamReader, total_bytes: int) -> bytearray:
+async def read_all_message_bytes(reader: asyncio.StreamReader, total_bytes: int) -> bytes:
     """
     Read exactly X bytes from reader and returns when the specified number of bytes has been received
     Input:
@@ -33,23 +35,24 @@ async def read_all_message_bytes(reader: asyncio.StreamReader, total_bytes: int)
     Raises:
         SocketClientError - socket was closed before specified number of bytes could be read
     """
-    bytes_read = 0
-    whole_message = bytearray()
-    while True:
-        new_bytes = await reader.read(total_bytes - bytes_read)
-        if not new_bytes:
-            raise SocketClientError("Socket closed.")
-        bytes_read += len(new_bytes)
-        whole_message += new_bytes
-        if bytes_read == total_bytes:
-            return whole_message
+    try:
+        return await reader.readexactly(total_bytes)
+    except asyncio.IncompleteReadError:
+        raise SocketClientError("Socket closed.")
 
 
 class SocketClient(object):
     """ 
     Provides an asynchronous interface that represents a client connection to 1 remote host.
+    With pipeline_depth = 1 requests take turns on the connection, each waiting for its response before the next is sent.
+    With a larger depth up to that many requests are in flight at once and a reader task hands each response
+    to the request with the same sequence ID, so a slow response no longer holds up the ones behind it.
+    Requests are refused with TimeoutNotExpiredError while the remote's health (shared between all clients to the same remote
+    when passed in) says it is dead; retry_timeout is the longest backoff after repeated failures.
+    When framed, responses are read with a FramedConnection instead of a StreamReader (see framing.py).
+    With metrics (an UpstreamMetrics) the latency of every answered request, timeouts, rejections, connects and disconnects are counted.
     """
-    def __init__(self, protocol_handler, host, port, retry_timeout = 150, connect_timeout = 10, response_timeout = 10, masks = []):
+    def __init__(self, protocol_handler, host, port, retry_timeout = 150, connect_timeout = 10, response_timeout = 10, masks = [], pipeline_depth = 1, health = None, framed = False, metrics = None):
         self.host = host
         self.port = port
         self.reader = None
@@ -61,11 +64,18 @@ class SocketClient(object):
         self.retry_timeout = retry_timeout
         self.connect_timeout = connect_timeout
         self.response_timeout = response_timeout
-        self.last_disconnect_retry = None
+        self.health = health if health is not None else RemoteHealth(protocol_handler, host, port, backoff_max = retry_timeout, probe = False)
         self.masks = masks
+        self.pipeline_depth = max(pipeline_depth, 1)
+        self.framed = framed
+        self.metrics = metrics
         self.uuid = uuid4()
         self.__lock = asyncio.Lock()
-        self._logger = logging.getLogger(self.__class__.__name__ + '.' +str(self.uuid))
+        self.__connect_lock = asyncio.Lock()
+        self.__pipeline = asyncio.Semaphore(self.pipeline_depth)
+        self.__pending = {} #sequence id -> deque of futures waiting for a response with that id, in send order
+        self.__reader_task = None
+        self._logger = get_context_logger(self, self.uuid)
         self._logger.info('Client initialized to {}:{}'.format(str(self.host), str(self.port)))
 
     @property
@@ -78,23 +88,40 @@ class SocketClient(object):
             self.writer = None
             self.reader = None
 
-            if self._connected == True:
-                self.last_disconnect_retry = time.time()
-
         self._connected = connected
 
+    @property
+    def pipelined(self):
+        return self.pipeline_depth > 1
+
+    @property
+    def available(self):
+        """
+        False while the remote is known to be dead, so callers can skip it without waiting on a connect.
+        """
+        return self.health.available
+
     async def connect(self):        
         if self.connected == True:
             return
-        
-        if self.last_disconnect_retry is not None and time.time() < (self.last_disconnect_retry + self.retry_timeout):
-            raise TimeoutNotExpiredError
 
-        self.last_disconnect_retry = time.time()
-        future_connection = asyncio.open_connection(self.host, self.port)
+        async with self.__connect_lock:
+            await self.__connect()
+
+    async def __connect(self):
+        if self.connected == True:
+            return #someone else connected while we waited
+
         try:
-            self.reader, self.writer = await asyncio.wait_for(future_connection, self.connect_timeout)       
+            if self.framed:
+                self.reader = self.writer = await asyncio.wait_for(open_framed_connection(self.protocol_handler, self.host, self.port), self.connect_timeout)
+            else:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.connect_timeout)
             self.connected = True
+            if self.metrics is not None:
+                self.metrics.connects.inc()
+            if self.pipelined:
+                self.__reader_task = asyncio.create_task(self.read_responses(self.reader))
             self._logger.info('Client connected to {}:{}'.format(str(self.host), str(self.port)))
             return
         except:
@@ -106,32 +133,149 @@ class SocketClient(object):
         if self.connected == False:
             return
 
+        if self.__reader_task is not None:
+            if self.__reader_task is not asyncio.current_task():
+                self.__reader_task.cancel()
+            self.__reader_task = None
+        self.__fail_pending(SocketClientError("Client disconnected."))
+
         self.writer.close()  
         await self.writer.wait_closed()
+        if self.metrics is not None:
+            self.metrics.disconnects.inc()
         self._logger.info('Client disconnected from {}:{}'.format(str(self.host), str(self.port)))
         self.connected = False             
         
             
-    async def send(self, message : bytes):
+    async def send(self, message : bytes, trace = None):
         await self.connect()
 
         await self.writer.drain()
         self.writer.write(message)        
+        if trace is not None:
+            trace.upstream_write = time.perf_counter_ns()
         self._logger.info('Forwarded message to remote host')
-        self._logger.debug('Sent: {}'.format(binascii.hexlify(message)))
+        self._logger.debug('Sent: %s', HexDump(message))
         
-    async def send_and_wait_response(self, message : bytes):
-        await self.send(message)        
-        response, message_type, session_id = await self.protocol_handler.wait_and_handle_response_message(reader = self.reader, request = message)
-        self._logger.info('Received response from remote host, Message type: {}, Session Id:{}'.format(message_type, session_id))
+    async def send_and_wait_response(self, message, trace = None):
+        """
+        Sends a request and waits for its response.
+        Input:
+            message - the request, either as bytes or as already parsed by the protocol handler (preferred, avoids re-parsing)
+            trace - MessageTrace to stamp with the upstream write and the response's arrival (optional)
+        Returns:
+            response, message_type, session_id - as returned by the protocol handler
+        """
+        request = self.protocol_handler.parse_message(message)
+        await self.send(request.message, trace)        
+        response, message_type, session_id = await self.protocol_handler.wait_and_handle_response_message(reader = self.reader, request = request, trace = trace)
+        self._logger.info('Received response from remote host, Message type: %s, Session Id:%s', message_type, session_id)
         if response is not None:
-            self._logger.debug('Received: {}'.format(binascii.hexlify(response)))
+            self._logger.debug('Received: %s', HexDump(response))
         return response, message_type, session_id
     
-    async def send_and_wait_response_with_timeout(self, message : bytes):
+    def __fail_pending(self, exception):
+        for futures in self.__pending.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exception)
+        self.__pending.clear()
+
+    async def read_responses(self, reader: asyncio.StreamReader):
+        """
+        Pipelined mode: reads responses as they arrive and resolves the oldest request waiting for the same sequence ID.
+        Responses nobody waits for anymore (e.g. the request timed out) are dropped. Ends by disconnecting when the socket fails.
+        """
+        try:
+            while True:
+                response = await self.protocol_handler.read_message(reader)
+                futures = self.__pending.get(self.protocol_handler.get_sequence_id(response))
+                if not futures:
+                    self._logger.warning('Dropping response with no request waiting for it, Message type: {}'.format(response.handling_type))
+                    continue
+                future = futures.popleft()
+                if not futures:
+                    del self.__pending[self.protocol_handler.get_sequence_id(response)]
+                if not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._logger.error('Reading responses from {}:{} failed: {}'.format(str(self.host), str(self.port), repr(e)))
+            self.__fail_pending(e)
+            await self.disconnect()
+
+    async def send_and_wait_pipelined_response(self, message, trace = None):
+        """
+        Pipelined mode counterpart of send_and_wait_response: sends without waiting for earlier requests to be answered.
+        """
+        request = self.protocol_handler.parse_message(message)
+        await self.connect()
+        if request.handling_type == MessageHandlingType.MULTICAST_NO_RESPONSE:
+            await self.send(request.message, trace)
+            return None, MessageHandlingType.MULTICAST_NO_RESPONSE, None
+
+        sequence_id = self.protocol_handler.get_sequence_id(request)
+        future = asyncio.get_running_loop().create_future()
+        futures = self.__pending.setdefault(sequence_id, collections.deque())
+        futures.append(future)
+        try:
+            await self.send(request.message, trace)
+            response = await future
+        finally:
+            if future in futures:
+                futures.remove(future)
+                if not futures and self.__pending.get(sequence_id) is futures:
+                    del self.__pending[sequence_id]
+        if trace is not None:
+            trace.first_response = response.received_ns
+
+        self._logger.info('Received response from remote host, Message type: %s, Session Id:%s', response.handling_type, response.session_id)
+        self._logger.debug('Received: %s', HexDump(response.message))
+        return response.message, response.handling_type, response.session_id
+
+    async def send_and_wait_response_with_timeout(self, message, trace = None, response_timeout = None, attempt_begun = False, lane = None):
+        """
+        Sends a request and waits for its response for response_timeout seconds (the client's response_timeout when None).
+        Input:
+            attempt_begun - the caller already called health.begin_attempt for this request (as an UpstreamPool does before leasing)
+            lane - the sender, as for an UpstreamPool; one connection keeps every sender's requests in order already
+        """
+        if not attempt_begun and not self.health.begin_attempt():
+            if self.metrics is not None:
+                self.metrics.rejections.inc()
+            raise TimeoutNotExpiredError
+
+        started = time.perf_counter()
+        try:
+            result = await self.__send_and_wait_response_with_timeout(message, trace, response_timeout or self.response_timeout)
+        except asyncio.CancelledError:
+            self.health.abort_attempt()
+            raise
+        except Exception as e:
+            if self.metrics is not None and isinstance(e, asyncio.TimeoutError):
+                self.metrics.timeouts.inc()
+            self.health.record_failure()
+            raise
+        self.health.record_success()
+        if self.metrics is not None and result[0] is not None:
+            self.metrics.latency.observe(time.perf_counter() - started)
+        return result
+
+    async def __send_and_wait_response_with_timeout(self, message, trace, response_timeout):
+        if self.pipelined:
+            async with self.__pipeline:
+                try:
+                    return await asyncio.wait_for(self.send_and_wait_pipelined_response(message, trace), response_timeout)
+                except asyncio.TimeoutError:
+                    raise #a late response is matched by sequence ID and dropped, the connection stays usable
+                except:
+                    await self.disconnect()
+                    raise
+
         async with self.__lock:
             try:
-                return await asyncio.wait_for(self.send_and_wait_response(message), self.response_timeout)
+                return await asyncio.wait_for(self.send_and_wait_response(message, trace), response_timeout)
             except:
                 await self.disconnect()
                 raise
\ No newline at end of file
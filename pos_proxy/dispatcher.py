@@ -1,11 +1,20 @@
 import asyncio
-import logging
-import binascii
-import fnmatch
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from uuid import uuid4
 from .handler import PosHandler
 from .passport_handler import PassportHandler
 from .client import MessageHandlingType, SocketClient
+from .pool import UpstreamPool
+from .routing import RoutingTable
+from .framing import start_framed_server
+from .passthrough import PassthroughRelay
+from .tracing import MessageTrace, Tracer
+from .capture import CaptureWriter, REQUEST, RESPONSE
+from .response_cache import ResponseCache
+from .logging_setup import get_context_logger, HexDump
+from .metrics import ListenerMetrics, MetricsServer, registry as metrics_registry
 
 
 class NoClientConnectedError(Exception):
@@ -17,121 +26,358 @@ class DispatchedMessage:
 		self.request = request
 		self.responded = False
 		self.user_id = None
+		self.cache_key = None #responses to it go to the response cache under this key
 
 
 class Dispatcher:
 	"""
 	Handles messaged coming from one POS source (represented by a reader/writer pair).
 	Needs also pre-initilized clients and a handler instance to handle POS messages.
+	Clients can be SocketClients owned by this dispatcher or UpstreamPools shared with other dispatchers (owns_clients = False),
+	which are then left open on exit. The card routing table is built from the clients unless a shared one is passed.
+	With a tracer, every request sent to a client is traced (see MessageTrace) and recorded when that client is done with it.
+	With metrics (a ListenerMetrics), requests are counted by handling type and while they are in flight.
+	With a capture (a CaptureWriter), every request and every response written to the POS is added to it, under this dispatcher's uuid.
+	With a response_cache (a ResponseCache), requests the handler gives a cache key are answered from a cached response
+	of one of their clients when there is one, and sent to the clients (refreshing the cache) otherwise.
+	With fire_and_forget, requests without a response (MULTICAST_NO_RESPONSE) are handed to the fanout queue of each of their
+	clients (UpstreamPools) instead, which the dispatcher does not wait for. They travel on a connection of their own, so the remote
+	may receive them after requests the POS sent later.
+	A unicast request whose client belongs to a redundancy group (see RoutingTable.redundant) goes to the next member of the
+	group as soon as the last one tried fails and, with hedge_percentile, also when that one has not answered within the
+	hedge_percentile of its recent response times (at least hedge_min_delay); only the first response is written to the POS.
+	Requests not answered by any client within dispatch_timeout seconds are given up on, and at most max_in_flight
+	requests of the POS are dispatched at once (see loop_await_dispatch_and_respond).
+	Which member of a group is tried first is up to the group's balancer, except that a session stays on the member
+	that answered its card based request (as remembered by the session handler) while that one is available.
 	"""
-	def __init__(self, reader: asyncio.StreamWriter, writer: asyncio.StreamWriter, clients, handler, session_handler):
+	def __init__(self, reader: asyncio.StreamWriter, writer: asyncio.StreamWriter, clients, handler, session_handler, owns_clients = True, routing_table = None, tracer = None, metrics = None, capture = None, response_cache = None, fire_and_forget = False, hedge_percentile = 0, hedge_min_delay = 0.01, dispatch_timeout = 30, max_in_flight = 64):
 		self.reader  = reader
 		self.writer = writer
 		self.clients = clients
+		self.owns_clients = owns_clients
+		self.routing_table = routing_table if routing_table is not None else RoutingTable(clients)
 		self.handler = handler
+		self.tracer = tracer
+		self.metrics = metrics
+		self.capture = capture
+		self.response_cache = response_cache
+		self.fire_and_forget = fire_and_forget
+		self.hedge_percentile = hedge_percentile
+		self.hedge_min_delay = hedge_min_delay
+		self.dispatch_timeout = dispatch_timeout
+		self.max_in_flight = max(max_in_flight, 1)
+		self.__window = asyncio.Semaphore(self.max_in_flight)
+		self.__tasks = set()
+		self.__redundant = set() #hedges and failovers still running after their request was answered
+		self.__failed = False
 		self.__session_handler = session_handler
 		self.uuid = uuid4()
-		self._logger = logging.getLogger(self.__class__.__name__ + '.' + str(self.uuid))
+		self._logger = get_context_logger(self, self.uuid)
 
 	async def __aenter__(self): 
 		return self
   
 	async def __aexit__(self,type, value, traceback):
-		self._logger.info('Closing all peer sockets.')
-		for client in self.clients:
-			await client.disconnect()
+		if self.owns_clients:
+			self._logger.info('Closing all peer sockets.')
+			for client in self.clients:
+				await client.disconnect()
 		
 		if self.writer is not None:
 			self.writer.close()
 			await self.writer.wait_closed()
 
+	async def resolve_session_user(self, session_id: str) -> str:
+		"""
+		Returns the user ID stored for a session, None if unknown.
+		"""
+		if self.__session_handler is None or session_id is None:
+			return None
+		try:
+			return await self.__session_handler.get_user_for_session(session_id)
+		except Exception:
+			self._logger.exception('Session lookup failed.')
+			return None
+
 	def get_valid_clients(self, dispatched_message: DispatchedMessage, message_type: MessageHandlingType, routing_id: str, session_id: str):
+		"""
+		Returns the clients to send a message to. For unicasts that is the best matching client, whether available or not,
+		followed by the rest of its redundancy group (available ones first) to fail over to.
+		Input: routing_id - the card for CARD_BASED_UNICAST, the user ID resolved from the session (see resolve_session_user) for SESSION_BASED_UNICAST
+		"""
+		available_clients = [client for client in self.clients if client.available]
 		if message_type == MessageHandlingType.MULTICAST_NO_RESPONSE or message_type == MessageHandlingType.MULTICAST_WITH_RESPONSE:
-			return self.clients
+			return available_clients if len(available_clients) > 0 else self.clients
 		
-		if message_type == MessageHandlingType.SESSION_BASED_UNICAST:
-			try:
-				routing_id = self.__session_handler.get_user_for_session(routing_id)
-				assert routing_id is not None
-			except:
-				self._logger.error('Cannot find user ID for session.')
-				message_type == MessageHandlingType.DEFAULT_UNICAST
+		if message_type == MessageHandlingType.SESSION_BASED_UNICAST and routing_id is None:
+			self._logger.error('Cannot find user ID for session.')
+			message_type = MessageHandlingType.DEFAULT_UNICAST
 
 		if message_type == MessageHandlingType.CARD_BASED_UNICAST:
 			dispatched_message.user_id = routing_id
 
 		if message_type == MessageHandlingType.CARD_BASED_UNICAST or message_type == MessageHandlingType.SESSION_BASED_UNICAST:
-			def filter_masks(v):
-				return len(list(filter(lambda x: fnmatch.fnmatch(routing_id, x + '*'), v.masks)))
-			client_candidates = list(filter(filter_masks, self.clients))
+			client_candidates = self.routing_table.match(routing_id)
 			if len(client_candidates) > 0:
-				return client_candidates[:1] #return first match
+				#always the best match, even when it is dead (then it fails fast): a shorter prefix or the default route
+				#is another loyalty provider, only its redundancy group may stand in for it
+				return self.with_redundancy(client_candidates[0], session_id)
 			
-		return self.clients[:1]#in all other cases, forward to first (default) client
+		return self.with_redundancy(self.clients[0], session_id)#in all other cases, forward to first (default) client
+
+	def with_redundancy(self, client, session_id: str = None) -> list:
+		"""
+		Returns client and the rest of its redundancy group, ordered by the group's balancer (the session's remote first
+		if it has one), unavailable ones last.
+		"""
+		redundant = self.routing_table.redundant(client)
+		if not redundant:
+			return [client]
+		members = [client] + redundant
+		ordered = self.routing_table.balancer(client).order([member for member in members if member.available])
+		sticky = self.__session_handler.get_upstream(session_id) if self.__session_handler is not None and session_id is not None else None
+		if sticky is not None:
+			ordered.sort(key = lambda member: '{}:{}'.format(member.host, member.port) != sticky) #stable, the rest keeps the balancer's order
+		return ordered + [member for member in members if not member.available]
+
+	def hedge_delay(self, client) -> float:
+		"""
+		Returns how long to wait for client before also sending to the next client, None to only fail over.
+		"""
+		latencies = getattr(client, 'latencies', None)
+		if self.hedge_percentile <= 0 or latencies is None:
+			return None
+		delay = latencies.percentile(self.hedge_percentile)
+		return max(delay, self.hedge_min_delay) if delay is not None else None
+
+	async def dispatch_with_failover(self, message: DispatchedMessage, clients, routed_ns = None) -> bool:
+		"""
+		Sends a unicast request to the first of clients, moving on to the next one when the last one tried fails or is
+		slower than its hedge delay. Returns as soon as a response was written: requests still running then are left to finish
+		in the background, their responses are dropped and their failures logged, until the lane closes.
+		Returns: True if a client answered
+		"""
+		loop = asyncio.get_running_loop()
+		deadline = loop.time() + self.dispatch_timeout
+		remaining = list(clients)
+		running = set()
+		success = False
+		delay = None
+		try:
+			while not message.responded and loop.time() < deadline:
+				if not running:
+					if not remaining:
+						break
+					if len(remaining) < len(clients): #the last one tried failed
+						if self.metrics is not None:
+							self.metrics.failovers.inc()
+						self._logger.info('Failing over to %s:%s', remaining[0].host, remaining[0].port)
+					client = remaining.pop(0)
+					running.add(asyncio.create_task(self.dispatch_to_client_and_respond_if_first_answer(message, client, routed_ns)))
+					delay = self.hedge_delay(client)
+
+				wait = deadline - loop.time()
+				if remaining and delay is not None:
+					wait = min(wait, delay)
+				done, running = await asyncio.wait(running, timeout = max(wait, 0), return_when = asyncio.FIRST_COMPLETED)
+				for task in done:
+					try:
+						task.result()
+						success = True
+					except Exception:
+						self._logger.exception("Exception in a dispatch task.")
+
+				if not done and remaining and not message.responded and loop.time() < deadline:
+					client = remaining.pop(0)
+					if self.metrics is not None:
+						self.metrics.hedges.inc()
+					self._logger.info('Hedging to %s:%s', client.host, client.port)
+					running.add(asyncio.create_task(self.dispatch_to_client_and_respond_if_first_answer(message, client, routed_ns)))
+					delay = self.hedge_delay(client)
+
+		finally:
+			for task in running: #also when the lane closes meanwhile, so it can cancel them
+				self.__redundant.add(task)
+				task.add_done_callback(self.__redundant_done)
+		return success
+
+	def __redundant_done(self, task):
+		self.__redundant.discard(task)
+		if not task.cancelled() and task.exception() is not None:
+			self._logger.info('Redundant dispatch task failed: %r', task.exception())
+
+	async def dispatch_to_client_and_respond_if_first_answer(self, message:DispatchedMessage, client: SocketClient, routed_ns = None):
+		trace = None
+		if self.tracer is not None:
+			trace = MessageTrace.for_request(message.request, '{}:{}'.format(client.host, client.port), routed_ns)
+			trace.outcome = 'failed'
+		try:
+			await self.__dispatch_to_client_and_respond_if_first_answer(message, client, trace)
+		finally:
+			if trace is not None:
+				self.tracer.record(trace)
 
-	async def dispatch_to_client_and_respond_if_first_answer(self, message:DispatchedMessage, client: SocketClient):
+	async def __dispatch_to_client_and_respond_if_first_answer(self, message:DispatchedMessage, client: SocketClient, trace):
 		self._logger.debug('Sending message to remote peer')
-		response, _, session_id = await client.send_and_wait_response_with_timeout(message.request)
+		response, _, session_id = await client.send_and_wait_response_with_timeout(message.request, trace, lane = self)
+		if response is not None and message.cache_key is not None:
+			self.response_cache.put('{}:{}'.format(client.host, client.port), message.cache_key, response)
 		if message.responded is True:
+			if trace is not None:
+				trace.outcome = 'late'
 			return
 
 		message.responded = True		
+		if trace is not None:
+			trace.outcome = 'no_response' if response is None else 'responded'
 		if response is not None and self.writer is not None:
 			await self.writer.drain()
 			self.writer.write(response)        
-			self._logger.info('Forwarded response to "%s:%s"' % self.writer.get_extra_info('peername'))
-			self._logger.debug('Sent: {}'.format(binascii.hexlify(response)))
+			if trace is not None:
+				trace.responded = time.perf_counter_ns()
+			if self.capture is not None:
+				self.capture.record(RESPONSE, self.uuid, '{}:{}'.format(client.host, client.port), response)
+			self._logger.info('Forwarded response to "%s:%s"', *self.writer.get_extra_info('peername'))
+			self._logger.debug('Sent: %s', HexDump(response))
 
 		if session_id is not None and self.__session_handler is not None and message.user_id is not None:
-			self.__session_handler.write_user(session_id, message.user_id)
+			self.__session_handler.write_user(session_id, message.user_id, '{}:{}'.format(client.host, client.port))
 
 		
 
-	async def dispatch_and_respond(self, message: bytes, message_type: MessageHandlingType, routing_id: str, session_id: str):		
+	async def respond_from_cache(self, message: DispatchedMessage, clients) -> bool:
+		"""
+		Answers a request with the cached response of the first of its clients that has one.
+		Returns: True if answered, False if the request has to be sent (its cache_key is then set when its responses can be cached)
+		"""
+		key = self.handler.response_cache_key(message.request)
+		if key is None:
+			return False
+		message.cache_key = key
+		for client in clients:
+			cached = self.response_cache.get('{}:{}'.format(client.host, client.port), key)
+			response = self.handler.rewrite_response(cached, message.request) if cached is not None else None
+			if response is None:
+				continue
+			message.responded = True
+			if self.metrics is not None:
+				self.metrics.response_cache_hits.inc()
+			if self.writer is not None:
+				await self.writer.drain()
+				self.writer.write(response)
+				if self.capture is not None:
+					self.capture.record(RESPONSE, self.uuid, '{}:{}'.format(client.host, client.port), response)
+				self._logger.info('Answered "%s:%s" from the response cache of %s:%s', *self.writer.get_extra_info('peername'), client.host, client.port)
+			return True
+
+		if self.metrics is not None:
+			self.metrics.response_cache_misses.inc()
+		return False
+
+	def fan_out(self, message, clients):
+		"""
+		Queues a request without a response on the fanout queue of each of its clients and returns right away.
+		With a tracer, every queue the request went to (or was dropped by) is traced as queued (or dropped).
+		"""
+		routed_ns = time.perf_counter_ns() if self.tracer is not None else None
+		for client in clients:
+			queued = client.fanout.enqueue(message.message)
+			if self.tracer is not None:
+				trace = MessageTrace.for_request(message, '{}:{}'.format(client.host, client.port), routed_ns)
+				trace.outcome = 'queued' if queued else 'dropped'
+				self.tracer.record(trace)
+		self._logger.debug('Queued message for %s remote peer(s)', len(clients))
+
+	async def dispatch_and_respond(self, message):
+		"""
+		Forwards one request to the clients its routing info selects and writes the first response back to the POS.
+		Input: message - the request as parsed by the handler (carries handling_type, routing_id and session_id)
+		"""
+		if self.metrics is None:
+			await self.__dispatch_and_respond(message)
+			return
+
+		self.metrics.count_message(message.handling_type.name)
+		self.metrics.in_flight.inc()
+		try:
+			await self.__dispatch_and_respond(message)
+		finally:
+			self.metrics.in_flight.dec()
+
+	async def __dispatch_and_respond(self, message):
 		dispatched_message = DispatchedMessage(message)
-		valid_clients = self.get_valid_clients(dispatched_message, message_type, routing_id, session_id)
+		routing_id = message.routing_id
+		if message.handling_type == MessageHandlingType.SESSION_BASED_UNICAST:
+			routing_id = await self.resolve_session_user(routing_id)
+		valid_clients = self.get_valid_clients(dispatched_message, message.handling_type, routing_id, message.session_id)
+		if self.response_cache is not None and await self.respond_from_cache(dispatched_message, valid_clients):
+			return
+		if self.fire_and_forget and message.handling_type == MessageHandlingType.MULTICAST_NO_RESPONSE:
+			self.fan_out(message, valid_clients)
+			return
+		routed_ns = time.perf_counter_ns() if self.tracer is not None else None
+		if len(valid_clients) > 1 and message.handling_type not in (MessageHandlingType.MULTICAST_WITH_RESPONSE, MessageHandlingType.MULTICAST_NO_RESPONSE):
+			success = await self.dispatch_with_failover(dispatched_message, valid_clients, routed_ns)
+		else:
+			success = await self.dispatch_to_all(dispatched_message, valid_clients, routed_ns)
+
+		if success is False:
+			self._logger.error("Could not dispatch to any good client. Closing POS connection.")			
+			self.writer.close()	#this will create a socket event which in turn raises an exception in the read triggering a dispatcher close - somewhat fiddly but efficient
+
+	async def dispatch_to_all(self, dispatched_message: DispatchedMessage, valid_clients, routed_ns = None) -> bool:
+		"""
+		Sends a request to all clients at once, the first response is written to the POS.
+		Returns: True if any client succeeded
+		"""
 		success = False
-		for f in asyncio.as_completed([self.dispatch_to_client_and_respond_if_first_answer(dispatched_message, client) for client in valid_clients], timeout = 30):
+		for f in asyncio.as_completed([self.dispatch_to_client_and_respond_if_first_answer(dispatched_message, client, routed_ns) for client in valid_clients], timeout = self.dispatch_timeout):
 			try:
 				await f	
 				success = True #we just need one success (lack of exception) to consider the message successfully processed
 			except Exception:				
 				self._logger.exception("Exception in a dispatch task.")
+		return success
 
-		if success is False:
-			self._logger.error("Could not dispatch to any good client. Closing POS connection.")			
-			self.writer.close()	#this will create a socket event which in turn raises an exception in the read triggering a dispatcher close - somewhat fiddly but efficient
-	
+	def __dispatch_done(self, task):
+		self.__tasks.discard(task)
+		self.__window.release()
+		if not task.cancelled() and task.exception() is not None:
+			#should never really happen, dispatch and respond does not raise
+			self._logger.error("Exception in a dispatch and respond task.", exc_info = task.exception())
+			self.__failed = True
 
 	async def loop_await_dispatch_and_respond(self):
-		tasks = []		
-		finished = False
-		while True:		
-			try:						
-				message, message_type, routing_id, session_id = await self.handler.wait_and_handle_request_message(self.reader)			
-				self._logger.info('Received message from "%s:%s"' % self.writer.get_extra_info('peername'))
-			
-				dispatch_task = asyncio.create_task(self.dispatch_and_respond(message, message_type, routing_id, session_id))
-				tasks.append(dispatch_task)								
+		"""
+		Reads requests from the POS and dispatches each one in a task of its own, until the POS connection fails.
+		At most max_in_flight requests are dispatched at once: when that many are, the next request is not read until one is done.
+		Without fire_and_forget, a request without a response is sent before the next request is read, so remotes receive them in order.
+		"""
+		while not self.__failed:
+			if self.__window.locked() and self.metrics is not None:
+				self.metrics.lane_window_full.inc()
+			await self.__window.acquire()
+			try:
+				message = await self.handler.wait_and_handle_request_message(self.reader)
+				self._logger.info('Received message from "%s:%s"', *self.writer.get_extra_info('peername'))
+				if self.capture is not None:
+					self.capture.record(REQUEST, self.uuid, '', message.message)
 			except Exception:
-				self._logger.exception("POS socket exception.")				
-				finished = True
-			finally:
-				#we go over completed tasks and we break out if an exeption occurred
-				completed_tasks = [task for task in tasks if task.done() is True]
-				tasks = [task for task in tasks if task.done() is not True]
-				try:
-					for task in completed_tasks:
-						task.result() #this will raise an exception if the async task also raised any exception so we will break out
-				except Exception:				
-					self._logger.exception("Exception in a dispatch and respond task.") #should never really happen, dispatch and respond does not raise
-					finished = True
-
-			if finished is True:
+				self.__window.release()
+				self._logger.exception("POS socket exception.")
 				break
 
-		for task in tasks:
-			task.cancel()
+			dispatch_task = asyncio.create_task(self.dispatch_and_respond(message))
+			self.__tasks.add(dispatch_task)
+			dispatch_task.add_done_callback(self.__dispatch_done)
+			if message.handling_type == MessageHandlingType.MULTICAST_NO_RESPONSE and not self.fire_and_forget:
+				await asyncio.wait([dispatch_task]) #sent before the next request, on the connection that one will use (see UpstreamPool)
+
+		for tasks in (self.__tasks, self.__redundant): #dispatch tasks first, they hand their hedges and failovers still running to __redundant
+			for task in list(tasks):
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions = True)
 				
 class DispatcherServer:	
 	"""
@@ -141,32 +387,120 @@ class DispatcherServer:
 	[HOST] #represents the listener
 	Port = 19999 #the port to listen on
 	PosType = PASSPORT #the type of Register. Supported are: PASSPORT
+	FastScan = yes #extract routing fields by scanning the raw message instead of a full XML parse, falls back to parsing when unsure
+	ClassifyOffloadThreshold = 0 #messages of this many bytes or more are verified and classified on a pool instead of the event loop (e.g. 65536 with ClassifyPoolType = process), 0 to never offload
+	ClassifyPoolSize = 2 #workers of that pool
+	ClassifyPoolType = thread #thread, or process to parse in parallel with the event loop at the cost of copying the message to the worker
+	Framing = yes #split POS and remote connections into messages with a FramedConnection instead of StreamReader reads
+	Passthrough = no #relay messages between each POS connection and a connection of its own to the only client without parsing or routing them (only ResponseTimeout of the client applies, not AdaptiveTimeout, and no sessions are tracked): yes, no, or auto (yes when there is only one client section, and Trace and ResponseCacheTtl are off)
+	PassthroughVerifyCrc = no #in passthrough, check both CRCs of every message and drop the bad ones
+	Trace = no #time every stage of every request (header read, classified, routed, upstream write, first response byte, response written) with its POSSequenceID and upstream, except in passthrough
+	TraceBufferSize = 1024 #traces kept in memory, the newest ones
+	TraceFile = log/trace-{pid}.jsonl #also append every trace to this file as a line of JSON, {pid} is replaced with the process ID; none if empty
+	FireAndForget = no #send requests without a response (Begin/EndCustomerRequest) from a bounded queue per client on a connection of its own, without waiting for them (the remote may then receive them out of order with the lane's other requests)
+	MaxInFlight = 64 #requests of one POS connection dispatched at once, further requests are not read from it until one is done
+	SessionFlushInterval = 1 #seconds between writes of new sessions to the session database (shared by all listeners, the first .proxy file setting it wins)
+	SessionCacheSize = 10000 #sessions kept in memory, least recently used ones are looked up in the database again (shared, as above)
+	SessionCacheTtl = 172800 #seconds a session is answered from memory before it is looked up in the database again, which keeps sessions for 2 days (shared, as above)
+	DispatchTimeout = 30 #seconds a request may take over all clients it is sent to (failovers and hedges included) before it is given up on
+	HedgePercentile = 0 #also send a request to the next client of its redundancy group when the last one tried has not answered within this percentile (e.g. 95) of its recent response times; 0 to only fail over
+	HedgeMinDelay = 0.01 #seconds to wait at least before hedging
+	ResponseCacheTtl = 0 #seconds a client's answer to an online status request or binary echo is reused for the same request from any POS (with its POSSequenceID rewritten) instead of multicasting it again, 0 to always multicast
+	Capture = no #append every request from and response to the POS connections, with its time, connection and upstream, to a capture file for benchmarks/replay.py
+	CaptureFile = capture/{port}-{pid}.cap #{port} is replaced with Port, {pid} with the process ID
+	CaptureMaxBytes = 67108864 #the capture file is rotated to CaptureFile.1, .2, ... before it grows past this
+	CaptureBackupCount = 5 #rotated capture files kept
+	MetricsPort = 9100 #serve this listener's metrics (with the event loop's) over HTTP on 127.0.0.1 in the Prometheus text format, at /metrics; none if 0 or missing. run.py --metrics-port serves all listeners' instead
 
 	[CLIENT-1] #represents one client to forward messages to - this first one in the list is also the default client when none other match
 	Remote = X #the host name of the remote
 	Port = X the port # to connect to
-	CardMasks = 425001, 425002
+	CardMasks = 425001, 425002 #card prefixes routed to this client, the longest matching prefix over all clients wins; masks with * ? [ are globs, only tried when no prefix matches
+	ConnectTimeout = 10 #seconds to wait for a connection to the remote
+	ResponseTimeout = 10 #seconds a request waits for its response, the upper limit with AdaptiveTimeout
+	AdaptiveTimeout = no #wait AdaptiveTimeoutMultiplier times the AdaptiveTimeoutPercentile of the remote's recent response times instead (within ResponseTimeoutFloor and ResponseTimeout), once 20 are known
+	AdaptiveTimeoutPercentile = 99
+	AdaptiveTimeoutMultiplier = 2
+	ResponseTimeoutFloor = 0.2 #seconds a request waits at least with AdaptiveTimeout
+	MinConnections = 1 #connections kept open to the remote, shared by all POS connections
+	MaxConnections = 8 #upper limit of connections to the remote, requests wait for a free one beyond that
+	PipelineDepth = 1 #requests in flight at once per connection, responses are matched to requests by POSSequenceID when > 1
+	FailureThreshold = 3 #consecutive failed requests or connects after which the remote is skipped
+	RetryBackoffMin = 1 #seconds a remote is skipped after FailureThreshold failures, doubling (with jitter) on every further failure
+	RetryBackoffMax = 150 #upper limit of that backoff
+	HealthProbe = yes #probe a dead remote with binary echoes in the background instead of waiting for traffic to retry it
+	Balancer = first #how the requests of a redundancy group are spread over its clients, set on its first client: first (in this order), round_robin, weighted (by Weight), least_outstanding (fewest requests in flight) or latency_ewma (lowest average response time); a session sticks to the client that answered its card based request
+	Weight = 1 #share of the group's requests with Balancer = weighted
+	RedundancyGroup = site-a #clients with the same group serve the same cards: a request routed to one is sent to the next (in this order) when it fails, or is slow with HedgePercentile; none if missing
+	FanoutQueueSize = 1000 #requests without a response waiting to be sent to the remote with FireAndForget, more are dropped (and counted)
 
 	[CLIENT-2] #second client to forward messages to
 	.... - same as CLIENT-1
 
 	[....] #Client 3 and further
 	"""
-	def __init__(self, config, session_handler):				
+	def __init__(self, config, session_handler, reuse_port = False, metrics_port_offset = 0):
 		self._port = config['HOST'].getint('Port')
+		self.reuse_port = reuse_port #several processes listen on the port, the OS spreads connections between them
 		self.__session_handler = session_handler
 		handler_string = config['HOST'].get('PosType', 'PASSPORT')
+		self.metrics = ListenerMetrics(metrics_registry, self._port)
+		self.metrics_port = config['HOST'].getint('MetricsPort', 0)
+		if self.metrics_port > 0:
+			self.metrics_port += metrics_port_offset #worker processes serve their metrics on ports of their own
+		self._metrics_server = None
+
+		self.classify_executor = None
+		offload_threshold = config['HOST'].getint('ClassifyOffloadThreshold', 0)
+		if offload_threshold > 0:
+			pool_type = config['HOST'].get('ClassifyPoolType', 'thread').lower()
+			pool_size = config['HOST'].getint('ClassifyPoolSize', 2)
+			if pool_type == 'thread':
+				self.classify_executor = ThreadPoolExecutor(max_workers = pool_size, thread_name_prefix = 'Classify')
+			elif pool_type == 'process':
+				self.classify_executor = ProcessPoolExecutor(max_workers = pool_size)
+			else:
+				raise ValueError("Unknown ClassifyPoolType {}".format(pool_type))
 
 		if handler_string == 'PASSPORT':			
-			self.handler = PassportHandler()
+			self.handler = PassportHandler(fast_scan = config['HOST'].getboolean('FastScan', True), offload_threshold = offload_threshold, offload_executor = self.classify_executor, crc_failures = self.metrics.crc_failures)
 		else:
 			raise ValueError("Unknown POS Type {}".format(handler_string))
 
 		self.config = config
+		self.framed = config['HOST'].getboolean('Framing', True)
 		self.uuid = uuid4()
-		self._logger = logging.getLogger(self.__class__.__name__ + '.'  + str(self.uuid))
+		self._logger = get_context_logger(self, self.uuid)
 		self.writers = []	
 		self._server = None
+		self.pools = [UpstreamPool.from_config(self.handler, self.config[x], framed = self.framed, metrics = self.metrics.upstream(self.config[x]['Remote'], self.config[x]['Port'])) for x in self.config.sections() if x not in ['HOST', 'DEFAULT']]
+		self.routing_table = RoutingTable(self.pools)
+
+		self.tracer = None
+		if config['HOST'].getboolean('Trace', False):
+			self.tracer = Tracer(config['HOST'].getint('TraceBufferSize', 1024), config['HOST'].get('TraceFile', ''))
+
+		self.capture = None
+		if config['HOST'].getboolean('Capture', False):
+			self.capture = CaptureWriter(config['HOST'].get('CaptureFile', 'capture/{port}-{pid}.cap').format(port = self._port, pid = os.getpid()),
+				max_bytes = config['HOST'].getint('CaptureMaxBytes', 64 * 1024 * 1024), backup_count = config['HOST'].getint('CaptureBackupCount', 5))
+
+		self.response_cache = None
+		response_cache_ttl = config['HOST'].getfloat('ResponseCacheTtl', 0)
+		if response_cache_ttl > 0:
+			self.response_cache = ResponseCache(response_cache_ttl)
+
+		self.fire_and_forget = config['HOST'].getboolean('FireAndForget', False)
+		self.hedge_percentile = config['HOST'].getfloat('HedgePercentile', 0)
+		self.hedge_min_delay = config['HOST'].getfloat('HedgeMinDelay', 0.01)
+		self.dispatch_timeout = config['HOST'].getfloat('DispatchTimeout', 30)
+		self.max_in_flight = config['HOST'].getint('MaxInFlight', 64)
+
+		passthrough = config['HOST'].get('Passthrough', 'no')
+		self.passthrough = len(self.pools) == 1 and self.tracer is None and self.response_cache is None if passthrough.lower() == 'auto' else config['HOST'].getboolean('Passthrough', False)
+		if self.passthrough and len(self.pools) != 1:
+			raise ValueError("Passthrough needs exactly one client section, found {}".format(len(self.pools)))
+		self.passthrough_verify_crc = config['HOST'].getboolean('PassthroughVerifyCrc', False)
 		
 	async def __aenter__(self): 
 		await self.listen()
@@ -175,9 +509,35 @@ class DispatcherServer:
 	async def __aexit__(self, type, value, traceback):
 		await self.close()
 
-	async def listen(self):
-		self._server = await asyncio.start_server(
-			self.__on_connection, host='127.0.0.1', port=self._port)
+	async def listen(self, sock = None):
+		"""
+		Starts the clients and listens for POS connections, on sock if passed (an already bound socket shared with other processes).
+		"""
+		if sock is not None:
+			address = {'sock': sock}
+		elif self.reuse_port:
+			address = {'host': '127.0.0.1', 'port': self._port, 'reuse_port': True}
+		else:
+			address = {'host': '127.0.0.1', 'port': self._port}
+
+		if self.passthrough:
+			self.pools[0].health.start() #relays connect on their own, the pool is only used for its remote's settings and health
+		else:
+			for pool in self.pools:
+				pool.start()
+
+		if self.framed or self.passthrough:
+			self._server = await start_framed_server(
+				self.__on_connection, self.handler, **address)
+		else:
+			self._server = await asyncio.start_server(
+				self.__on_connection, **address)
+
+		if self.capture is not None:
+			self.capture.open()
+
+		if self.metrics_port > 0:
+			self._metrics_server = await MetricsServer(metrics_registry, self.metrics_port, listener = self._port).start()
 		
 		self._logger.info('Listening on port %s' % self._port)
 		return self
@@ -186,19 +546,22 @@ class DispatcherServer:
 	async def __on_connection(self, reader, writer):
 		self._logger.info('Received connection from POS "%s:%s"' % writer.get_extra_info('peername'))
 		self.writers.append(writer)
+		self.metrics.connections.inc()
 		
 		try:
-			clients_config = [self.config[x] for x in self.config.sections() if x not in ['HOST', 'DEFAULT']]
-			
-			clients = [SocketClient(protocol_handler = self.handler, host = cli_cfg['Remote'], port = cli_cfg.getint('Port'), masks = [x.strip() for x in cli_cfg.get('CardMasks', '').split(',')]) for cli_cfg in clients_config]		
-			
-			async with Dispatcher(reader, writer, clients, self.handler, session_handler = self.__session_handler) as dispatcher:
-				await dispatcher.loop_await_dispatch_and_respond()
+			if self.passthrough:
+				pool = self.pools[0]
+				await PassthroughRelay(writer, self.handler, pool.host, pool.port, pool.health, connect_timeout = pool.connect_timeout, response_timeout = pool.response_timeout, verify_crc = self.passthrough_verify_crc, metrics = self.metrics, upstream_metrics = pool.metrics, capture = self.capture).run()
+			else:
+				async with Dispatcher(reader, writer, self.pools, self.handler, session_handler = self.__session_handler, owns_clients = False, routing_table = self.routing_table, tracer = self.tracer, metrics = self.metrics, capture = self.capture, response_cache = self.response_cache, fire_and_forget = self.fire_and_forget,
+					hedge_percentile = self.hedge_percentile, hedge_min_delay = self.hedge_min_delay, dispatch_timeout = self.dispatch_timeout, max_in_flight = self.max_in_flight) as dispatcher:
+					await dispatcher.loop_await_dispatch_and_respond()
 			
 		except Exception:			
 			self._logger.exception("Exception processing POS message.")	 #nobody higher listens for exceptions on this task	
 		finally:			
 			self.writers.remove(writer)	
+			self.metrics.connections.dec()
 			if writer.is_closing() is False:
 				self._logger.info('Closing POS connection.')
 				writer.close()
@@ -214,4 +577,19 @@ class DispatcherServer:
 		
 		if self._server is not None:
 			self._server.close()
-			await self._server.wait_closed()
\ No newline at end of file
+			await self._server.wait_closed()
+
+		if self._metrics_server is not None:
+			await self._metrics_server.close()
+
+		for pool in self.pools:
+			await pool.close()
+
+		if self.classify_executor is not None:
+			self.classify_executor.shutdown(wait = False)
+
+		if self.tracer is not None:
+			self.tracer.close()
+
+		if self.capture is not None:
+			self.capture.close()
\ No newline at end of file
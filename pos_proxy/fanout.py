@@ -0,0 +1,112 @@
+import asyncio
+import collections
+from uuid import uuid4
+from .client import SocketClient
+from .logging_setup import get_context_logger
+
+
+class FanoutQueue(object):
+    """
+    Sends requests nobody waits a response for (MULTICAST_NO_RESPONSE) to one remote on a connection of its own,
+    so they never take a lease or lock from the connections that carry requests waiting for responses.
+    enqueue returns at once: a background task writes everything queued meanwhile in one write, connecting when needed.
+    Requests are dropped when max_size of them are already queued (overflows), and when the remote is dead or
+    the write fails (dropped); the health of the remote (shared with its pool) is updated with every connect and failed write.
+    With metrics (an UpstreamMetrics) sent, overflowed and dropped requests and writes are counted.
+    """
+    def __init__(self, protocol_handler, host, port, health, max_size = 1000, connect_timeout = 10, framed = False, metrics = None):
+        self.protocol_handler = protocol_handler
+        self.host = host
+        self.port = port
+        self.health = health
+        self.max_size = max(max_size, 1)
+        self.connect_timeout = connect_timeout
+        self.framed = framed
+        self.metrics = metrics
+        self.sent = 0
+        self.overflows = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._queued = asyncio.Event()
+        self._client = None
+        self._task = None
+        self.uuid = uuid4()
+        self._logger = get_context_logger(self, self.uuid)
+
+    def enqueue(self, message) -> bool:
+        """
+        Queues a complete message for the remote.
+        Returns: False if the queue is full and the message was dropped
+        """
+        if len(self._queue) >= self.max_size:
+            self.overflows += 1
+            if self.metrics is not None:
+                self.metrics.fanout_overflows.inc()
+            return False
+        self._queue.append(message)
+        self._queued.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self.write_queued())
+        return True
+
+    def __drop(self, count):
+        self.dropped += count
+        if self.metrics is not None:
+            self.metrics.fanout_dropped.inc(count)
+
+    async def __connect(self):
+        if self._client is not None and self._client.connected and not self._client.reader.at_eof():
+            return
+        if self._client is not None:
+            await self._client.disconnect() #closed by the remote while idle
+        if not self.health.begin_attempt():
+            raise ConnectionError('Remote {}:{} is dead'.format(str(self.host), str(self.port)))
+        self._client = SocketClient(self.protocol_handler, self.host, self.port, connect_timeout = self.connect_timeout, health = self.health, framed = self.framed, metrics = self.metrics)
+        try:
+            await self._client.connect()
+        except asyncio.CancelledError:
+            self.health.abort_attempt()
+            raise
+        except Exception:
+            self.health.record_failure()
+            raise
+        self.health.record_success()
+
+    async def write_queued(self):
+        while True:
+            await self._queued.wait()
+            self._queued.clear()
+            batch = list(self._queue)
+            self._queue.clear()
+            if not batch:
+                continue
+            if not self.health.available and (self._client is None or not self._client.connected):
+                self.__drop(len(batch))
+                continue
+
+            try:
+                await self.__connect()
+                await self._client.send(b''.join(batch))
+                await self._client.writer.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._logger.error('Could not send {} message(s) to {}:{}: {}'.format(len(batch), str(self.host), str(self.port), repr(e)))
+                self.__drop(len(batch))
+                if self._client is not None and self._client.connected:
+                    self.health.record_failure()
+                    await self._client.disconnect()
+                continue
+
+            self.sent += len(batch)
+            if self.metrics is not None:
+                self.metrics.fanout_sent.inc(len(batch))
+                self.metrics.fanout_writes.inc()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._client is not None:
+            await self._client.disconnect()
+            self._client = None
@@ -0,0 +1,244 @@
+import asyncio
+import collections
+
+
+class FramingError(Exception):
+    pass
+
+
+class FramedConnection(asyncio.BufferedProtocol):
+    """
+    A connection that splits the received byte stream into complete protocol messages (frames) without a StreamReader.
+    The transport receives straight into a reusable buffer, where the handler decodes headers in place (frame_length).
+    Frames that arrived whole are copied out of it once; the rest of a frame that did not is received directly into
+    a buffer of its own, so large messages are never copied or grown. Every frame is handed out as a memoryview over
+    a bytearray of its own, which stays valid for as long as it is referenced.
+    The connection is its own reader and writer: read_frame() reads, and it has the StreamWriter methods the proxy uses.
+    Alternatively set_frame_received() has every frame handed to a callback as soon as it is complete, without a task switch.
+    """
+    def __init__(self, header_length: int, frame_length, buffer_size = 64 * 1024, max_frame_size = 16 * 1024 * 1024, max_queued_frames = 64):
+        self.header_length = header_length
+        self.frame_length = frame_length
+        self.max_frame_size = max_frame_size
+        self.max_queued_frames = max_queued_frames
+        self.transport = None
+        self._loop = asyncio.get_running_loop()
+        self._buffer = bytearray(max(buffer_size, header_length))
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+        self._frame = None #view of the frame being received past the buffer
+        self._frame_filled = 0
+        self._frames = collections.deque()
+        self._frame_received = None
+        self._read_waiter = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self._writing_paused_changed = None
+        self._drain_waiters = collections.deque()
+        self._eof = False
+        self._exception = None
+        self._closed = self._loop.create_future()
+
+    #asyncio.BufferedProtocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self._frame is not None:
+            return self._frame[self._frame_filled:]
+        return self._view[self._filled:]
+
+    def buffer_updated(self, nbytes):
+        if self._frame is not None:
+            self._frame_filled += nbytes
+            if self._frame_filled == len(self._frame):
+                frame, self._frame = self._frame, None
+                self._emit(frame)
+            return
+
+        self._filled += nbytes
+        try:
+            self._split_frames()
+        except Exception as e:
+            self._exception = FramingError('Invalid frame: {}'.format(repr(e)))
+            self._wake_reader()
+            self.transport.abort()
+
+    def _split_frames(self):
+        start, end = 0, self._filled
+        while end - start >= self.header_length:
+            length = self.frame_length(self._buffer, start)
+            if length < self.header_length or length > self.max_frame_size:
+                raise FramingError('Frame length {} out of bounds'.format(length))
+            if end - start >= length:
+                self._emit(memoryview(bytearray(self._view[start:start + length])))
+                start += length
+            else:
+                frame = bytearray(length)
+                frame[:end - start] = self._view[start:end]
+                self._frame = memoryview(frame)
+                self._frame_filled = end - start
+                start = end
+                break
+
+        #only part of a header (if anything) is left, move it to the front
+        self._filled = end - start
+        if self._filled and start:
+            self._buffer[:self._filled] = bytes(self._view[start:end])
+
+    def _emit(self, frame: memoryview):
+        if self._frame_received is not None:
+            self._frame_received(frame)
+            return
+        self._frames.append(frame)
+        if len(self._frames) >= self.max_queued_frames and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        self._wake_reader()
+
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+        return False #close the transport
+
+    def connection_lost(self, exc):
+        self._eof = True
+        if exc is not None and self._exception is None:
+            self._exception = exc
+        self._wake_reader()
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError('Connection lost'))
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._writing_paused = True
+        if self._writing_paused_changed is not None:
+            self._writing_paused_changed(True)
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._writing_paused_changed is not None:
+            self._writing_paused_changed(False)
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    #reading
+
+    def set_frame_received(self, callback):
+        """
+        Hands every complete frame to callback(frame) from now on, starting with those already received, instead of queueing it for read_frame.
+        """
+        self._frame_received = callback
+        while self._frames:
+            callback(self._frames.popleft())
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def pause_reading(self):
+        """
+        Stops receiving until resume_reading, e.g. while the connection frames are copied to can't keep up.
+        """
+        if not self._reading_paused and not self.transport.is_closing():
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        if self._reading_paused and not self.transport.is_closing():
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    async def read_frame(self) -> memoryview:
+        """
+        Waits for the next complete frame.
+        Raises:
+            FramingError - the peer sent something that is not a valid frame
+            asyncio.IncompleteReadError - the connection was closed before a complete frame was received
+        """
+        while not self._frames:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                partial = bytes(self._frame[:self._frame_filled]) if self._frame is not None else bytes(self._view[:self._filled])
+                raise asyncio.IncompleteReadError(partial, None)
+            self._read_waiter = self._loop.create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+
+        frame = self._frames.popleft()
+        if self._reading_paused and len(self._frames) <= self.max_queued_frames // 2:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    def at_eof(self) -> bool:
+        return self._eof and not self._frames
+
+    #writing, as asyncio.StreamWriter
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def set_writing_paused_changed(self, callback):
+        """
+        Calls callback(paused) whenever the transport's write buffer goes over (True) or back under (False) its high water mark.
+        """
+        self._writing_paused_changed = callback
+        if self._writing_paused:
+            callback(True)
+
+    async def drain(self):
+        if self._closed.done():
+            raise ConnectionResetError('Connection lost')
+        if self._writing_paused:
+            waiter = self._loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def close(self):
+        self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+    def get_extra_info(self, name, default = None):
+        return self.transport.get_extra_info(name, default)
+
+
+async def open_framed_connection(handler, host, port, **kwargs) -> FramedConnection:
+    """
+    Connects to host:port and returns a FramedConnection splitting the stream into the handler's messages.
+    """
+    _, connection = await asyncio.get_running_loop().create_connection(
+        lambda: FramedConnection(handler.header_bytes_length, handler.frame_length), host, port, **kwargs)
+    return connection
+
+
+async def start_framed_server(client_connected_cb, handler, host = None, port = None, **kwargs) -> asyncio.AbstractServer:
+    """
+    Like asyncio.start_server, with FramedConnections for the handler's messages: client_connected_cb(reader, writer)
+    is scheduled as a task for every connection, with the connection being both the reader and the writer.
+    """
+    loop = asyncio.get_running_loop()
+
+    class ServerConnection(FramedConnection):
+        def connection_made(self, transport):
+            super().connection_made(transport)
+            loop.create_task(client_connected_cb(self, self))
+
+    return await loop.create_server(lambda: ServerConnection(handler.header_bytes_length, handler.frame_length), host, port, **kwargs)
@@ -8,12 +8,81 @@ class PosHandler(abc.ABC):
     ABC class (abstract class) defining the universal interface which the Dispatcher can use to process individual POS protocols.
     """
     @abc.abstractmethod
-    async def wait_and_handle_response_message(self, reader: asyncio.StreamReader, request: bytes) -> (bytes, MessageHandlingType, str):
+    def parse_message(self, message):
+        """
+        Verifies and classifies a complete message once, so it can be passed along the request/response path without re-parsing.
+        Input:
+            message - the complete message as bytes, or an already parsed message (which is returned unchanged)
+        Returns:
+            parsed message - exposes at least: message (the raw bytes), handling_type (MessageHandlingType),
+            routing_id and session_id, and received_ns/classified_ns (time.perf_counter_ns when its header was read
+            and when it was classified, set by read_message, None otherwise)
+        """
+        pass
+
+    @abc.abstractmethod
+    def frame_length(self, buffer, offset: int = 0) -> int:
+        """
+        Returns the length of the complete message whose header starts at offset in buffer, for a FramedConnection
+        (which reads header_bytes_length bytes before asking). Raises if the header is invalid.
+        """
+        pass
+
+    @abc.abstractmethod
+    def expects_response(self, message) -> bool:
+        """
+        Whether the remote answers this complete message, decided without verifying or parsing it (for a relay that only copies messages).
+        """
+        pass
+
+    @abc.abstractmethod
+    def build_echo(self) -> bytes:
+        """
+        Returns a request that any remote answers without side effects, used to probe whether it is alive.
+        """
+        pass
+
+    @abc.abstractmethod
+    def response_cache_key(self, request) -> str:
+        """
+        Returns the key under which responses to this request may be cached and reused for other requests with the
+        same key (e.g. status requests and echoes, answered the same way to every POS), None if they may not.
+        """
+        pass
+
+    @abc.abstractmethod
+    def rewrite_response(self, response, request) -> bytes:
+        """
+        Returns a cached response adapted to answer request (its sequence ID and checksums), None if it can't be adapted.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_sequence_id(self, message) -> str:
+        """
+        Returns the ID that pairs a response with its request.
+        Input:
+            message - the complete message, as bytes or parsed
+        """
+        pass
+
+    @abc.abstractmethod
+    async def read_message(self, reader: asyncio.StreamReader):
+        """
+        Waits for one complete message using the provided StreamReader and returns it parsed (see parse_message).
+        Raises:
+            SocketClientError - if sockets get closed before receiving a full message.
+        """
+        pass
+
+    @abc.abstractmethod
+    async def wait_and_handle_response_message(self, reader: asyncio.StreamReader, request, trace = None) -> (bytes, MessageHandlingType, str):
         """
         Waits for a fully received response using the provided StreamReader and returns the response and its meta-data.
         Input: 
             reader - the StreamReader to use
-            request - the request message that has been sent already that we are waitig a response for - it is needed in order to internally recognize its response policy.
+            request - the request message (bytes or parsed) that has been sent already that we are waitig a response for - it is needed in order to internally recognize its response policy.
+            trace - MessageTrace of the request, to set first_response on (optional)
         Returns: 
             response - the awaited response
             message_type - the message type of the response
@@ -25,16 +94,14 @@ class PosHandler(abc.ABC):
         pass
 
     @abc.abstractmethod
-    async def wait_and_handle_request_message(self, reader: asyncio.StreamReader) -> (bytes, MessageHandlingType, str, str):
+    async def wait_and_handle_request_message(self, reader: asyncio.StreamReader):
         """
-        Waits for a fully received request using the provided StreamReader and returns the received whole message and its meta-data.
+        Waits for a fully received request using the provided StreamReader and returns it parsed (see parse_message).
         Input: 
             reader - the StreamReader to use            
         Returns: 
-            message - the awaited complete message
-            message_type - the message type
-            routing_id - the ID around which to base roting one, dependant on type
-            session_id - the session number, if available, for the caller to track sessions
+            parsed message - the awaited complete message with its handling type, routing_id
+            (the ID around which to base routing, dependant on type) and session_id
             
         Raises:
             SocketClientError - if sockets get closed before receiving a full message.
@@ -0,0 +1,141 @@
+import asyncio
+import random
+import time
+from enum import Enum
+from uuid import uuid4
+from .logging_setup import get_context_logger
+
+
+class HealthState(Enum):
+    HEALTHY = 1
+    HALF_OPEN = 2
+    DEAD = 3
+
+
+class RemoteHealth(object):
+    """
+    Tracks whether one remote host is usable, shared by every connection to it.
+    failure_threshold consecutive failures (a refused connect, or a request that timed out on one slow transaction) mark a
+    healthy remote DEAD, so one slow request does not lock every lane out of it. It stays DEAD for a backoff that doubles with
+    every further failure (from backoff_min up to backoff_max, randomized by +/- jitter so remotes and proxies don't retry in lockstep). When the backoff expires the remote is HALF_OPEN:
+    one attempt at a time is let through, and its outcome makes the remote HEALTHY again or DEAD for longer.
+    When started, a background task makes that attempt itself with an echo message, so traffic doesn't have to.
+    """
+    def __init__(self, protocol_handler, host, port, backoff_min = 1, backoff_max = 150, jitter = 0.2, probe = True, probe_timeout = 5, failure_threshold = 3):
+        self.protocol_handler = protocol_handler
+        self.host = host
+        self.port = port
+        self.backoff_min = backoff_min
+        self.backoff_max = max(backoff_max, backoff_min)
+        self.jitter = jitter
+        self.probe = probe
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = max(failure_threshold, 1)
+        self.failures = 0
+        self.retry_at = None
+        self._state = HealthState.HEALTHY
+        self._trial_in_progress = False
+        self._failed = asyncio.Event()
+        self._probe_task = None
+        self.uuid = uuid4()
+        self._logger = get_context_logger(self, self.uuid)
+
+    @property
+    def state(self) -> HealthState:
+        if self._state == HealthState.DEAD and time.time() >= self.retry_at:
+            self._state = HealthState.HALF_OPEN
+        return self._state
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether an attempt to use the remote could be made right now.
+        """
+        state = self.state
+        return state == HealthState.HEALTHY or (state == HealthState.HALF_OPEN and not self._trial_in_progress)
+
+    def begin_attempt(self) -> bool:
+        """
+        Must be called before connecting to the remote.
+        Returns:
+            False if the remote is dead and its backoff has not expired, or another attempt is already testing it
+        """
+        state = self.state
+        if state == HealthState.DEAD:
+            return False
+        if state == HealthState.HALF_OPEN:
+            if self._trial_in_progress:
+                return False
+            self._trial_in_progress = True
+        return True
+
+    def abort_attempt(self):
+        """
+        Ends an attempt that was cancelled before it had an outcome, so the next one can test the remote, without changing its state.
+        """
+        self._trial_in_progress = False
+
+    def record_success(self):
+        if self._state != HealthState.HEALTHY:
+            self._logger.info('Remote {}:{} is healthy again'.format(str(self.host), str(self.port)))
+        self._state = HealthState.HEALTHY
+        self._trial_in_progress = False
+        self.failures = 0
+        self._failed.clear()
+
+    def record_failure(self):
+        self.failures += 1
+        if self._state == HealthState.HEALTHY and self.failures < self.failure_threshold:
+            self._logger.info('Remote {}:{} failed {} consecutive time(s)'.format(str(self.host), str(self.port), self.failures))
+            return
+        backoff = min(self.backoff_max, self.backoff_min * (2 ** (self.failures - self.failure_threshold)))
+        backoff *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.retry_at = time.time() + backoff
+        self._state = HealthState.DEAD
+        self._trial_in_progress = False
+        self._failed.set()
+        self._logger.warning('Remote {}:{} marked dead for {:.1f}s after {} consecutive failure(s)'.format(str(self.host), str(self.port), backoff, self.failures))
+
+    def start(self):
+        if self.probe and self._probe_task is None:
+            self._probe_task = asyncio.create_task(self.probe_when_dead())
+
+    def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+
+    async def probe_once(self):
+        """
+        Sends an echo on a separate connection and waits for it to come back.
+        Raises:
+            any error - the remote is not usable
+        """
+        echo = self.protocol_handler.build_echo()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.probe_timeout)
+        try:
+            writer.write(echo)
+            response, _, _ = await asyncio.wait_for(self.protocol_handler.wait_and_handle_response_message(reader, echo), self.probe_timeout)
+            assert response is not None, "No echo response"
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def probe_when_dead(self):
+        while True:
+            await self._failed.wait()
+            if self._state == HealthState.DEAD:
+                await asyncio.sleep(max(0, self.retry_at - time.time()))
+            if not self.begin_attempt():
+                await asyncio.sleep(self.backoff_min) #a request is testing the remote already
+                continue
+
+            try:
+                await self.probe_once()
+                self.record_success()
+            except asyncio.CancelledError:
+                self.abort_attempt()
+                raise
+            except Exception as e:
+                self._logger.info('Echo probe to {}:{} failed: {}'.format(str(self.host), str(self.port), repr(e)))
+                self.record_failure()
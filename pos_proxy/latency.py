@@ -0,0 +1,36 @@
+import collections
+import math
+
+
+class LatencyTracker(object):
+    """
+    Response times (seconds) of the last window requests answered by one remote, for hedging requests that take
+    longer than the remote usually does. Percentiles are taken from a sorted copy of the samples, refreshed every
+    refresh samples rather than on every request.
+    ewma is the exponentially weighted moving average of all response times (weight alpha for the newest), None before the first.
+    """
+    def __init__(self, window = 256, min_samples = 20, refresh = 16, alpha = 0.2):
+        self.samples = collections.deque(maxlen = max(window, 1))
+        self.alpha = alpha
+        self.ewma = None
+        self.min_samples = min_samples
+        self.refresh = max(refresh, 1)
+        self._sorted = None
+        self._since_sorted = 0
+
+    def record(self, latency: float):
+        self.samples.append(latency)
+        self._since_sorted += 1
+        self.ewma = latency if self.ewma is None else self.ewma + self.alpha * (latency - self.ewma)
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns the nearest-rank p-th percentile of the recent response times, None while fewer than min_samples are known.
+        """
+        if len(self.samples) < max(self.min_samples, 1):
+            return None
+        if self._sorted is None or self._since_sorted >= self.refresh:
+            self._sorted = sorted(self.samples)
+            self._since_sorted = 0
+        rank = max(int(math.ceil(p / 100.0 * len(self._sorted))), 1)
+        return self._sorted[min(rank, len(self._sorted)) - 1]
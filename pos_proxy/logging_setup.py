@@ -1,22 +1,102 @@
 import logging.config
 import logging
+import atexit
+import binascii
 import os
-from logging.handlers import TimedRotatingFileHandler
+import queue
+import threading
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
-def setup_logging(working_folder, format='%(asctime)s [%(filename)s:%(lineno)s - %(funcName)20s() %(levelname)s] %(message)s', level=logging.INFO):
-    logging.basicConfig(format=format, level=level)        
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue for a QueueListener thread to write. When the queue is full the record is dropped
+    and counted on dropped (a metrics Counter, only incremented under this handler's lock as any thread may log),
+    or, with block, the logging thread waits until there is room.
+    """
+    def __init__(self, records: queue.Queue, block = False, dropped = None):
+        super().__init__(records)
+        self.block = block
+        self.dropped = dropped
+        self._dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.dropped is not None:
+                with self._dropped_lock:
+                    self.dropped.inc()
+
+
+def setup_logging(working_folder, format='%(asctime)s [%(filename)s:%(lineno)s - %(funcName)20s() %(levelname)s] %(message)s', level=logging.INFO, file_name="PosProxy.log",
+                  queue_size = 10000, overflow = 'drop') -> QueueListener:
+    """
+    Logs to the console and to a file in the log folder rotated at midnight. Log calls only put the record on a queue of
+    queue_size records, a listener thread writes them, so no log call waits for the disk or a rotation.
+    Input: overflow - what a log call does when the queue is full: drop (the record, counted as posproxy_log_records_dropped_total) or block (until there is room)
+    Returns:
+        QueueListener - the listener writing the records, stopped (after writing what is queued) at exit
+    """
+    from .metrics import registry #imports this module
+
+    if overflow not in ('drop', 'block'):
+        raise ValueError("Unknown log queue overflow {}".format(overflow))
 
     logger = logging.getLogger() #gets the root logger for the application
+    logger.setLevel(level)
+    formatter = logging.Formatter(format)
 
-    file = os.path.join(working_folder, "log/PosProxy.log")
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+
+    file = os.path.join(working_folder, "log", file_name) #one file per process, rotation can't be shared
     os.makedirs(os.path.dirname(file), exist_ok=True)
     
     handler = TimedRotatingFileHandler(file, when = 'midnight', backupCount=30)
     handler.setLevel(logging.DEBUG)
-
-    formatter = logging.Formatter(format)  
     handler.setFormatter(formatter)
-    
-    logger.addHandler(handler)
-       
-       
\ No newline at end of file
+
+    records = queue.Queue(maxsize = max(queue_size, 1))
+    dropped = registry.counter('posproxy_log_records_dropped_total', 'Log records dropped because the log queue was full.')
+    logger.addHandler(BoundedQueueHandler(records, block = overflow == 'block', dropped = dropped))
+
+    listener = QueueListener(records, console, handler, respect_handler_level = True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class ContextLogger(logging.LoggerAdapter):
+    """
+    Logs through the one logger of a class, putting the ID of the object that logs (a POS connection, a client, ...)
+    in front of every message and into the record as context_id.
+    The logging module keeps every named logger for good, so a logger per connection would grow without bound.
+    """
+    def process(self, msg, kwargs):
+        kwargs['extra'] = self.extra
+        return '[' + self.extra['context_id'] + '] ' + str(msg), kwargs
+
+
+def get_context_logger(owner, context_id) -> ContextLogger:
+    """
+    Returns a ContextLogger on the logger named after owner's class.
+    """
+    return ContextLogger(logging.getLogger(owner.__class__.__name__), {'context_id': str(context_id)})
+
+
+class HexDump(object):
+    """
+    A message shown as hex, only converted when a record holding it is emitted: pass it as a logging argument
+    (logger.debug('Sent: %s', HexDump(message))) so nothing is converted while DEBUG is off.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data).decode()
@@ -0,0 +1,266 @@
+import asyncio
+import bisect
+import time
+from uuid import uuid4
+from .logging_setup import get_context_logger
+
+#seconds, from a fast local remote to one about to time out
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class Counter(object):
+    """
+    A value that only goes up. Like all metrics it is only updated from the event loop, so it needs no lock; code
+    counting from other threads must hold a lock of its own (see BoundedQueueHandler).
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def samples(self, name):
+        yield name, (), self.value
+
+
+class Gauge(object):
+    """
+    A value that goes up and down.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount = 1):
+        self.value += amount
+
+    def dec(self, amount = 1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        yield name, (), self.value
+
+
+class Histogram(object):
+    """
+    Counts observations into fixed buckets (upper bounds), one bisect and two additions per observation.
+    The cumulative counts Prometheus expects are only added up when rendering.
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1) #the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            yield name + '_bucket', (('le', '+Inf' if bound == float('inf') else repr(float(bound))),), cumulative
+        yield name + '_sum', (), self.sum
+        yield name + '_count', (), cumulative
+
+
+class MetricsRegistry(object):
+    """
+    All metrics of the process, by name and labels. Asking for a metric that exists returns it, so listeners and
+    upstreams started again (or shared) keep counting where they were.
+    """
+    def __init__(self):
+        self._families = {} #name -> (type, help, {labels: metric})
+        self.lag_monitor = LoopLagMonitor(self)
+
+    def _get(self, cls, kind, name, help, labels, **kwargs):
+        family = self._families.setdefault(name, (kind, help, {}))
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = cls(**kwargs)
+        return metric
+
+    def counter(self, name, help, **labels) -> Counter:
+        return self._get(Counter, 'counter', name, help, labels)
+
+    def gauge(self, name, help, **labels) -> Gauge:
+        return self._get(Gauge, 'gauge', name, help, labels)
+
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._get(Histogram, 'histogram', name, help, labels, buckets = buckets)
+
+    def render(self, **only) -> str:
+        """
+        Returns the metrics in the Prometheus text format.
+        Input: only - label values to keep, metrics with another value for one of these labels are left out
+        """
+        only = {label: str(value) for label, value in only.items()}
+        lines = []
+        for name, (kind, help, metrics) in sorted(self._families.items()):
+            selected = [(labels, metric) for labels, metric in metrics.items()
+                        if all(only.get(label, value) == value for label, value in labels)]
+            if not selected:
+                continue
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in selected:
+                for sample_name, sample_labels, value in metric.samples(name):
+                    label_text = ','.join('{}="{}"'.format(label, _escape(value)) for label, value in labels + sample_labels)
+                    lines.append('{}{} {}'.format(sample_name, '{' + label_text + '}' if label_text else '', _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the event loop wakes up a task sleeping for interval seconds, which is how long a POS message
+    arriving at that time would have waited before being looked at. Runs while at least one MetricsServer does.
+    """
+    def __init__(self, registry: MetricsRegistry, interval = 0.25):
+        self.interval = interval
+        self.lag = registry.histogram('posproxy_event_loop_lag_seconds', 'Delay of the event loop in running a task that is due.', buckets = LAG_BUCKETS)
+        self.last_lag = registry.gauge('posproxy_event_loop_last_lag_seconds', 'Event loop delay at the last measurement.')
+        self._users = 0
+        self._task = None
+
+    def start(self):
+        self._users += 1
+        if self._task is None or self._task.get_loop() is not asyncio.get_running_loop():
+            self._task = asyncio.create_task(self.measure())
+
+    def stop(self):
+        self._users -= 1
+        if self._users <= 0 and self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._users = 0
+
+    async def measure(self):
+        while True:
+            due = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - due, 0.0)
+            self.lag.observe(lag)
+            self.last_lag.set(lag)
+
+
+class UpstreamMetrics(object):
+    """
+    Metrics of one remote of one listener, shared by its UpstreamPool and all of the pool's connections.
+    """
+    def __init__(self, registry: MetricsRegistry, listener, upstream: str):
+        labels = {'listener': listener, 'upstream': upstream}
+        self.latency = registry.histogram('posproxy_upstream_latency_seconds', 'Time from sending a request to the remote to having its response.', **labels)
+        self.timeouts = registry.counter('posproxy_upstream_timeouts_total', 'Requests the remote did not answer within the response timeout.', **labels)
+        self.rejections = registry.counter('posproxy_upstream_rejections_total', 'Requests not sent because the remote is backed off after failures (TimeoutNotExpiredError).', **labels)
+        self.connects = registry.counter('posproxy_upstream_connects_total', 'Connections opened to the remote, beyond MinConnections these are reconnects.', **labels)
+        self.disconnects = registry.counter('posproxy_upstream_disconnects_total', 'Connections to the remote closed, after failures or on shutdown.', **labels)
+        self.response_timeout = registry.gauge('posproxy_upstream_response_timeout_seconds', 'Response timeout of the last request to the remote, with AdaptiveTimeout.', **labels)
+        self.fanout_sent = registry.counter('posproxy_fanout_sent_total', 'Requests without a response sent to the remote from its fan-out queue.', **labels)
+        self.fanout_writes = registry.counter('posproxy_fanout_writes_total', 'Writes of the fan-out queue, each sending every request queued meanwhile.', **labels)
+        self.fanout_overflows = registry.counter('posproxy_fanout_overflows_total', 'Requests without a response dropped because the fan-out queue was full.', **labels)
+        self.fanout_dropped = registry.counter('posproxy_fanout_dropped_total', 'Requests without a response dropped because the remote was dead or the write failed.', **labels)
+
+
+class ListenerMetrics(object):
+    """
+    Metrics of one DispatcherServer, labelled with the port it listens on.
+    """
+    def __init__(self, registry: MetricsRegistry, listener):
+        self.registry = registry
+        self.listener = listener
+        self.connections = registry.gauge('posproxy_pos_connections', 'Open POS connections.', listener = listener)
+        self.in_flight = registry.gauge('posproxy_dispatches_in_flight', 'Requests being dispatched to remotes and answered.', listener = listener)
+        self.lane_window_full = registry.counter('posproxy_lane_window_full_total', 'Times a POS connection had MaxInFlight requests dispatched and was not read from until one was done.', listener = listener)
+        self.crc_failures = registry.counter('posproxy_crc_failures_total', 'Messages received with a bad header or XML CRC.', listener = listener)
+        self.hedges = registry.counter('posproxy_hedged_requests_total', 'Requests also sent to the next member of a redundancy group because the last one tried was slower than HedgePercentile.', listener = listener)
+        self.failovers = registry.counter('posproxy_failover_requests_total', 'Requests sent to the next member of a redundancy group because the last one tried failed.', listener = listener)
+        self.response_cache_hits = registry.counter('posproxy_response_cache_hits_total', 'Status requests and echoes answered from the response cache.', listener = listener)
+        self.response_cache_misses = registry.counter('posproxy_response_cache_misses_total', 'Status requests and echoes sent to the remotes for lack of a cached response.', listener = listener)
+        self._messages = {}
+
+    def count_message(self, handling_type: str):
+        counter = self._messages.get(handling_type)
+        if counter is None:
+            counter = self._messages[handling_type] = self.registry.counter('posproxy_messages_total', 'Requests received from POS connections, by MessageHandlingType (PASSTHROUGH when relayed unparsed).',
+                                                                             listener = self.listener, type = handling_type)
+        counter.inc()
+
+    def upstream(self, host, port) -> UpstreamMetrics:
+        return UpstreamMetrics(self.registry, self.listener, '{}:{}'.format(host, port))
+
+
+class MetricsServer(object):
+    """
+    A minimal HTTP server answering GET /metrics with the registry in the Prometheus text format.
+    Input: only - label values to keep (see MetricsRegistry.render), e.g. the listener of a DispatcherServer
+    """
+    def __init__(self, registry: MetricsRegistry, port, host = '127.0.0.1', request_timeout = 5, **only):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.request_timeout = request_timeout
+        self.only = only
+        self._server = None
+        self.uuid = uuid4()
+        self._logger = get_context_logger(self, self.uuid)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.__on_connection, self.host, self.port)
+        self.registry.lag_monitor.start()
+        self._logger.info('Serving metrics on {}:{}'.format(self.host, self.port))
+        return self
+
+    async def close(self):
+        if self._server is None:
+            return
+        self.registry.lag_monitor.stop()
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def __on_connection(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+            while True: #headers, not needed
+                line = await asyncio.wait_for(reader.readline(), self.request_timeout)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else ''
+            if parts and parts[0] == 'GET' and path in ('/', '/metrics'):
+                status, body = '200 OK', self.registry.render(**self.only).encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'
+                         .format(status, len(body)).encode() + body)
+            await writer.drain()
+        except Exception as e:
+            self._logger.info('Metrics request failed: {}'.format(repr(e)))
+        finally:
+            writer.close()
+
+
+registry = MetricsRegistry() #the process' metrics
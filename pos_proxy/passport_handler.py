@@ -2,18 +2,117 @@ import asyncio
 import struct
 import binascii
 import logging
+import re
+import time
 import xml.etree.ElementTree as ET
-from .client import read_all_message_bytes, MessageHandlingType
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from .client import read_all_message_bytes, MessageHandlingType, SocketClientError
+from .framing import FramedConnection
 from .handler import PosHandler
 
 
+class CrcError(AssertionError):
+    """
+    A message whose header or XML does not match its CRC.
+    """
+    pass
+
+
+class ParsedPassportMessage(object):
+    """
+    A Passport message that has been verified and classified once, so that the rest of the request/response
+    path never needs to parse the XML or compute CRCs again.
+    Messages read with read_message also carry when their header was read and when they were classified
+    (time.perf_counter_ns), for tracing.
+    """
+    __slots__ = ('message', 'message_type', 'xml_length', 'crc_data', 'crc_header',
+                 'handling_type', 'loyalty_id', 'loyalty_sequence_id', 'pos_sequence_id',
+                 'received_ns', 'classified_ns')
+
+    def __init__(self, message: bytes, message_type: int, xml_length: int, crc_data: int, crc_header: int):
+        self.message = message
+        self.message_type = message_type
+        self.xml_length = xml_length
+        self.crc_data = crc_data
+        self.crc_header = crc_header
+        self.handling_type = None
+        self.loyalty_id = None
+        self.loyalty_sequence_id = None
+        self.pos_sequence_id = None
+        self.received_ns = None
+        self.classified_ns = None
+
+    @property
+    def routing_id(self) -> str:
+        """
+        Card if card routing, session if session routing, None otherwise.
+        """
+        if self.handling_type == MessageHandlingType.CARD_BASED_UNICAST:
+            return self.loyalty_id
+        if self.handling_type == MessageHandlingType.SESSION_BASED_UNICAST:
+            return self.loyalty_sequence_id
+        return None
+
+    @property
+    def session_id(self) -> str:
+        """
+        The session id for maintaining sessions, if available.
+        """
+        if self.handling_type == MessageHandlingType.CARD_BASED_UNICAST or self.handling_type == MessageHandlingType.SESSION_BASED_UNICAST:
+            return self.loyalty_sequence_id
+        return None
+
+
+#Tags that make a message multicast, in order of precedence
+_MULTICAST_TAGS = {
+    'GetLoyaltyOnlineStatusRequest': MessageHandlingType.MULTICAST_WITH_RESPONSE,
+    'GetLoyaltyOnlineStatusResponse': MessageHandlingType.MULTICAST_WITH_RESPONSE,
+    'BeginCustomerRequest': MessageHandlingType.MULTICAST_NO_RESPONSE,
+    'EndCustomerRequest': MessageHandlingType.MULTICAST_NO_RESPONSE,
+}
+_MULTICAST_BYTE_TAGS = {tag.encode(): handling_type for tag, handling_type in _MULTICAST_TAGS.items()}
+_NO_RESPONSE_START_TAGS = [b'<' + tag for tag, handling_type in _MULTICAST_BYTE_TAGS.items() if handling_type == MessageHandlingType.MULTICAST_NO_RESPONSE]
+_WITH_RESPONSE_START_TAGS = [b'<' + tag for tag, handling_type in _MULTICAST_BYTE_TAGS.items() if handling_type == MessageHandlingType.MULTICAST_WITH_RESPONSE]
+
+#Start tags of the elements routing needs, followed by the character that ends the name
+_SCAN_TAGS = re.compile(rb'<(' + rb'|'.join(list(_MULTICAST_BYTE_TAGS) + [b'LoyaltyID', b'LoyaltySequenceID', b'POSSequenceID']) + rb')([\s/>])')
+#Anything a plain scan can not interpret the way an XML parser would: entities, CDATA, comments, DOCTYPE,
+#processing instructions (other than a leading XML declaration), namespaces and CR/LF normalization
+#(plain substring searches, much faster than a regex alternation here)
+_SCAN_AMBIGUOUS = ((b'&', 28), (b'<!', 28), (b'<?', 29), (b'xmlns', 28), (b'\r', 28))
+
+#The POSSequenceID element of a message, rewritten when answering from the response cache
+_POS_SEQUENCE_ID = re.compile(rb'<POSSequenceID(?:\s[^>]*)?(?:/>|>[^<]*</POSSequenceID>)')
+
+#signature, 2 zero bytes, message type, xml length, crc of the xml, crc of the header
+_HEADER = struct.Struct('<10s2sIIII')
+
+
+def _parse_detached(message: bytes, fast_scan: bool) -> ParsedPassportMessage:
+    """
+    parse_message for a process pool: returns the parsed message without the message itself, which the caller already has.
+    """
+    parsed = PassportHandler(fast_scan = fast_scan).parse_message(message)
+    parsed.message = None
+    return parsed
+
 
 class PassportHandler(PosHandler):
     """
     Implementation of a PosHandler for Passport Loyalty protocol.
+    Received messages of offload_threshold bytes or more are verified and classified on offload_executor
+    (a concurrent.futures thread or process pool), so a huge basket does not stall every other lane on the event loop.
+    Messages failing a CRC check raise CrcError and are counted on crc_failures (a metrics Counter) when one is passed.
     """
-    def __init__(self):
+    def __init__(self, fast_scan = True, offload_threshold = 0, offload_executor = None, crc_failures = None):
         self.header_bytes_length = 28
+        self.fast_scan = fast_scan
+        self.offload_threshold = offload_threshold
+        self.offload_executor = offload_executor
+        self.crc_failures = crc_failures
+        #parses on offload_executor threads, where nothing may be counted; failures are counted back on the event loop
+        self._offload_handler = PassportHandler(fast_scan = fast_scan) if offload_executor is not None else None
         self._logger = logging.getLogger(self.__class__.__name__)
 
 
@@ -27,23 +126,37 @@ class PassportHandler(PosHandler):
             crc_data - CRC of the following message
             bytes - the raw processed header 
         """
-        signature =  input[0:10].decode()        
-        assert signature == "POSLOYALTY", "First 10 bytes are not POSLOYALTY"
-        assert input[10] == 0, "11th byte is not 0"
-        assert input[11] == 0, "12th byte is not 0"
+        _, xml_length, crc_data, _ = self.unpack_header(input)
+        return xml_length, crc_data, input[0:28]
 
-        #read bytes 12 to 15 in netowrk byte order as int
-        message_type = struct.unpack("<I", input[12:16])[0]        
+    def unpack_header(self, input) -> (int, int, int, int):
+        """
+        Decodes and verifies the header in one unpack, without slicing the message.
+        Input: input - bytes-like object starting with the header
+        Returns:
+            message_type, xml_length, crc_data, crc_header
+        """
+        signature, padding, message_type, xml_length, crc_data, crc_header = _HEADER.unpack_from(input)
+        assert signature == b"POSLOYALTY", "First 10 bytes are not POSLOYALTY"
+        assert padding[0] == 0, "11th byte is not 0"
+        assert padding[1] == 0, "12th byte is not 0"
         assert message_type == 1 or message_type == 2, "Invalid message type"
+        if crc_header != (binascii.crc32(memoryview(input)[0:24]) & 0xffffffff):
+            raise self.crc_error("Invalid header CRC")
+        return message_type, xml_length, crc_data, crc_header
 
-        xml_length = struct.unpack("<I", input[16:20])[0]
-
-        crc_data = struct.unpack("<I", input[20:24])[0]
-        crc_header = struct.unpack("<I", input[24:28])[0]
-        
-        assert crc_header == (binascii.crc32(input[0:24]) & 0xffffffff), "Invalid header CRC"
-
-        return xml_length, crc_data, input[0:28]
+    def frame_length(self, buffer, offset: int = 0) -> int:
+        """
+        Decodes just enough of a header, in place, to know where the message ends (the header CRC is verified when parsing).
+        Input:
+            buffer - bytes-like object holding at least a header from offset on
+            offset - where the header starts
+        Returns:
+            int - the length of the complete message, header included
+        """
+        signature, _, _, xml_length, _, _ = _HEADER.unpack_from(buffer, offset)
+        assert signature == b"POSLOYALTY", "First 10 bytes are not POSLOYALTY"
+        return self.header_bytes_length + xml_length
 
     def verify_message(self, message: bytes):
         """
@@ -52,8 +165,16 @@ class PassportHandler(PosHandler):
         """
         _, crc_data, _ = self.process_header(message)
 
-        if crc_data > 0:                    
-            assert crc_data == (binascii.crc32(self.get_xml(message)) & 0xffffffff), "Invalid message XML CRC"
+        if crc_data > 0 and crc_data != (binascii.crc32(self.get_xml(message)) & 0xffffffff):
+            raise self.crc_error("Invalid message XML CRC")
+
+    def crc_error(self, reason: str) -> CrcError:
+        """
+        Counts a CRC failure and returns the error to raise.
+        """
+        if self.crc_failures is not None:
+            self.crc_failures.inc()
+        return CrcError(reason)
 
     async def read_and_process_header(self, reader: asyncio.StreamReader) -> (int, bytes):
         """
@@ -77,87 +198,300 @@ class PassportHandler(PosHandler):
         """
         Checks if this is a binary echo message.
         """
-        message_type = struct.unpack("<I", message[12:16])[0]    
+        message_type = struct.unpack_from("<I", message, 12)[0]
         if message_type == 2:
             return True
 
         return False
 
-    def get_message_handling_type_and_identifier(self, message: bytes) -> (MessageHandlingType, str, str):
+    def expects_response(self, message) -> bool:
         """
-        Returns the basic routing info for a message.
-        Input: message - the message as bytes
+        Whether the remote answers this message: everything but Begin/EndCustomerRequest (MULTICAST_NO_RESPONSE),
+        found by searching the raw bytes for their start tags rather than parsing the XML.
+        Input: message - the complete message, as bytes or a memoryview of a frame
+        """
+        if isinstance(message, memoryview):
+            message = message.obj if message.nbytes == len(message.obj) else message.tobytes()
+        if self.is_binary_echo(message):
+            return True
+        if not any(message.find(tag, 28) != -1 for tag in _NO_RESPONSE_START_TAGS):
+            return True
+        return any(message.find(tag, 28) != -1 for tag in _WITH_RESPONSE_START_TAGS)
+
+    def build_message(self, xml: bytes, message_type: int = 1) -> bytes:
+        """
+        Builds a complete Passport message (header with both CRCs followed by the XML).
+        Input:
+            xml - the XML portion of the message
+            message_type - 1 for a regular message, 2 for a binary echo
         Returns:
-            MessageHandlingType - the base handling type of the message
-            routing_id - card if card routing, session if session routing - dispatcher should route on that
-            session_id - the session id for maintaining sessions, if available
-        """        
-        self.verify_message(message)
+            bytes - the complete message
+        """
+        header = b'POSLOYALTY\x00\x00' + struct.pack("<III", message_type, len(xml), binascii.crc32(xml) & 0xffffffff)
+        return header + struct.pack("<I", binascii.crc32(header) & 0xffffffff) + xml
 
-        if self.is_binary_echo(message):
-            return MessageHandlingType.MULTICAST_WITH_RESPONSE, None, None
+    def build_echo(self) -> bytes:
+        """
+        Returns a binary echo message (message type 2), which a Passport remote answers with an echo.
+        """
+        return self.build_message(b'', message_type = 2)
 
-        xml_bytes = self.get_xml(message)
-        root = ET.fromstring(xml_bytes.decode())
+    def response_cache_key(self, request) -> str:
+        """
+        Returns the key under which responses to this request can be cached: PASSPORT_ECHO for binary echoes,
+        GetLoyaltyOnlineStatus for online status requests (the only XML requests multicast with a response), None for all others.
+        Input: request - the request, as bytes or parsed
+        """
+        request = self.parse_message(request)
+        if request.handling_type != MessageHandlingType.MULTICAST_WITH_RESPONSE:
+            return None
+        return 'PASSPORT_ECHO' if request.message_type == 2 else 'GetLoyaltyOnlineStatus'
 
-        for _ in root.iter('GetLoyaltyOnlineStatusRequest'):
-            return MessageHandlingType.MULTICAST_WITH_RESPONSE, None, None
+    def rewrite_response(self, response, request) -> bytes:
+        """
+        Adapts a cached response to another request: sets its POSSequenceID to the request's and recomputes both CRCs.
+        Input:
+            response - the cached response, as bytes
+            request - the request to answer, as bytes or parsed
+        Returns:
+            bytes - the response for request, None if the response has no POSSequenceID to rewrite
+        """
+        if self.is_binary_echo(response):
+            return response #no XML, nothing identifies the request
+
+        request = self.parse_message(request)
+        xml = self.get_xml(response)
+        match = _POS_SEQUENCE_ID.search(xml)
+        if match is None:
+            return None
+        sequence_id = escape(request.pos_sequence_id or '').encode()
+        xml = xml[:match.start()] + b'<POSSequenceID>' + sequence_id + b'</POSSequenceID>' + xml[match.end():]
+        return self.build_message(xml, struct.unpack_from("<I", response, 12)[0])
+
+    def parse_message(self, message) -> ParsedPassportMessage:
+        """
+        Verifies a complete Passport message and extracts everything needed to route and match it, in one pass.
+        Input: message - the complete message as bytes (or a memoryview of a frame), or an already parsed message (returned unchanged)
+        Returns:
+            ParsedPassportMessage - the header fields, handling type and routing/sequence IDs of the message
+        """
+        if isinstance(message, ParsedPassportMessage):
+            return message
 
-        for _ in root.iter('GetLoyaltyOnlineStatusResponse'):
-            return MessageHandlingType.MULTICAST_WITH_RESPONSE, None, None
+        message_type, xml_length, crc_data, crc_header = self.unpack_header(message)
+        parsed = ParsedPassportMessage(message, message_type, xml_length, crc_data, crc_header)
 
-        for _ in root.iter('BeginCustomerRequest'):
-            return MessageHandlingType.MULTICAST_NO_RESPONSE, None, None
-        
-        for _ in root.iter('EndCustomerRequest'):
-            return MessageHandlingType.MULTICAST_NO_RESPONSE, None, None
-        
+        if crc_data > 0 and crc_data != (binascii.crc32(memoryview(message)[28:]) & 0xffffffff):
+            raise self.crc_error("Invalid message XML CRC")
+
+        if isinstance(message, memoryview):
+            #scan the frame's own buffer rather than copying it, the memoryview is what gets forwarded
+            message = message.obj if message.nbytes == len(message.obj) else message.tobytes()
+
+        if parsed.message_type == 2:
+            parsed.handling_type = MessageHandlingType.MULTICAST_WITH_RESPONSE
+            parsed.pos_sequence_id = 'PASSPORT_ECHO'
+            return parsed
+
+        fields = self.scan_fields(message) if self.fast_scan else None
+        if fields is None:
+            fields = self.parse_fields(message)
+        multicast_type, parsed.pos_sequence_id, parsed.loyalty_id, parsed.loyalty_sequence_id = fields
+
+        if multicast_type is not None:
+            parsed.handling_type = multicast_type
         #If we have card #, route based on card #, but still record session ID if available
+        elif parsed.loyalty_id is not None:
+            parsed.handling_type = MessageHandlingType.CARD_BASED_UNICAST
+        #If no card #, route based on Session
+        elif parsed.loyalty_sequence_id is not None:
+            parsed.handling_type = MessageHandlingType.SESSION_BASED_UNICAST
+        #Nothing to base routing on, default route
+        else:
+            parsed.handling_type = MessageHandlingType.DEFAULT_UNICAST
+
+        return parsed
+
+    def parse_fields(self, message: bytes) -> (MessageHandlingType, str, str, str):
+        """
+        Extracts the routing fields with a full ElementTree parse of the XML portion.
+        Input: message - the complete message
+        Returns:
+            multicast_type - MULTICAST_WITH_RESPONSE/MULTICAST_NO_RESPONSE if the message is to be multicast, None otherwise
+            pos_sequence_id - text of the first POSSequenceID
+            loyalty_id - text of the first non-empty LoyaltyID
+            loyalty_sequence_id - text of the first non-empty LoyaltySequenceID
+        """
+        root = ET.fromstring(self.get_xml(message).decode())
+        multicast_type = pos_sequence_id = loyalty_id = loyalty_sequence_id = None
+
+        for node in root.iter('POSSequenceID'):
+            pos_sequence_id = node.text
+            break
+
+        for tag in _MULTICAST_TAGS:
+            for _ in root.iter(tag):
+                multicast_type = _MULTICAST_TAGS[tag]
+                break
+            if multicast_type is not None:
+                break
+
         for node in root.iter('LoyaltyID'):
             if node.text:
-                session_id = None
-                for ses_node in root.iter('LoyaltySequenceID'):
-                    if ses_node.text:
-                        session_id = ses_node.text
-                        break
-                return MessageHandlingType.CARD_BASED_UNICAST, node.text, session_id
-        
-        #If no card #, route based on Session
+                loyalty_id = node.text
+                break
+
         for node in root.iter('LoyaltySequenceID'):
             if node.text:
-                return MessageHandlingType.SESSION_BASED_UNICAST, node.text, node.text        
+                loyalty_sequence_id = node.text
+                break
 
-        #Nothing to base routing on, default route
-        return MessageHandlingType.DEFAULT_UNICAST, None, None
-
-    def get_sequence_id(self, message: bytes) -> (str):
-            """
-            Returns the unique message sequence ID.
-            Input: message - the complete message to get the sequnce ID from
-            Returns:
-                sequence id - the sequence if from the message, PASSPORT_ECHO if binary echo
-            """        
-            self.verify_message(message)
-
-            if self.is_binary_echo(message):
-                return 'PASSPORT_ECHO'
-
-            xml_bytes = self.get_xml(message)
-            root = ET.fromstring(xml_bytes.decode())
-
-            for node in root.iter('POSSequenceID'):
-                return node.text
-            
-    def verify_sequence_id(self, request: bytes, response: bytes) -> (bool):
+        return multicast_type, pos_sequence_id, loyalty_id, loyalty_sequence_id
+
+    def scan_fields(self, message: bytes) -> (MessageHandlingType, str, str, str):
+        """
+        Extracts the same fields as parse_fields by scanning the raw bytes for the few tags routing needs,
+        without building a tree.
+        Input: message - the complete message
+        Returns:
+            the same tuple as parse_fields, or None if the XML uses constructs the scan cannot interpret
+            exactly as a parser would (CDATA, comments, entities, namespaces, ...) and a full parse is needed
+        """
+        for token, start in _SCAN_AMBIGUOUS:
+            if message.find(token, start) != -1:
+                return None
+
+        pos_sequence_id = loyalty_id = loyalty_sequence_id = None
+        pos_sequence_found = False
+        multicast_types = set()
+        for match in _SCAN_TAGS.finditer(message, 28):
+            tag = match.group(1)
+            if tag in _MULTICAST_BYTE_TAGS:
+                multicast_types.add(_MULTICAST_BYTE_TAGS[tag])
+                continue
+
+            if tag == b'POSSequenceID':
+                if pos_sequence_found:
+                    continue
+            elif tag == b'LoyaltyID':
+                if loyalty_id is not None:
+                    continue
+            elif loyalty_sequence_id is not None:
+                continue
+
+            text_start = match.end()
+            if match.group(2) != b'>':
+                tag_end = message.find(b'>', match.end(1))
+                if tag_end == -1:
+                    return None
+                attributes = message[match.end(1):tag_end]
+                if b'<' in attributes or (attributes.count(b'"') + attributes.count(b"'")) % 2 != 0:
+                    return None
+                text_start = tag_end + 1
+                if attributes.endswith(b'/'): #self-closing, no text
+                    text_start = None
+
+            text = None
+            if text_start is not None:
+                text_end = message.find(b'<', text_start)
+                if text_end == -1:
+                    return None
+                if text_end > text_start:
+                    text = message[text_start:text_end].decode()
+
+            if tag == b'POSSequenceID':
+                pos_sequence_id = text
+                pos_sequence_found = True
+            elif text:
+                if tag == b'LoyaltyID':
+                    loyalty_id = text
+                else:
+                    loyalty_sequence_id = text
+
+        multicast_type = None
+        if MessageHandlingType.MULTICAST_WITH_RESPONSE in multicast_types:
+            multicast_type = MessageHandlingType.MULTICAST_WITH_RESPONSE
+        elif MessageHandlingType.MULTICAST_NO_RESPONSE in multicast_types:
+            multicast_type = MessageHandlingType.MULTICAST_NO_RESPONSE
+
+        return multicast_type, pos_sequence_id, loyalty_id, loyalty_sequence_id
+
+    def get_message_handling_type_and_identifier(self, message) -> (MessageHandlingType, str, str):
+        """
+        Returns the basic routing info for a message.
+        Input: message - the message as bytes (or an already parsed message)
+        Returns:
+            MessageHandlingType - the base handling type of the message
+            routing_id - card if card routing, session if session routing - dispatcher should route on that
+            session_id - the session id for maintaining sessions, if available
+        """
+        parsed = self.parse_message(message)
+        return parsed.handling_type, parsed.routing_id, parsed.session_id
+
+    def get_sequence_id(self, message) -> (str):
+        """
+        Returns the unique message sequence ID.
+        Input: message - the complete message (bytes or already parsed) to get the sequence ID from
+        Returns:
+            sequence id - the sequence if from the message, PASSPORT_ECHO if binary echo
+        """
+        return self.parse_message(message).pos_sequence_id
+
+    def verify_sequence_id(self, request, response) -> (bool):
         return (self.get_sequence_id(request) == self.get_sequence_id(response))
 
+    async def read_message(self, reader: asyncio.StreamReader) -> ParsedPassportMessage:
+        """
+        Waits for a complete message on the reader and parses it.
+        Input: reader - the asyncio stream reader to use for reading, or a FramedConnection
+        Returns:
+            ParsedPassportMessage - the received message, verified and classified
+
+        Raises:
+            SocketClientError - if sockets get closed before receiving a full message.
+        """
+        if isinstance(reader, FramedConnection):
+            try:
+                message = await reader.read_frame()
+            except asyncio.IncompleteReadError:
+                raise SocketClientError("Socket closed.")
+            received_ns = time.perf_counter_ns()
+        else:
+            header_bytes = await read_all_message_bytes(reader, self.header_bytes_length)
+            received_ns = time.perf_counter_ns()
+            #like a frame, the header is only verified once, by parse_message
+            message = header_bytes + await read_all_message_bytes(reader, self.frame_length(header_bytes) - self.header_bytes_length)
+
+        if self.offload_executor is None or self.offload_threshold <= 0 or len(message) < self.offload_threshold:
+            parsed = self.parse_message(message)
+        else:
+            parsed = await self.parse_message_offloaded(message)
+        parsed.received_ns = received_ns
+        parsed.classified_ns = time.perf_counter_ns()
+        return parsed
+
+    async def parse_message_offloaded(self, message) -> ParsedPassportMessage:
+        """
+        parse_message on the offload executor.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if not isinstance(self.offload_executor, ProcessPoolExecutor):
+                return await loop.run_in_executor(self.offload_executor, self._offload_handler.parse_message, message)
+            parsed = await loop.run_in_executor(self.offload_executor, _parse_detached, bytes(message), self.fast_scan)
+        except CrcError as e:
+            raise self.crc_error(str(e)) #raised by a handler without crc_failures, count it here on the event loop
+        parsed.message = message
+        return parsed
+
 #Should return the response message (bytes, and whether the message is echo or not)
-    async def wait_and_handle_response_message(self, reader: asyncio.StreamReader, request: bytes) -> (bytes, MessageHandlingType, str):
+    async def wait_and_handle_response_message(self, reader: asyncio.StreamReader, request, trace = None) -> (bytes, MessageHandlingType, str):
         """
         Waits for a fully received response using the provided StreamReader and returns the response and its meta-data.
         Input: 
             reader - the StreamReader to use
-            request - the request message that has been sent already that we are waitig a response for - it is needed in order to internally recognize its response policy.
+            request - the request message (bytes or already parsed) that has been sent already that we are waitig a response for - it is needed in order to internally recognize its response policy.
+            trace - MessageTrace of the request, stamped with the arrival of the response (optional)
         Returns: 
             response - the awaited response
             message_type - the message type of the response
@@ -166,40 +500,27 @@ class PassportHandler(PosHandler):
         Raises:
             SocketClientError - if sockets get closed before receiving a full message.
         """
-
-        message_type, _, _ = self.get_message_handling_type_and_identifier(request)
-        if message_type == MessageHandlingType.MULTICAST_NO_RESPONSE:
+        request = self.parse_message(request)
+        if request.handling_type == MessageHandlingType.MULTICAST_NO_RESPONSE:
             return None, MessageHandlingType.MULTICAST_NO_RESPONSE, None
 
-        xml_length, header_bytes = await self.read_and_process_header(reader)
-
-        xml_bytes = await read_all_message_bytes(reader, xml_length)
-
-        response = header_bytes + xml_bytes
-        message_type, _, session_id = self.get_message_handling_type_and_identifier(response)
+        response = await self.read_message(reader)
+        if trace is not None:
+            trace.first_response = response.received_ns
 
         assert self.verify_sequence_id(request, response), "Response SequenceID doesn't match request"
 
-        return response, message_type, session_id
+        return response.message, response.handling_type, response.session_id
 
-    async def wait_and_handle_request_message(self, reader: asyncio.StreamReader) -> (bytes, MessageHandlingType, str, str):
+    async def wait_and_handle_request_message(self, reader: asyncio.StreamReader) -> ParsedPassportMessage:
         """
-        Waits for a fully received request using the provided StreamReader and returns the received whole message and its meta-data.
+        Waits for a fully received request using the provided StreamReader and returns it parsed.
         Input: 
             reader - the StreamReader to use            
         Returns: 
-            message - the awaited complete message
-            message_type - the message type
-            routing_id - the ID around which to base roting one, dependant on type
-            session_id - the session number, if available, for the caller to track sessions
+            ParsedPassportMessage - the complete message together with its handling type, routing ID and session ID
         
         Raises:
             SocketClientError - if sockets get closed before receiving a full message.
         """
-        xml_length, header_bytes = await self.read_and_process_header(reader)
-
-        xml_bytes = await read_all_message_bytes(reader, xml_length)
-
-        message = header_bytes + xml_bytes
-        message_type, routing_id, session_id = self.get_message_handling_type_and_identifier(message)
-        return message, message_type, routing_id, session_id
\ No newline at end of file
+        return await self.read_message(reader)
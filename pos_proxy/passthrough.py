@@ -0,0 +1,151 @@
+import asyncio
+import collections
+from uuid import uuid4
+from .capture import REQUEST, RESPONSE
+from .framing import FramedConnection, open_framed_connection
+from .logging_setup import get_context_logger
+
+
+class PassthroughRelay(object):
+    """
+    Relays one POS connection to a connection of its own to the only remote, for listeners that have nothing to route.
+    Messages are only split by length and copied to the other side from the connection callbacks; nothing is parsed,
+    and with verify_crc only both CRCs are checked. The remote connection is opened with the
+    first message, and the POS connection is closed when the remote can't be reached or closes, or a message fails the CRC check,
+    as a Dispatcher does when a message could not be dispatched. The health of the remote (shared by all relays to it) is updated with every connect.
+    Every request the remote answers (see PosHandler.expects_response) must be answered within response_timeout seconds, in order;
+    otherwise the remote is recorded as failed and the POS connection closed, as a Dispatcher does.
+    Each side stops being read while the other side's write buffer is full, so a slow peer can't make the relay buffer without bounds.
+    Relayed requests are counted as PASSTHROUGH on metrics (a ListenerMetrics), connects on upstream_metrics, when passed.
+    With a capture (a CaptureWriter), relayed requests and responses are added to it, under this relay's uuid.
+    """
+    def __init__(self, connection: FramedConnection, handler, host, port, health, connect_timeout = 10, response_timeout = 10, verify_crc = False, metrics = None, upstream_metrics = None, capture = None):
+        self.connection = connection
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.health = health
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        self.verify_crc = verify_crc
+        self.metrics = metrics
+        self.upstream_metrics = upstream_metrics
+        self.capture = capture
+        self.upstream = None
+        self._backlog = [] #requests received while connecting
+        self._connect_task = None
+        self._deadlines = collections.deque() #of the requests waiting for a response, oldest first
+        self._timer = None
+        self.uuid = uuid4()
+        self._logger = get_context_logger(self, self.uuid)
+
+    async def run(self):
+        """
+        Relays until the POS connection is closed.
+        """
+        self.connection.set_frame_received(self.__request_received)
+        try:
+            await self.connection.wait_closed()
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+            if self._connect_task is not None:
+                self._connect_task.cancel()
+            if self.upstream is not None:
+                self.upstream.close()
+
+    def __verified(self, frame) -> bool:
+        if not self.verify_crc:
+            return True
+        try:
+            self.handler.verify_message(frame)
+            return True
+        except Exception as e:
+            self._logger.error('Invalid message ({}), closing POS connection.'.format(repr(e)))
+            self.connection.close()
+            return False
+
+    def __request_received(self, frame):
+        if not self.__verified(frame):
+            return
+        if self.metrics is not None:
+            self.metrics.count_message('PASSTHROUGH')
+        if self.capture is not None:
+            self.capture.record(REQUEST, self.uuid, '', frame)
+        if self.handler.expects_response(frame):
+            self._deadlines.append(asyncio.get_running_loop().time() + self.response_timeout)
+            if self._timer is None:
+                self.__schedule_timeout()
+        if self.upstream is not None:
+            self.upstream.write(frame)
+            return
+        self._backlog.append(frame)
+        if self._connect_task is None:
+            self._connect_task = asyncio.create_task(self.__connect())
+
+    def __schedule_timeout(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._deadlines:
+            self._timer = asyncio.get_running_loop().call_at(self._deadlines[0], self.__response_timed_out)
+
+    def __response_timed_out(self):
+        self._timer = None
+        if not self._deadlines or self._deadlines[0] > asyncio.get_running_loop().time():
+            self.__schedule_timeout()
+            return
+        if self.upstream_metrics is not None:
+            self.upstream_metrics.timeouts.inc()
+        self.health.record_failure()
+        self._logger.error('Remote {}:{} did not respond within {}s, closing POS connection.'.format(str(self.host), str(self.port), self.response_timeout))
+        self.connection.close()
+
+    def __response_received(self, frame):
+        if self._deadlines:
+            self._deadlines.popleft()
+            self.__schedule_timeout()
+        if self.__verified(frame):
+            self.connection.write(frame)
+            if self.capture is not None:
+                self.capture.record(RESPONSE, self.uuid, '{}:{}'.format(self.host, self.port), frame)
+
+    async def __connect(self):
+        if not self.health.begin_attempt():
+            if self.upstream_metrics is not None:
+                self.upstream_metrics.rejections.inc()
+            self._logger.error('Remote {}:{} is dead, closing POS connection.'.format(str(self.host), str(self.port)))
+            self.connection.close()
+            return
+
+        try:
+            upstream = await asyncio.wait_for(open_framed_connection(self.handler, self.host, self.port), self.connect_timeout)
+        except asyncio.CancelledError:
+            self.health.abort_attempt()
+            raise
+        except Exception as e:
+            self.health.record_failure()
+            self._logger.error('Could not connect to {}:{} ({}), closing POS connection.'.format(str(self.host), str(self.port), repr(e)))
+            self.connection.close()
+            return
+        self.health.record_success()
+        if self.upstream_metrics is not None:
+            self.upstream_metrics.connects.inc()
+        self._logger.info('Relaying to {}:{}'.format(str(self.host), str(self.port)))
+
+        self.upstream = upstream
+        upstream.set_frame_received(self.__response_received)
+        upstream.set_writing_paused_changed(lambda paused: self.connection.pause_reading() if paused else self.connection.resume_reading())
+        self.connection.set_writing_paused_changed(lambda paused: upstream.pause_reading() if paused else upstream.resume_reading())
+        asyncio.create_task(self.__close_with_upstream(upstream))
+        for frame in self._backlog:
+            upstream.write(frame)
+        self._backlog = []
+
+    async def __close_with_upstream(self, upstream: FramedConnection):
+        await upstream.wait_closed()
+        if self.upstream_metrics is not None:
+            self.upstream_metrics.disconnects.inc()
+        if not self.connection.is_closing():
+            self._logger.error('Remote {}:{} closed the connection, closing POS connection.'.format(str(self.host), str(self.port)))
+            self.connection.close()
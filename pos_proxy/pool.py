@@ -0,0 +1,272 @@
+import asyncio
+import contextlib
+import time
+import weakref
+from uuid import uuid4
+from .client import SocketClient, TimeoutNotExpiredError, MessageHandlingType
+from .fanout import FanoutQueue
+from .health import RemoteHealth, HealthState
+from .latency import LatencyTracker
+from .logging_setup import get_context_logger
+
+
+class UpstreamPool(object):
+    """
+    A set of connections to one remote host, shared by all Dispatchers of a DispatcherServer.
+    Connections are leased per request and returned afterwards, so the number of upstream sockets follows
+    the number of concurrent requests instead of the number of POS lanes. A connection serves one lease at a time,
+    or up to pipeline_depth at once when pipelined.
+    All connections share one RemoteHealth, so an outage is detected, backed off from and probed once per remote.
+    Offers the same sending interface as a SocketClient, so a Dispatcher can use either.
+    The pool and its connections count into the same metrics (an UpstreamMetrics), when passed.
+    Requests without a response can be handed to fanout (a FanoutQueue of up to fanout_queue_size requests) instead,
+    which sends them on a connection of its own.
+    Response times of answered requests are kept in latencies (a LatencyTracker), for hedging, and requests being sent
+    or answered are counted in outstanding. Pools with the same redundancy_group serve the same cards (see RoutingTable.redundant),
+    spread over them by the group's balancer and weight.
+    With adaptive_timeout, requests wait for their response adaptive_timeout_multiplier times the adaptive_timeout_percentile
+    of the recent response times, but at least response_timeout_floor and at most response_timeout, so a remote that got
+    much slower than usual is given up on (and backed off from) quickly. A timed out request counts as a response time
+    of the timeout used, so the timeout grows again when the remote stays slower.
+    A lane (the Dispatcher of a POS connection) that sent a request without a response is pinned to the connection it went out on
+    until its next request has been sent there too, so the remote receives a lane's requests in the order the POS sent them.
+    """
+    def __init__(self, protocol_handler, host, port, masks = [], min_connections = 1, max_connections = 8, retry_timeout = 150, connect_timeout = 10, response_timeout = 10, keep_warm_interval = 30, pipeline_depth = 1,
+                 retry_backoff_min = 1, health_probe = True, framed = False, metrics = None, fanout_queue_size = 1000,
+                 redundancy_group = None, balancer = 'first', weight = 1, adaptive_timeout = False, adaptive_timeout_percentile = 99, adaptive_timeout_multiplier = 2,
+                 response_timeout_floor = 0.2, failure_threshold = 3):
+        self.protocol_handler = protocol_handler
+        self.host = host
+        self.port = port
+        self.masks = masks
+        self.min_connections = min_connections
+        self.max_connections = max(max_connections, 1)
+        self.retry_timeout = retry_timeout
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        self.keep_warm_interval = keep_warm_interval
+        self.pipeline_depth = max(pipeline_depth, 1)
+        self.framed = framed
+        self.metrics = metrics
+        self.redundancy_group = redundancy_group
+        self.balancer = balancer
+        self.weight = weight
+        self.outstanding = 0
+        self.latencies = LatencyTracker()
+        self.adaptive_timeout = adaptive_timeout
+        self.adaptive_timeout_percentile = adaptive_timeout_percentile
+        self.adaptive_timeout_multiplier = adaptive_timeout_multiplier
+        self.response_timeout_floor = min(response_timeout_floor, response_timeout)
+        self.health = RemoteHealth(protocol_handler, host, port, backoff_min = retry_backoff_min, backoff_max = retry_timeout, probe = health_probe, failure_threshold = failure_threshold)
+        self.fanout = FanoutQueue(protocol_handler, host, port, self.health, max_size = fanout_queue_size, connect_timeout = connect_timeout, framed = framed, metrics = metrics)
+        self._leases = {} #every connection that is open or being opened -> number of requests currently using it
+        self._available = asyncio.Condition()
+        self._pinned = weakref.WeakKeyDictionary() #lane -> connection its next request must go out on
+        self._warm_task = None
+        self.uuid = uuid4()
+        self._logger = get_context_logger(self, self.uuid)
+        self._logger.info('Pool initialized to {}:{} ({} to {} connections)'.format(str(self.host), str(self.port), self.min_connections, self.max_connections))
+
+    @classmethod
+    def from_config(cls, protocol_handler, cli_cfg, framed = False, metrics = None):
+        """
+        Creates a pool from a client section of a .proxy file.
+        """
+        return cls(protocol_handler = protocol_handler, host = cli_cfg['Remote'], port = cli_cfg.getint('Port'),
+                   masks = [x.strip() for x in cli_cfg.get('CardMasks', '').split(',')],
+                   min_connections = cli_cfg.getint('MinConnections', 1), max_connections = cli_cfg.getint('MaxConnections', 8),
+                   pipeline_depth = cli_cfg.getint('PipelineDepth', 1), retry_backoff_min = cli_cfg.getfloat('RetryBackoffMin', 1),
+                   retry_timeout = cli_cfg.getfloat('RetryBackoffMax', 150), health_probe = cli_cfg.getboolean('HealthProbe', True), framed = framed, metrics = metrics,
+                   fanout_queue_size = cli_cfg.getint('FanoutQueueSize', 1000), redundancy_group = cli_cfg.get('RedundancyGroup') or None,
+                   balancer = cli_cfg.get('Balancer', 'first'), weight = cli_cfg.getfloat('Weight', 1),
+                   connect_timeout = cli_cfg.getfloat('ConnectTimeout', 10), response_timeout = cli_cfg.getfloat('ResponseTimeout', 10),
+                   adaptive_timeout = cli_cfg.getboolean('AdaptiveTimeout', False), adaptive_timeout_percentile = cli_cfg.getfloat('AdaptiveTimeoutPercentile', 99),
+                   adaptive_timeout_multiplier = cli_cfg.getfloat('AdaptiveTimeoutMultiplier', 2), response_timeout_floor = cli_cfg.getfloat('ResponseTimeoutFloor', 0.2),
+                   failure_threshold = cli_cfg.getint('FailureThreshold', 3))
+
+    @property
+    def size(self) -> int:
+        return len(self._leases)
+
+    @property
+    def available(self) -> bool:
+        return self.health.available
+
+    def start(self):
+        """
+        Starts keeping the minimum number of connections open and probing the remote while it is dead, in the background.
+        """
+        self.health.start()
+        if self._warm_task is None and self.min_connections > 0:
+            self._warm_task = asyncio.create_task(self.keep_warm())
+
+    async def close(self):
+        self.health.close()
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+            self._warm_task = None
+        await self.fanout.close()
+
+        clients = list(self._leases)
+        self._leases.clear()
+        for client in clients:
+            await client.disconnect()
+        self._logger.info('Pool to {}:{} closed'.format(str(self.host), str(self.port)))
+
+    def _new_client(self) -> SocketClient:
+        return SocketClient(protocol_handler = self.protocol_handler, host = self.host, port = self.port, retry_timeout = self.retry_timeout,
+                            connect_timeout = self.connect_timeout, response_timeout = self.response_timeout, masks = self.masks,
+                            pipeline_depth = self.pipeline_depth, health = self.health, framed = self.framed, metrics = self.metrics)
+
+    async def _open_client(self, report_failure = True) -> SocketClient:
+        """
+        Opens one more connection. The caller must have checked max_connections.
+        Input: report_failure - whether a failed connect counts against the remote's health
+        """
+        client = self._new_client()
+        self._leases[client] = 1
+        try:
+            await client.connect()
+        except BaseException as e:
+            self._leases.pop(client, None)
+            if report_failure and isinstance(e, Exception):
+                self.health.record_failure()
+            async with self._available:
+                self._available.notify()
+            raise
+        return client
+
+    def _is_usable(self, client: SocketClient) -> bool:
+        return client.connected and not client.reader.at_eof()
+
+    async def acquire(self, pinned: SocketClient = None) -> SocketClient:
+        """
+        Returns the least used open connection that can take another request, opening a new one if none can
+        and max_connections has not been reached, otherwise waits for one to be released.
+        Input: pinned - the connection to wait for instead, while it is open
+        """
+        async with self._available:
+            while True:
+                for client in [client for client, leases in self._leases.items() if leases == 0 and not self._is_usable(client)]:
+                    self._logger.info('Dropping connection closed by remote')
+                    del self._leases[client]
+                    await client.disconnect()
+
+                if pinned is not None and pinned in self._leases and self._is_usable(pinned):
+                    if self._leases[pinned] < self.pipeline_depth:
+                        self._leases[pinned] += 1
+                        return pinned
+                    await self._available.wait()
+                    continue
+
+                #connections still being opened count too, their leases wait for the connect to finish
+                candidates = [client for client, leases in self._leases.items() if leases < self.pipeline_depth]
+                if candidates:
+                    client = min(candidates, key = self._leases.get)
+                    self._leases[client] += 1
+                    return client
+
+                if len(self._leases) < self.max_connections:
+                    break
+                await self._available.wait()
+
+        return await self._open_client()
+
+    async def release(self, client: SocketClient):
+        """
+        Returns a leased connection to the pool. Connections that got closed are dropped.
+        """
+        if client not in self._leases:
+            return #pool closed or connection dropped in the meantime
+
+        self._leases[client] -= 1
+        if client.connected is False:
+            del self._leases[client]
+            await client.disconnect()
+
+        async with self._available:
+            self._available.notify()
+
+    @contextlib.asynccontextmanager
+    async def lease(self):
+        client = await self.acquire()
+        try:
+            yield client
+        finally:
+            await self.release(client)
+
+    async def keep_warm(self):
+        """
+        Tops the pool up to min_connections every keep_warm_interval seconds while the remote is healthy.
+        Failures are only logged, requests and probes decide whether the remote is reachable.
+        """
+        while True:
+            try:
+                while self.health.state == HealthState.HEALTHY and len(self._leases) < min(self.min_connections, self.max_connections):
+                    client = await self._open_client(report_failure = False)
+                    await self.release(client)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._logger.info('Could not warm up connection to {}:{}'.format(str(self.host), str(self.port)))
+            await asyncio.sleep(self.keep_warm_interval)
+
+    def current_response_timeout(self) -> float:
+        """
+        Returns how long the next request waits for its response, response_timeout unless adaptive.
+        """
+        if not self.adaptive_timeout:
+            return self.response_timeout
+        observed = self.latencies.percentile(self.adaptive_timeout_percentile)
+        timeout = self.response_timeout
+        if observed is not None:
+            timeout = min(max(observed * self.adaptive_timeout_multiplier, self.response_timeout_floor), self.response_timeout)
+        if self.metrics is not None:
+            self.metrics.response_timeout.set(timeout)
+        return timeout
+
+    async def send_and_wait_response_with_timeout(self, message, trace = None, lane = None):
+        """
+        Sends a request on a leased connection and waits for its response. The remote's health is asked before leasing,
+        so while it is half open only the one request testing it opens a connection, and opening one counts against
+        the response timeout.
+        Input: lane - the sender, whose requests are kept in order (see the class description); the caller must send them one after the other
+        """
+        if not self.health.begin_attempt():
+            if self.metrics is not None:
+                self.metrics.rejections.inc()
+            raise TimeoutNotExpiredError
+
+        timeout = self.current_response_timeout()
+        started = time.perf_counter()
+        self.outstanding += 1
+        try:
+            try:
+                client = await asyncio.wait_for(self.acquire(self._pinned.get(lane) if lane is not None else None), timeout)
+            except asyncio.TimeoutError:
+                if self.metrics is not None:
+                    self.metrics.timeouts.inc()
+                self.health.record_failure()
+                raise
+            except BaseException:
+                self.health.abort_attempt() #a failed connect was recorded already
+                raise
+            try:
+                sent = time.perf_counter()
+                result = await client.send_and_wait_response_with_timeout(message, trace, max(timeout - (sent - started), 0), attempt_begun = True)
+                if lane is not None:
+                    if result[1] == MessageHandlingType.MULTICAST_NO_RESPONSE:
+                        self._pinned[lane] = client
+                    elif self._pinned.get(lane) is client:
+                        del self._pinned[lane]
+            finally:
+                await self.release(client)
+        except asyncio.TimeoutError:
+            if self.adaptive_timeout:
+                self.latencies.record(timeout)
+            raise
+        finally:
+            self.outstanding -= 1
+        if result[0] is not None:
+            self.latencies.record(time.perf_counter() - sent)
+        return result
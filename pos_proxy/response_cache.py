@@ -0,0 +1,31 @@
+import time
+
+
+class ResponseCache(object):
+    """
+    The latest response of every upstream to each kind of request whose responses can be reused (see
+    PosHandler.response_cache_key), kept for ttl seconds after it arrived. Shared by all Dispatchers of a listener,
+    so one lane's status request refreshes the answer every other lane gets until it expires.
+    """
+    def __init__(self, ttl: float, clock = time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._responses = {} #(upstream, key) -> (expires at, response)
+
+    def get(self, upstream: str, key: str) -> bytes:
+        """
+        Returns the response of upstream cached under key, None if there is none or it has expired.
+        """
+        entry = self._responses.get((upstream, key))
+        if entry is None:
+            return None
+        if entry[0] <= self.clock():
+            del self._responses[(upstream, key)]
+            return None
+        return entry[1]
+
+    def put(self, upstream: str, key: str, response):
+        self._responses[(upstream, key)] = (self.clock() + self.ttl, bytes(response))
+
+    def clear(self):
+        self._responses.clear()
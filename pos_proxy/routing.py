@@ -0,0 +1,90 @@
+import fnmatch
+import os
+import re
+from .balancing import FirstBalancer, create_balancer
+
+_GLOB_CHARACTERS = ('*', '?', '[')
+_CLIENTS = None #trie node key holding the clients whose mask ends at that node
+
+
+class RoutingTable(object):
+    """
+    Maps card numbers to the clients whose CardMasks match them, compiled once and shared by all dispatchers.
+    Plain prefix masks are stored in a trie, so a lookup costs O(card length) regardless of the number of masks,
+    and the longest matching prefix wins. Masks with glob characters (*, ?, [) are a slower tier, tried in client order
+    only when no prefix matches.
+    Clients with the same redundancy_group serve the same cards for each other (see redundant), and requests are
+    spread over them by the balancer named by the group's first client (see balancing.py).
+    """
+    def __init__(self, clients):
+        self._root = {}
+        self._globs = []
+        self._groups = {}
+        self._balancers = {}
+        self._first = FirstBalancer()
+        for client in clients:
+            group = getattr(client, 'redundancy_group', None)
+            if group is not None:
+                if group not in self._groups:
+                    self._balancers[group] = create_balancer(getattr(client, 'balancer', 'first'))
+                self._groups.setdefault(group, []).append(client)
+            masks = [client.masks] if isinstance(client.masks, str) else client.masks
+            for mask in masks:
+                if any(character in mask for character in _GLOB_CHARACTERS):
+                    self._globs.append((re.compile(fnmatch.translate(mask + '*')), client))
+                else:
+                    self._insert(mask, client)
+
+    def _insert(self, prefix: str, client):
+        node = self._root
+        for character in prefix:
+            node = node.setdefault(character, {})
+        clients = node.setdefault(_CLIENTS, [])
+        if client not in clients:
+            clients.append(client)
+
+    def redundant(self, client) -> list:
+        """
+        Returns the other clients of client's redundancy group, in configuration order.
+        """
+        group = getattr(client, 'redundancy_group', None)
+        if group is None:
+            return []
+        return [other for other in self._groups.get(group, []) if other is not client]
+
+    def balancer(self, client):
+        """
+        Returns the balancer of client's redundancy group (a FirstBalancer for clients without a group).
+        """
+        return self._balancers.get(getattr(client, 'redundancy_group', None), self._first)
+
+    def match(self, routing_id: str) -> list:
+        """
+        Returns the clients matching a card number, best match first: clients of the longest matching prefix
+        (in configuration order), then those of shorter prefixes, then glob matches if no prefix matched,
+        then clients with an empty mask, which matches every card.
+        """
+        if routing_id is None:
+            return []
+
+        matched = []
+        node = self._root
+        for character in routing_id:
+            node = node.get(character)
+            if node is None:
+                break
+            if _CLIENTS in node:
+                matched.extend(reversed(node[_CLIENTS]))
+        matched.reverse()
+
+        if not matched:
+            normalized = os.path.normcase(routing_id) #same case handling as fnmatch.fnmatch
+            matched = [client for pattern, client in self._globs if pattern.match(normalized)]
+
+        matched.extend(self._root.get(_CLIENTS, []))
+
+        result = []
+        for client in matched:
+            if client not in result:
+                result.append(client)
+        return result
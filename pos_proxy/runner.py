@@ -1,12 +1,14 @@
 from .logging_setup import setup_logging
 from .dispatcher import DispatcherServer
 from .sessions import SessionHandler
+from .metrics import MetricsServer, registry as metrics_registry
 import logging
 import configparser
 import os
 
 servers = []
 session_handler = None
+metrics_server = None
 logger = logging.getLogger( __name__ )
 
 def get_all_init_files(working_folder):
@@ -20,7 +22,57 @@ def get_all_init_files(working_folder):
         yield os.path.join(working_folder, filename)
 
 
-async def run(working_folder):    
+def read_listen_ports(working_folder) -> list:
+    """
+    Returns the ports the .proxy files in the folder listen on.
+    """
+    ports = []
+    for filename in get_all_init_files(working_folder):
+        try:
+            config = configparser.ConfigParser()
+            config.read(filename)
+            ports.append(config['HOST'].getint('Port'))
+        except Exception as e:
+            logger.error(e)
+    return ports
+
+
+#[HOST] keys of the SessionHandler shared by all listeners -> its parameter and how to read the value
+SESSION_SETTINGS = {
+    'SessionFlushInterval': ('flush_interval', 'getfloat'),
+    'SessionCacheSize': ('cache_size', 'getint'),
+    'SessionCacheTtl': ('cache_ttl', 'getfloat'),
+}
+
+
+def read_session_settings(init_files) -> dict:
+    """
+    Returns the SessionHandler parameters set in the [HOST] sections of the .proxy files, the first file setting a key wins
+    (there is one session handler for all listeners). Parameters no file sets keep their defaults.
+    """
+    settings = {}
+    for filename in init_files:
+        try:
+            config = configparser.ConfigParser()
+            config.read(filename)
+            for key, (parameter, getter) in SESSION_SETTINGS.items():
+                if parameter not in settings and config['HOST'].get(key) is not None:
+                    settings[parameter] = getattr(config['HOST'], getter)(key)
+        except Exception as e:
+            logger.error(e)
+    return settings
+
+
+async def run(working_folder, reuse_port = False, listen_sockets = None, metrics_port = None, metrics_port_offset = 0):
+    """
+    Starts a DispatcherServer per .proxy file in the folder.
+    Input:
+        reuse_port - listen with SO_REUSEPORT, for worker processes sharing the ports
+        listen_sockets - port -> already bound socket to listen on, for worker processes sharing the ports without SO_REUSEPORT
+        metrics_port - serve the metrics of all listeners on this port (see MetricsServer)
+        metrics_port_offset - added to every metrics port, so worker processes serve theirs on ports of their own
+    """
+    global session_handler, metrics_server
     logger = logging.getLogger( __name__ )
     logger.info("Starting up")    
 
@@ -33,15 +85,18 @@ async def run(working_folder):
         logger.error("No .proxy files")
         raise ValueError("No .proxy files. Cannot start")
 
-    session_handler = SessionHandler(working_folder).open()
+    session_handler = SessionHandler(working_folder, **read_session_settings(init_files)).open()
+
+    if metrics_port:
+        metrics_server = await MetricsServer(metrics_registry, metrics_port + metrics_port_offset).start()
     
     for filename in init_files:
         try:
             print(filename)
             config = configparser.ConfigParser()
             config.read(filename) 
-            server = DispatcherServer(config, session_handler)         
-            await server.listen()
+            server = DispatcherServer(config, session_handler, reuse_port = reuse_port, metrics_port_offset = metrics_port_offset)
+            await server.listen(sock = (listen_sockets or {}).get(config['HOST'].getint('Port')))
             servers.append(server)
         except Exception as e:
             logger.error(e)       
@@ -52,5 +107,8 @@ async def stop():
     for server in servers:
         await server.close()
 
+    if metrics_server is not None:
+        await metrics_server.close()
+
     if session_handler is not None:
         session_handler.close()
\ No newline at end of file
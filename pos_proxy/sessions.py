@@ -1,41 +1,175 @@
 import sqlite3
 import os
 import asyncio
+import collections
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class SessionHandler():
-    def __init__(self, folder_path):
-        self.__db_file_name = os.path.join(folder_path, 'sessions', 'sessions.db')             
+    """
+    Remembers which user (card) a loyalty session belongs to, so session based messages can be routed like card based ones.
+    Lookups are served from a bounded in-memory LRU map with a TTL in front of the SQLite store. Writes go to the map at once
+    and are written to the store in batches every flush_interval seconds.
+    All SQLite work runs on one dedicated worker thread that owns the connection, so the event loop never waits for the disk.
+    Worker processes (see WorkerSupervisor) share the store file, WAL mode lets them read while another one writes. Each keeps
+    its own cache, so a session written by another worker is found in the store once that worker has flushed it.
+    The remote that served a session can be remembered with its user, in memory only, to keep the session on it (see get_upstream).
+    """
+    def __init__(self, folder_path, cache_size = 10000, cache_ttl = 2 * 24 * 60 * 60, flush_interval = 1, expiry_chunk_size = 500):
+        self.__db_file_name = os.path.join(folder_path, 'sessions', 'sessions.db')
         self.__conn = None
         self.__cleanup_task = None
+        self.__flush_task = None
+        self.__cache = collections.OrderedDict() #session -> (user, expiry time), least recently used first
+        self.__cache_size = cache_size
+        self.__cache_ttl = cache_ttl
+        self.__flush_interval = flush_interval
+        self.__expiry_chunk_size = expiry_chunk_size
+        self.__pending_writes = {}
+        self.__upstreams = collections.OrderedDict() #session -> remote (host:port) that served it, least recently written first
+        self.__worker = None
+        self._logger = logging.getLogger(self.__class__.__name__)
 
     def open(self):
-        os.makedirs(os.path.dirname(self.__db_file_name), exist_ok=True)
-        self.__conn = sqlite3.connect(self.__db_file_name)
-        self.__conn.execute("CREATE TABLE IF NOT EXISTS SessionUsers(session_id TEXT PRIMARY KEY, user_id TEXT, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);")
-        self.__conn.commit()
+        self.__worker = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'SessionStore')
+        self.__worker.submit(self.__open_db).result() #startup only, before any traffic
         self.__cleanup_task = asyncio.create_task(self.eod())
+        self.__flush_task = asyncio.create_task(self.flush_periodically())
         return self
 
     def close(self):
         self.__cleanup_task.cancel()
-        self.__conn.close() 
+        self.__flush_task.cancel()
+        self.__worker.submit(self.__write_batch, self.__take_pending_writes()).result()
+        self.__worker.submit(self.__close_db).result()
+        self.__worker.shutdown()
 
-    def __enter__(self):        
-        return self.open()        
+    def __enter__(self):
+        return self.open()
 
-    def __exit__(self, *exc):         
+    def __exit__(self, *exc):
         self.close()
 
-    def write_user(self, session, user):
-        self.__conn.execute("REPLACE INTO SessionUsers(session_id, user_id, Timestamp) VALUES(?, ?, CURRENT_TIMESTAMP);", (session, user,))
+    def __cache_user(self, session, user):
+        self.__cache[session] = (user, time.monotonic() + self.__cache_ttl)
+        self.__cache.move_to_end(session)
+        while len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last = False)
+
+    def write_user(self, session, user, upstream = None):
+        """
+        Fire and forget: the user is cached at once and written to the store with the next batch.
+        Input: upstream - the remote (host:port) that served the session, if it should stick to it
+        """
+        self.__cache_user(session, user)
+        self.__pending_writes[session] = user
+        if upstream is not None:
+            self.__upstreams[session] = upstream
+            self.__upstreams.move_to_end(session)
+            while len(self.__upstreams) > self.__cache_size:
+                self.__upstreams.popitem(last = False)
+
+    def get_upstream(self, session):
+        """
+        Returns the remote (host:port) last written for a session by this process, None if unknown.
+        Sessions stay on one POS connection, which stays with one worker process, so this needs no sharing.
+        """
+        return self.__upstreams.get(session)
+
+    def get_cached_user(self, session):
+        """
+        Returns the user for a session if it is in the cache (None otherwise), without touching the store.
+        """
+        cached = self.__cache.get(session)
+        if cached is None:
+            return None
+        user, expires = cached
+        if time.monotonic() >= expires:
+            del self.__cache[session]
+            return None
+        self.__cache.move_to_end(session)
+        return user
+
+    async def get_user_for_session(self, session):
+        user = self.get_cached_user(session)
+        if user is not None:
+            return user
+
+        user = self.__pending_writes.get(session)
+        if user is None:
+            user = await asyncio.get_running_loop().run_in_executor(self.__worker, self.__select_user, session)
+        if user is not None:
+            self.__cache_user(session, user)
+        return user
+
+    def __take_pending_writes(self):
+        batch = self.__pending_writes
+        self.__pending_writes = {}
+        return batch
+
+    #The methods below run on the worker thread only, which owns the connection
+
+    def __open_db(self):
+        os.makedirs(os.path.dirname(self.__db_file_name), exist_ok=True)
+        self.__conn = sqlite3.connect(self.__db_file_name)
+        self.__conn.execute("PRAGMA journal_mode=WAL;")
+        self.__conn.execute("PRAGMA synchronous=NORMAL;")
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS SessionUsers(session_id TEXT PRIMARY KEY, user_id TEXT, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP);")
+        self.__conn.commit()
+
+    def __close_db(self):
+        self.__conn.close()
+        self.__conn = None
+
+    def __select_user(self, session):
+        row = self.__conn.execute("SELECT user_id FROM SessionUsers WHERE session_id = ?;", (session,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __write_batch(self, batch):
+        if not batch:
+            return
+        self.__conn.executemany("REPLACE INTO SessionUsers(session_id, user_id, Timestamp) VALUES(?, ?, CURRENT_TIMESTAMP);", batch.items())
+        self.__conn.commit()
+
+    def __delete_expired_chunk(self) -> int:
+        cursor = self.__conn.execute("DELETE FROM SessionUsers WHERE rowid IN (SELECT rowid FROM SessionUsers WHERE Timestamp < DATE('now', '-2 days') LIMIT ?);", (self.__expiry_chunk_size,))
         self.__conn.commit()
+        return cursor.rowcount
+
+    async def flush(self):
+        """
+        Writes all pending session writes to the store. Writes that fail are kept for the next flush.
+        """
+        batch = self.__take_pending_writes()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.__worker, self.__write_batch, batch)
+        except Exception:
+            for session, user in batch.items():
+                self.__pending_writes.setdefault(session, user) #newer writes of the same session win
+            raise
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.__flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                self._logger.exception('Could not write sessions, will retry.')
 
-    def get_user_for_session(self, session):
-        self.__conn.execute("SELECT user_id FROM SessionUsers WHERE session_id = ?;", (session,))
-        return self.__conn.fetchone()
+    async def delete_expired(self):
+        """
+        Deletes sessions older than 2 days, expiry_chunk_size rows per transaction, so lookups and writes
+        queued on the worker get their turn between chunks instead of waiting for one long DELETE.
+        """
+        loop = asyncio.get_running_loop()
+        while await loop.run_in_executor(self.__worker, self.__delete_expired_chunk) >= self.__expiry_chunk_size:
+            pass
 
     async def eod(self):
         while True:
-            self.__conn.execute("DELETE FROM SessionUsers WHERE Timestamp < DATE('now', '-2 days');")
-            self.__conn.commit()
-            await asyncio.sleep(60 * 60 * 24) #repeat every day
\ No newline at end of file
+            try:
+                await self.delete_expired()
+            except Exception:
+                self._logger.exception('Could not delete expired sessions.')
+            await asyncio.sleep(60 * 60 * 24) #repeat every day
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import socket
+import threading
+import time
+from . import runner
+from .logging_setup import setup_logging
+
+logger = logging.getLogger( __name__ )
+
+
+def worker_main(working_folder, index, listen_sockets = None, metrics_port = None, log_settings = None):
+    """
+    Entry point of a worker process: runs all .proxy files of the folder until terminated.
+    Metrics ports (the global one and the listeners' MetricsPort) are offset by the worker's index.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #the supervisor decides when workers stop
+    setup_logging(working_folder, file_name = 'PosProxy.worker-{}.log'.format(index), **(log_settings or {}))
+    asyncio.run(run_worker(working_folder, listen_sockets, metrics_port, index))
+
+
+async def run_worker(working_folder, listen_sockets = None, metrics_port = None, index = 0):
+    stopped = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    except NotImplementedError:
+        pass #Windows, terminate() ends the process right away
+
+    await runner.run(working_folder, reuse_port = listen_sockets is None, listen_sockets = listen_sockets, metrics_port = metrics_port, metrics_port_offset = index)
+    try:
+        await stopped.wait()
+    finally:
+        await runner.stop()
+
+
+class WorkerSupervisor(object):
+    """
+    Runs the .proxy files of a folder in several worker processes, so the proxy can use more than one core.
+    Every worker listens on all ports: with SO_REUSEPORT where the OS has it (the OS spreads new POS connections over
+    the workers), otherwise on sockets bound once here and shared with the workers. A POS connection stays with the
+    worker that accepted it. Workers share the session store (see SessionHandler).
+    Workers that exit are restarted after restart_delay, doubling up to max_restart_delay while they keep exiting
+    within min_uptime of being started.
+    Worker i serves its metrics on metrics_port + i (and on MetricsPort + i of every listener that has one).
+    log_settings are passed on to the workers' setup_logging (e.g. queue_size, overflow).
+    """
+    def __init__(self, working_folder, workers, restart_delay = 1, max_restart_delay = 60, min_uptime = 10, poll_interval = 0.5, reuse_port = None, metrics_port = None,
+                 log_settings = None):
+        self.working_folder = working_folder
+        self.workers = max(workers, 1)
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT') if reuse_port is None else reuse_port
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.poll_interval = poll_interval
+        self.metrics_port = metrics_port
+        self.log_settings = log_settings
+        self.processes = [None] * self.workers
+        self.restarts = 0
+        self.listen_sockets = None
+        self._started_at = [0.0] * self.workers
+        self._delays = [restart_delay] * self.workers
+        self._restart_at = [0.0] * self.workers
+        self._context = multiprocessing.get_context('spawn') #same on every platform, and no inherited event loop
+        self._stopping = threading.Event()
+
+    def bind_listen_sockets(self) -> dict:
+        """
+        Binds every configured port once, for platforms without SO_REUSEPORT.
+        """
+        return {port: socket.create_server(('127.0.0.1', port)) for port in runner.read_listen_ports(self.working_folder)}
+
+    def start_worker(self, index):
+        process = self._context.Process(target = worker_main, args = (self.working_folder, index, self.listen_sockets, self.metrics_port, self.log_settings),
+                                        name = 'PosProxyWorker-{}'.format(index)) #not daemonic, workers may run a ClassifyPoolType = process pool
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info('Started worker {} (pid {})'.format(index, process.pid))
+
+    def check_workers(self):
+        """
+        Restarts workers that have exited, once their restart delay has passed.
+        """
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if self._restart_at[index] == 0.0:
+                if now - self._started_at[index] < self.min_uptime:
+                    self._delays[index] = min(self._delays[index] * 2, self.max_restart_delay)
+                else:
+                    self._delays[index] = self.restart_delay
+                self._restart_at[index] = now + self._delays[index]
+                logger.error('Worker {} (pid {}) exited with code {}, restarting in {:.1f}s'.format(index, process.pid, process.exitcode, self._delays[index]))
+            if now >= self._restart_at[index]:
+                self._restart_at[index] = 0.0
+                self.restarts += 1
+                self.start_worker(index)
+
+    def run(self):
+        """
+        Starts the workers and keeps them running until stop() is called.
+        """
+        if not self.reuse_port:
+            self.listen_sockets = self.bind_listen_sockets()
+        for index in range(self.workers):
+            self.start_worker(index)
+
+        try:
+            while not self._stopping.wait(self.poll_interval):
+                self.check_workers()
+        finally:
+            self.stop_workers()
+
+    def stop(self):
+        self._stopping.set()
+
+    def stop_workers(self, timeout = 10):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    process.kill()
+        for sock in (self.listen_sockets or {}).values():
+            sock.close()
+        logger.info('All workers stopped')
@@ -0,0 +1,95 @@
+import collections
+import json
+import os
+
+
+class MessageTrace(object):
+    """
+    The stage timestamps (time.perf_counter_ns) of one request sent to one upstream, from reading it off the POS
+    connection to writing the response back. A multicast request gets one trace per upstream it is sent to.
+    Stages not reached stay None:
+        header_read - the request's header has been read (with Framing the whole request has arrived by then)
+        classified - the request has been verified and classified
+        routed - the upstreams to send it to have been chosen
+        upstream_write - the request has been written to the upstream connection
+        first_response - the response's header has been read from the upstream connection
+        responded - the response has been written to the POS
+    """
+    __slots__ = ('pos_sequence_id', 'upstream', 'outcome',
+                 'header_read', 'classified', 'routed', 'upstream_write', 'first_response', 'responded')
+
+    STAGES = ('header_read', 'classified', 'routed', 'upstream_write', 'first_response', 'responded')
+
+    def __init__(self, pos_sequence_id: str, upstream: str, header_read: int = None, classified: int = None, routed: int = None):
+        self.pos_sequence_id = pos_sequence_id
+        self.upstream = upstream
+        self.outcome = None #responded, late (another upstream answered first), no_response (nothing to answer), failed, or queued/dropped (by a fan-out queue)
+        self.header_read = header_read
+        self.classified = classified
+        self.routed = routed
+        self.upstream_write = None
+        self.first_response = None
+        self.responded = None
+
+    @classmethod
+    def for_request(cls, request, upstream: str, routed: int = None):
+        """
+        Starts the trace of a request (as parsed by the handler, which stamps received_ns and classified_ns) sent to upstream.
+        """
+        return cls(request.pos_sequence_id, upstream, request.received_ns, request.classified_ns, routed)
+
+    @property
+    def upstream_rtt_ns(self) -> int:
+        """
+        Time the upstream took to answer, from writing the request to reading the response's header. None if not answered.
+        """
+        if self.upstream_write is None or self.first_response is None:
+            return None
+        return self.first_response - self.upstream_write
+
+    def to_dict(self) -> dict:
+        """
+        Returns the trace with every stage reached as microseconds since the header was read.
+        """
+        start = self.header_read
+        stages = {}
+        if start is not None:
+            for stage in self.STAGES:
+                stamp = getattr(self, stage)
+                if stamp is not None:
+                    stages[stage] = (stamp - start) / 1000
+        rtt = self.upstream_rtt_ns
+        return {'pos_sequence_id': self.pos_sequence_id, 'upstream': self.upstream, 'outcome': self.outcome,
+                'start_ns': start, 'stages_us': stages, 'upstream_rtt_us': rtt / 1000 if rtt is not None else None}
+
+
+class Tracer(object):
+    """
+    Keeps the last capacity finished MessageTraces in memory and, when file_name is given, appends each one to that file
+    as a line of JSON. A {pid} in file_name is replaced with the process ID, so worker processes write files of their own.
+    """
+    def __init__(self, capacity = 1024, file_name = None):
+        self.traces = collections.deque(maxlen = max(capacity, 1))
+        self.file_name = file_name.format(pid = os.getpid()) if file_name else None
+        self._file = None
+        if self.file_name:
+            if os.path.dirname(self.file_name):
+                os.makedirs(os.path.dirname(self.file_name), exist_ok = True)
+            self._file = open(self.file_name, 'a', encoding = 'utf-8')
+
+    def record(self, trace: MessageTrace):
+        self.traces.append(trace)
+        if self._file is not None:
+            self._file.write(json.dumps(trace.to_dict()) + '\n') #buffered, reaches the disk in blocks and on close
+
+    def recent(self, count = None) -> list:
+        """
+        Returns the last count traces (all kept when None), oldest first.
+        """
+        traces = list(self.traces)
+        return traces if count is None else traces[-count:]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -3,6 +3,10 @@ import signal
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
 import pos_proxy.runner as runner
+from pos_proxy.logging_setup import setup_logging
+from pos_proxy.supervisor import WorkerSupervisor
+import argparse
+import multiprocessing
 import os.path
 import asyncio
 import os
@@ -10,11 +14,28 @@ import os
 
 
 def main():
-        loop = asyncio.get_event_loop()          
+        parser = argparse.ArgumentParser(description = 'Midax POS Proxy')
+        parser.add_argument('--workers', type = int, default = 1, help = 'worker processes sharing the listening ports, 1 runs everything in this process')
+        parser.add_argument('--metrics-port', type = int, default = None, help = 'serve the metrics of all listeners over HTTP on this port of 127.0.0.1 (worker i on this port + i)')
+        parser.add_argument('--log-queue-size', type = int, default = 10000, help = 'log records waiting to be written (per process) before the overflow policy applies')
+        parser.add_argument('--log-overflow', choices = ['drop', 'block'], default = 'drop', help = 'when the log queue is full, drop records (counted) or make the logging code wait')
+        args = parser.parse_args()
+        setup_logging(os.getcwd(), queue_size = args.log_queue_size, overflow = args.log_overflow) #the supervisor's own records, or everything in a single process
+
+        if args.workers > 1:
+                supervisor = WorkerSupervisor(os.getcwd(), args.workers, metrics_port = args.metrics_port,
+                                              log_settings = {'queue_size': args.log_queue_size, 'overflow': args.log_overflow})
+                signal.signal(signal.SIGINT, lambda *_: supervisor.stop())
+                signal.signal(signal.SIGTERM, lambda *_: supervisor.stop())
+                supervisor.run()
+                return
+
+        loop = asyncio.get_event_loop()
         #loop.run_until_complete(runner.run(os.getcwd()))
-        asyncio.ensure_future(runner.run(os.getcwd()))        
+        asyncio.ensure_future(runner.run(os.getcwd(), metrics_port = args.metrics_port))
         loop.run_forever()
 
 
 if __name__ == "__main__":
-        main()
\ No newline at end of file
+        multiprocessing.freeze_support() #workers of a frozen bundle
+        main()
@@ -0,0 +1,79 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.sessions import SessionHandler
+from pos_proxy.latency import LatencyTracker
+from pos_proxy.balancing import create_balancer
+
+class Client:
+    def __init__(self, name, weight = 1, outstanding = 0):
+        self.name = name
+        self.weight = weight
+        self.outstanding = outstanding
+        self.latencies = LatencyTracker()
+
+def first_names(balancer, clients, count):
+    return [balancer.order(clients)[0].name for _ in range(count)]
+
+def test_round_robin():
+    clients = [Client('a'), Client('b'), Client('c')]
+    assert first_names(create_balancer('round_robin'), clients, 4) == ['a', 'b', 'c', 'a']
+    assert [client.name for client in create_balancer('first').order(clients)] == ['a', 'b', 'c']
+
+def test_weighted_interleaves_by_weight():
+    clients = [Client('a', weight = 3), Client('b', weight = 1)]
+    assert first_names(create_balancer('weighted'), clients, 8) == ['a', 'a', 'b', 'a'] * 2
+
+def test_least_outstanding_and_latency_ewma():
+    busy, idle = Client('busy', outstanding = 3), Client('idle', outstanding = 1)
+    assert [client.name for client in create_balancer('least_outstanding').order([busy, idle])] == ['idle', 'busy']
+    slow, fast, new = Client('slow'), Client('fast'), Client('new')
+    slow.latencies.record(0.2)
+    fast.latencies.record(0.3)
+    for _ in range(10):
+        fast.latencies.record(0.01)
+    assert [client.name for client in create_balancer('LATENCY_EWMA').order([slow, fast, new])] == ['new', 'fast', 'slow']
+
+def test_unknown_balancer():
+    with pytest.raises(ValueError):
+        create_balancer('random')
+
+@pytest.fixture()
+def balanced_passport_config(server_multi_passport_config):
+    server_multi_passport_config['HOST']['Passthrough'] = 'no'
+    for section in ['TEST_CLIENT', 'TEST_CLIENT_2']:
+        server_multi_passport_config[section]['CardMasks'] = '4250605'
+        server_multi_passport_config[section]['RedundancyGroup'] = 'site'
+    server_multi_passport_config['TEST_CLIENT']['Balancer'] = 'round_robin'
+    return server_multi_passport_config
+
+async def send_and_check(reader, writer, request, mock_1, mock_2) -> list:
+    mock_1.message_received = mock_2.message_received = False
+    writer.write(request)
+    response = await asyncio.wait_for(PassportHandler().read_message(reader), 2)
+    assert response.message == request
+    return [mock_1.message_received, mock_2.message_received]
+
+@pytest.mark.asyncio
+async def test_group_round_robin(balanced_passport_config, mock_tcp_server, mock_tcp_server_2):
+    async with DispatcherServer(balanced_passport_config, session_handler = None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        assert await send_and_check(reader, writer, conftest.GET_REWARDS_REQUEST, mock_tcp_server, mock_tcp_server_2) == [True, False]
+        assert await send_and_check(reader, writer, conftest.GET_REWARDS_REQUEST, mock_tcp_server, mock_tcp_server_2) == [False, True]
+        writer.close()
+
+@pytest.mark.asyncio
+async def test_session_sticks_to_upstream(balanced_passport_config, mock_tcp_server, mock_tcp_server_2, tmp_path):
+    with SessionHandler(str(tmp_path)) as session_handler:
+        async with DispatcherServer(balanced_passport_config, session_handler = session_handler):
+            reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+            assert await send_and_check(reader, writer, conftest.FINALIZE_REWARDS_REQUEST, mock_tcp_server, mock_tcp_server_2) == [True, False]
+            assert session_handler.get_upstream(conftest.SESSION_IN_FRR) == '127.0.0.1:{}'.format(conftest.PORT_NMB_MOCK)
+            assert await send_and_check(reader, writer, conftest.FINALIZE_REWARDS_REQUEST, mock_tcp_server, mock_tcp_server_2) == [True, False]
+            unsticky = [await send_and_check(reader, writer, conftest.GET_REWARDS_REQUEST, mock_tcp_server, mock_tcp_server_2) for _ in range(2)] #no session
+            assert sorted(unsticky) == [[False, True], [True, False]]
+            writer.close()
@@ -0,0 +1,103 @@
+import pytest
+import asyncio
+import glob
+import uuid
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/../benchmarks"))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.capture import CaptureWriter, REQUEST, RESPONSE, read_capture
+from replay import load_lanes, replay
+
+@pytest.fixture(params = ['no', 'yes'])
+async def capturing_dispatcher_server(request, server_good_passport_config, mock_tcp_server, tmp_path):
+    server_good_passport_config['HOST']['Passthrough'] = request.param
+    server_good_passport_config['HOST']['Capture'] = 'yes'
+    server_good_passport_config['HOST']['CaptureFile'] = os.path.join(str(tmp_path), '{port}-{pid}.cap')
+    async with DispatcherServer(server_good_passport_config, session_handler = None) as server:
+        yield server
+
+@pytest.mark.asyncio
+async def test_capture_rotates_and_reads_back(tmp_path):
+    file_name = os.path.join(str(tmp_path), 'rotated.cap')
+    writer = CaptureWriter(file_name, max_bytes = 1024, backup_count = 2, flush_interval = 0.01).open()
+    lane = uuid.uuid4()
+    for _ in range(20):
+        writer.record(REQUEST, lane, '', conftest.GOOD_PASSPORT_ONL_STATUS)
+        writer.record(RESPONSE, lane, 'remote:1', conftest.GOOD_PASSPORT_ONL_STATUS)
+        await asyncio.sleep(0)
+    writer.close()
+
+    files = [file_name + '.2', file_name + '.1', file_name]
+    assert sorted(glob.glob(file_name + '*')) == sorted(files)
+    records = [record for name in files for record in read_capture(name)]
+    assert 0 < len(records) < 40 #the oldest rotated out
+    assert all(os.path.getsize(name) <= 1024 for name in files)
+    assert all(record.lane == lane and record.message == conftest.GOOD_PASSPORT_ONL_STATUS for record in records)
+    assert [record.upstream for record in records[-2:]] == ['', 'remote:1']
+    timestamps = [record.timestamp_ns for record in records]
+    assert timestamps == sorted(timestamps)
+
+def test_capture_rejects_other_files(tmp_path):
+    file_name = os.path.join(str(tmp_path), 'other.cap')
+    with open(file_name, 'wb') as other:
+        other.write(b'not a capture')
+    with pytest.raises(ValueError):
+        list(read_capture(file_name))
+
+@pytest.mark.asyncio
+async def test_capture_writer_drops_over_limit(tmp_path):
+    writer = CaptureWriter(os.path.join(str(tmp_path), 'full.cap'), flush_interval = 60, max_pending = 1)
+    writer.open()
+    writer.record(REQUEST, uuid.uuid4(), '', b'1')
+    writer.record(REQUEST, uuid.uuid4(), '', b'2')
+    writer.close()
+    assert writer.dropped == 1
+    assert [record.message for record in read_capture(writer.file_name)] == [b'1']
+
+@pytest.mark.asyncio
+async def test_capture_write_errors_reported(tmp_path):
+    writer = CaptureWriter(os.path.join(str(tmp_path), 'failing.cap'), flush_interval = 60, buffer_size = 1)
+    writer.open()
+    writes = []
+    def fail_write(batch):
+        writes.append(batch)
+        raise OSError('No space left on device')
+    writer._CaptureWriter__write_batch = fail_write
+    for message in [b'1', b'2', b'3']:
+        writer.record(REQUEST, uuid.uuid4(), '', message)
+    for _ in range(100):
+        if writer.write_errors:
+            break
+        await asyncio.sleep(0.01)
+    assert writer.write_errors == 1
+    assert len(writes) == 1 #no second write while the first was running
+    del writer._CaptureWriter__write_batch
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_server_captures_and_replays(capturing_dispatcher_server):
+    handler = PassportHandler()
+    reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+    for request in [conftest.GET_REWARDS_REQUEST, conftest.GOOD_PASSPORT_ONL_STATUS]:
+        writer.write(request)
+        await asyncio.wait_for(handler.wait_and_handle_response_message(reader, request), 2)
+    writer.close()
+    await asyncio.sleep(0.05)
+
+    file_name = capturing_dispatcher_server.capture.file_name
+    await capturing_dispatcher_server.close()
+    records = list(read_capture(file_name))
+    assert [record.direction for record in records] == [REQUEST, RESPONSE, REQUEST, RESPONSE]
+    assert len(set(record.lane for record in records)) == 1
+    assert records[0].message == conftest.GET_REWARDS_REQUEST
+    assert records[1].upstream == '127.0.0.1:{}'.format(conftest.PORT_NMB_MOCK)
+
+    async with DispatcherServer(capturing_dispatcher_server.config, session_handler = None):
+        lanes, first_ns = load_lanes([file_name])
+        report, _ = await replay('127.0.0.1', conftest.PORT_NMB_DISPATCHER, lanes, first_ns, speed = 0, response_timeout = 2)
+    assert report['GetRewardsRequest']['count'] == 1
+    assert report['GetRewardsRequest']['errors'] == 0
+    assert sum(row['count'] for row in report.values()) == 2
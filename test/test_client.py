@@ -3,6 +3,8 @@ import asyncio
 import sys, os
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 import conftest
+from pos_proxy.client import SocketClient
+from pos_proxy.passport_handler import PassportHandler
 
 #Tests
 @pytest.mark.asyncio
@@ -34,4 +36,41 @@ async def test_wait_response_good_wait_finalize(good_passport_client):
 @pytest.mark.asyncio
 async def test_wait_response_bad_wait(impatient_passport_client):       
     with pytest.raises(asyncio.TimeoutError): 
-        await impatient_passport_client.send_and_wait_response_with_timeout(conftest.GOOD_PASSPORT_ONL_STATUS)
\ No newline at end of file
+        await impatient_passport_client.send_and_wait_response_with_timeout(conftest.GOOD_PASSPORT_ONL_STATUS)
+
+@pytest.fixture()
+async def reversing_passport_server():
+    """
+    Answers every two requests in reverse order, like a remote that finishes the second one first.
+    """
+    handler = PassportHandler()
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                first = await handler.read_message(reader)
+                second = await handler.read_message(reader)
+                writer.write(second.message)
+                writer.write(first.message)
+        except Exception:
+            writer.close()
+    server = await asyncio.start_server(on_connection, host='127.0.0.1', port=conftest.PORT_NMB_MOCK)
+    yield server
+    server.close()
+    await server.wait_closed()
+
+@pytest.mark.asyncio
+async def test_pipelined_responses_matched_by_sequence_id(reversing_passport_server):
+    client = SocketClient(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, pipeline_depth = 2)
+    first, second = await asyncio.gather(client.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST),
+                                         client.send_and_wait_response_with_timeout(conftest.FINALIZE_REWARDS_REQUEST))
+    assert first[0] == conftest.GET_REWARDS_REQUEST
+    assert second[0] == conftest.FINALIZE_REWARDS_REQUEST
+    await client.disconnect()
+
+@pytest.mark.asyncio
+async def test_pipelined_timeout_keeps_connection(slow_tcp_server):
+    client = SocketClient(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, response_timeout = 0.2, pipeline_depth = 4)
+    with pytest.raises(asyncio.TimeoutError):
+        await client.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+    assert client.connected
+    await client.disconnect()
@@ -6,7 +6,7 @@ import binascii
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 import conftest
 from pos_proxy.client import MessageHandlingType, SocketClientError
-from pos_proxy.dispatcher import DispatchedMessage
+from pos_proxy.dispatcher import Dispatcher, DispatchedMessage, DispatcherServer
 from pos_proxy.passport_handler import PassportHandler
 
 @pytest.mark.asyncio
@@ -15,6 +15,19 @@ async def test_get_valid_clients(mute_passport_dispatcher):
     valid_clients = mute_passport_dispatcher.get_valid_clients(dispatched_message = dispatched_message, message_type = MessageHandlingType.CARD_BASED_UNICAST, routing_id = conftest.CARD_IN_FRR, session_id = conftest.SESSION_IN_FRR)
     assert valid_clients == mute_passport_dispatcher.clients[:1]
 
+class RoutedClient:
+    def __init__(self, name, masks, available = True):
+        self.name = name
+        self.masks = masks
+        self.available = available
+
+@pytest.mark.asyncio
+async def test_dead_card_provider_not_replaced_by_other_match():
+    provider, default = RoutedClient('provider', ['6000'], available = False), RoutedClient('default', [''])
+    dispatcher = Dispatcher(None, None, [default, provider], PassportHandler(), session_handler = None)
+    valid_clients = dispatcher.get_valid_clients(DispatchedMessage(conftest.FINALIZE_REWARDS_REQUEST), MessageHandlingType.CARD_BASED_UNICAST, '600012345', None)
+    assert [client.name for client in valid_clients] == ['provider'] #fails fast rather than going to another provider
+
 @pytest.mark.asyncio
 async def test_dispatch_to_client(mute_passport_dispatcher, good_passport_client):
     await mute_passport_dispatcher.dispatch_to_client_and_respond_if_first_answer(DispatchedMessage(conftest.FINALIZE_REWARDS_REQUEST), good_passport_client)
@@ -185,4 +198,25 @@ async def test_multi_server_send_multiple_fast(server_multi_passport_reader_writ
     
     #response order is not guaranteed (by design)
     
-    
\ No newline at end of file
+    
+@pytest.mark.asyncio
+async def test_lane_stops_reading_at_max_in_flight(server_good_passport_config, slow_tcp_server):
+    server_good_passport_config['HOST']['Passthrough'] = 'no'
+    server_good_passport_config['HOST']['MaxInFlight'] = '2'
+    server_good_passport_config['TEST_CLIENT']['PipelineDepth'] = '8'
+    async with DispatcherServer(server_good_passport_config, session_handler = None) as server:
+        in_flight = server.metrics.in_flight.value
+        window_full = server.metrics.lane_window_full.value
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST * 5) #the remote never answers
+        await asyncio.sleep(0.2)
+        assert server.metrics.in_flight.value == in_flight + 2
+        assert server.metrics.lane_window_full.value == window_full + 1
+        writer.close()
+
+def test_classify_offload_is_opt_in(server_good_passport_config):
+    assert DispatcherServer(server_good_passport_config, session_handler = None).classify_executor is None
+    server_good_passport_config['HOST']['ClassifyOffloadThreshold'] = '65536'
+    server = DispatcherServer(server_good_passport_config, session_handler = None)
+    assert server.classify_executor is not None
+    server.classify_executor.shutdown()
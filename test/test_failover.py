@@ -0,0 +1,77 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.latency import LatencyTracker
+
+@pytest.fixture()
+def redundant_passport_config(server_multi_passport_config):
+    for section in ['TEST_CLIENT', 'TEST_CLIENT_2']:
+        server_multi_passport_config[section]['CardMasks'] = '4250605'
+        server_multi_passport_config[section]['RedundancyGroup'] = 'site'
+        server_multi_passport_config[section]['FailureThreshold'] = '1'
+    return server_multi_passport_config
+
+def test_latency_percentile():
+    latencies = LatencyTracker(window = 100, min_samples = 10)
+    for latency in range(1, 10):
+        latencies.record(latency / 1000)
+    assert latencies.percentile(95) is None
+    for latency in range(10, 101):
+        latencies.record(latency / 1000)
+    assert latencies.percentile(50) == 0.05
+    assert latencies.percentile(95) == 0.095
+    assert latencies.percentile(100) == 0.1
+
+@pytest.mark.asyncio
+async def test_failover_to_redundant_client(redundant_passport_config, mock_tcp_server_2):
+    async with DispatcherServer(redundant_passport_config, session_handler = None) as server: #nothing listens for the first client
+        failovers = server.metrics.failovers.value
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST)
+        response = await asyncio.wait_for(PassportHandler().read_message(reader), 2)
+        assert response.message == conftest.GET_REWARDS_REQUEST
+        assert server.metrics.failovers.value == failovers + 1
+
+        writer.write(conftest.GET_REWARDS_REQUEST) #the dead client is skipped now
+        response = await asyncio.wait_for(PassportHandler().read_message(reader), 2)
+        assert response.message == conftest.GET_REWARDS_REQUEST
+        assert server.metrics.failovers.value == failovers + 1
+        writer.close()
+
+@pytest.mark.asyncio
+async def test_slow_request_hedged(redundant_passport_config, slow_tcp_server, mock_tcp_server_2):
+    redundant_passport_config['HOST']['HedgePercentile'] = '95'
+    redundant_passport_config['HOST']['HedgeMinDelay'] = '0.05'
+    async with DispatcherServer(redundant_passport_config, session_handler = None) as server:
+        for _ in range(20):
+            server.pools[0].latencies.record(0.01)
+        hedges = server.metrics.hedges.value
+        in_flight = server.metrics.in_flight.value
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST)
+        response = await asyncio.wait_for(PassportHandler().read_message(reader), 1)
+        assert response.message == conftest.GET_REWARDS_REQUEST
+        assert slow_tcp_server.message_received and mock_tcp_server_2.message_received
+        assert server.metrics.hedges.value == hedges + 1
+        await asyncio.sleep(0.05)
+        assert server.metrics.in_flight.value == in_flight #done as soon as answered, not when the slow client gives up
+        writer.close()
+
+@pytest.mark.asyncio
+async def test_hedged_request_cancelled_when_lane_closes(redundant_passport_config, slow_tcp_server, mock_tcp_server_2):
+    redundant_passport_config['HOST']['HedgePercentile'] = '95'
+    redundant_passport_config['HOST']['HedgeMinDelay'] = '0.05'
+    async with DispatcherServer(redundant_passport_config, session_handler = None) as server:
+        for _ in range(20):
+            server.pools[0].latencies.record(0.01)
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST)
+        await asyncio.wait_for(PassportHandler().read_message(reader), 1)
+        assert server.pools[0].outstanding == 1 #still waiting for the slow client
+        writer.close()
+        await asyncio.sleep(0.1)
+        assert server.pools[0].outstanding == 0
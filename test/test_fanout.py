@@ -0,0 +1,109 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.fanout import FanoutQueue
+from pos_proxy.health import RemoteHealth, HealthState
+from pos_proxy.metrics import MetricsRegistry, UpstreamMetrics
+from pos_proxy.client import MessageHandlingType
+from MockAsyncIOTCPServer import MockTCPServer
+
+@pytest.fixture()
+async def recording_server():
+    received = bytearray()
+    async def on_connection(reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received.extend(data)
+        writer.close()
+    server = await asyncio.start_server(on_connection, host = '127.0.0.1', port = 0)
+    yield server.sockets[0].getsockname()[1], received
+    server.close()
+    await server.wait_closed()
+
+def fanout_queue(port, **kwargs):
+    handler = PassportHandler()
+    return FanoutQueue(handler, '127.0.0.1', port, RemoteHealth(handler, '127.0.0.1', port, probe = False), **kwargs)
+
+@pytest.mark.asyncio
+async def test_fanout_coalesces_queued_messages(recording_server):
+    port, received = recording_server
+    metrics = UpstreamMetrics(MetricsRegistry(), 'test', 'remote')
+    queue = fanout_queue(port, metrics = metrics)
+    messages = [conftest.END_CUSTOMER_REQUEST, conftest.END_CUSTOMER_REQUEST, conftest.END_CUSTOMER_REQUEST]
+    assert all(queue.enqueue(message) for message in messages)
+    for _ in range(100):
+        if len(received) == len(b''.join(messages)):
+            break
+        await asyncio.sleep(0.01)
+    assert bytes(received) == b''.join(messages)
+    assert queue.sent == 3
+    assert metrics.fanout_writes.value == 1
+    assert metrics.fanout_sent.value == 3
+    await queue.close()
+
+@pytest.mark.asyncio
+async def test_fanout_overflows_full_queue(recording_server):
+    queue = fanout_queue(recording_server[0], max_size = 2)
+    assert queue.enqueue(conftest.END_CUSTOMER_REQUEST)
+    assert queue.enqueue(conftest.END_CUSTOMER_REQUEST)
+    assert queue.enqueue(conftest.END_CUSTOMER_REQUEST) is False
+    assert queue.overflows == 1
+    await queue.close()
+
+@pytest.mark.asyncio
+async def test_fanout_drops_for_dead_remote():
+    queue = fanout_queue(conftest.PORT_NMB_MOCK + 1)
+    queue.health.failure_threshold = 1
+    queue.enqueue(conftest.END_CUSTOMER_REQUEST)
+    await asyncio.sleep(0.1)
+    assert queue.health.state == HealthState.DEAD
+    queue.enqueue(conftest.END_CUSTOMER_REQUEST)
+    await asyncio.sleep(0.01)
+    assert queue.dropped == 2
+    await queue.close()
+
+@pytest.mark.asyncio
+async def test_server_fans_out_without_waiting(server_multi_passport_config, mock_tcp_server, mock_tcp_server_2):
+    server_multi_passport_config['HOST']['Trace'] = 'yes'
+    server_multi_passport_config['HOST']['FireAndForget'] = 'yes'
+    async with DispatcherServer(server_multi_passport_config, session_handler = None) as server:
+        mock_tcp_server.timeout = mock_tcp_server_2.timeout = True
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.END_CUSTOMER_REQUEST)
+        await asyncio.wait_for(mock_tcp_server.message_received_event.wait(), 2)
+        await asyncio.wait_for(mock_tcp_server_2.message_received_event.wait(), 2)
+        writer.close()
+        await asyncio.sleep(0.01)
+        assert [pool.fanout.sent for pool in server.pools] == [1, 1]
+        assert [trace.outcome for trace in server.tracer.recent()] == ['queued', 'queued']
+
+@pytest.mark.asyncio
+async def test_no_response_requests_keep_lane_order(server_good_passport_config):
+    handler = PassportHandler()
+    received = []
+    def answer(data):
+        answers = b''
+        while data:
+            message, data = data[:handler.frame_length(data)], data[handler.frame_length(data):]
+            received.append(handler.parse_message(message).handling_type)
+            if handler.expects_response(message):
+                answers += message
+        return answers
+    server_good_passport_config['TEST_CLIENT']['MinConnections'] = '2'
+    remote = await MockTCPServer(port = conftest.PORT_NMB_MOCK, reply_cb = answer).listen()
+    try:
+        async with DispatcherServer(server_good_passport_config, session_handler = None): #FireAndForget is off by default
+            await asyncio.sleep(0.1) #both connections warm, either could be leased
+            reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+            writer.write(conftest.END_CUSTOMER_REQUEST + conftest.GET_REWARDS_REQUEST)
+            await asyncio.wait_for(handler.read_message(reader), 2)
+            writer.close()
+    finally:
+        await remote.close()
+    assert received == [MessageHandlingType.MULTICAST_NO_RESPONSE, MessageHandlingType.CARD_BASED_UNICAST]
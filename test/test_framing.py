@@ -0,0 +1,124 @@
+import pytest
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.framing import FramedConnection, FramingError
+from pos_proxy.client import SocketClient, SocketClientError
+
+MESSAGES = [conftest.GET_REWARDS_REQUEST, PassportHandler().build_echo(), conftest.GOOD_PASSPORT_ONL_STATUS, conftest.END_CUSTOMER_REQUEST]
+
+class RecordingTransport:
+    def __init__(self):
+        self.aborted = False
+        self.reading = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def abort(self):
+        self.aborted = True
+
+    def is_closing(self):
+        return self.aborted
+
+def framed_connection(**kwargs) -> FramedConnection:
+    handler = PassportHandler()
+    connection = FramedConnection(handler.header_bytes_length, handler.frame_length, **kwargs)
+    connection.connection_made(RecordingTransport())
+    return connection
+
+def feed(connection: FramedConnection, data: bytes, chunk_size: int):
+    """
+    Delivers data the way a transport does, at most chunk_size bytes per receive.
+    """
+    while data:
+        buffer = connection.get_buffer(-1)
+        nbytes = min(len(buffer), chunk_size, len(data))
+        buffer[:nbytes] = data[:nbytes]
+        connection.buffer_updated(nbytes)
+        data = data[nbytes:]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('chunk_size', [1, 13, 28, 29, 1000, 100000])
+@pytest.mark.parametrize('buffer_size', [28, 512, 64 * 1024])
+async def test_frames_any_chunking(chunk_size, buffer_size):
+    connection = framed_connection(buffer_size = buffer_size)
+    feed(connection, b''.join(MESSAGES), chunk_size)
+
+    for message in MESSAGES:
+        frame = await connection.read_frame()
+        assert isinstance(frame, memoryview)
+        assert frame == message
+    assert not connection._frames
+
+@pytest.mark.asyncio
+async def test_frames_are_parsed_without_copy():
+    handler = PassportHandler()
+    connection = framed_connection()
+    feed(connection, conftest.GET_REWARDS_REQUEST, 100000)
+
+    frame = await connection.read_frame()
+    parsed = handler.parse_message(frame)
+    assert parsed.message is frame
+    assert parsed.routing_id == conftest.CARD_IN_GRR
+
+@pytest.mark.asyncio
+async def test_invalid_frame_aborts():
+    connection = framed_connection()
+    feed(connection, b'X' * 28, 100)
+
+    assert connection.transport.aborted
+    with pytest.raises(FramingError):
+        await connection.read_frame()
+
+@pytest.mark.asyncio
+async def test_oversized_frame_aborts():
+    connection = framed_connection(max_frame_size = 1000)
+    feed(connection, conftest.GET_REWARDS_REQUEST, 100000)
+
+    assert connection.transport.aborted
+    with pytest.raises(FramingError):
+        await connection.read_frame()
+
+@pytest.mark.asyncio
+async def test_eof_mid_frame():
+    connection = framed_connection()
+    feed(connection, conftest.GET_REWARDS_REQUEST[:100], 100000)
+    connection.eof_received()
+
+    with pytest.raises(SocketClientError):
+        await PassportHandler().read_message(connection)
+
+@pytest.mark.asyncio
+async def test_reading_paused_when_frames_pile_up():
+    connection = framed_connection(max_queued_frames = 4)
+    feed(connection, PassportHandler().build_echo() * 4, 100000)
+    assert connection.transport.reading is False
+
+    for _ in range(2):
+        await connection.read_frame()
+    assert connection.transport.reading is True
+
+@pytest.mark.asyncio
+async def test_framed_client(mock_tcp_server):
+    client = SocketClient(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, framed = True)
+    try:
+        for _ in range(3):
+            response, _, session_id = await client.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+            assert response == conftest.GET_REWARDS_REQUEST
+            assert session_id == PassportHandler().parse_message(conftest.GET_REWARDS_REQUEST).session_id
+    finally:
+        await client.disconnect()
+
+@pytest.mark.asyncio
+async def test_writing_paused_changed_pauses_peer():
+    pos, upstream = framed_connection(), framed_connection()
+    upstream.set_writing_paused_changed(lambda paused: pos.pause_reading() if paused else pos.resume_reading())
+    upstream.pause_writing()
+    assert pos.transport.reading is False
+    upstream.resume_writing()
+    assert pos.transport.reading is True
@@ -1,9 +1,12 @@
 import pytest
 import sys, os
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 import conftest
-from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.passport_handler import PassportHandler, CrcError
+from pos_proxy.metrics import Counter
 from pos_proxy.client import MessageHandlingType
 
 def test_process_end_customer_request():
@@ -36,6 +39,24 @@ def test_message_handling_type_finalize_rewards():
     assert id_string == conftest.CARD_IN_FRR
     assert session_id == conftest.SESSION_IN_FRR
 
+def test_parse_message_finalize_rewards():
+    parsed = PassportHandler().parse_message(conftest.FINALIZE_REWARDS_REQUEST)
+    assert parsed.message == conftest.FINALIZE_REWARDS_REQUEST
+    assert parsed.message_type == 1
+    assert parsed.xml_length == len(conftest.FINALIZE_REWARDS_REQUEST) - 28
+    assert parsed.handling_type == MessageHandlingType.CARD_BASED_UNICAST
+    assert parsed.loyalty_id == conftest.CARD_IN_FRR
+    assert parsed.loyalty_sequence_id == conftest.SESSION_IN_FRR
+    assert parsed.pos_sequence_id == '01-3668^2347498^'
+    assert parsed.routing_id == conftest.CARD_IN_FRR
+    assert parsed.session_id == conftest.SESSION_IN_FRR
+
+def test_parse_message_returns_parsed_unchanged():
+    handler = PassportHandler()
+    parsed = handler.parse_message(conftest.GET_REWARDS_REQUEST)
+    assert handler.parse_message(parsed) is parsed
+    assert handler.verify_sequence_id(parsed, conftest.GET_REWARDS_REQUEST)
+
 @pytest.mark.asyncio
 async def test_read_process_echo_header(echo_reader_writer):
     reader = echo_reader_writer[0]
@@ -51,4 +72,144 @@ async def test_read_process_echo_message(echo_reader_writer):
     writer = echo_reader_writer[1]
     writer.write(conftest.GOOD_PASSPORT_ONL_STATUS)    
     await PassportHandler().wait_and_handle_response_message(reader, conftest.GOOD_PASSPORT_ONL_STATUS)   
-    
\ No newline at end of file
+    
+def corpus_messages():
+    return [value for name, value in sorted(vars(conftest).items()) if isinstance(value, bytes) and value.startswith(b'POSLOYALTY')]
+
+def parse_outcome(handler, message):
+    try:
+        parsed = handler.parse_message(message)
+    except Exception as e:
+        return type(e)
+    return parsed.handling_type, parsed.routing_id, parsed.session_id, parsed.loyalty_id, parsed.loyalty_sequence_id, parsed.pos_sequence_id
+
+def test_scan_matches_full_parse_on_corpus():
+    messages = corpus_messages()
+    assert len(messages) > 0
+    for message in messages:
+        assert parse_outcome(PassportHandler(fast_scan=True), message) == parse_outcome(PassportHandler(fast_scan=False), message)
+
+@pytest.mark.parametrize('xml', [
+    b'<GetRewardsRequest><RequestHeader><POSSequenceID>1</POSSequenceID></RequestHeader><LoyaltyID/><LoyaltyID entryMethod="scan">4250</LoyaltyID></GetRewardsRequest>',
+    b'<GetRewardsRequest><POSSequenceID></POSSequenceID><LoyaltySequenceID /><LoyaltySequenceID>S-1</LoyaltySequenceID></GetRewardsRequest>',
+    b'<GetRewardsRequest><LoyaltyIDType>x</LoyaltyIDType><LoyaltyID><Nested>1</Nested></LoyaltyID></GetRewardsRequest>',
+    b'<Outer><EndCustomerRequest/><GetLoyaltyOnlineStatusResponse/></Outer>',
+    b'<?xml version="1.0"?><BeginCustomerRequest><POSSequenceID>7</POSSequenceID></BeginCustomerRequest>',
+    b'<GetRewardsRequest><LoyaltyID><![CDATA[4250]]></LoyaltyID></GetRewardsRequest>',
+    b'<GetRewardsRequest><LoyaltyID>42&amp;50</LoyaltyID></GetRewardsRequest>',
+    b'<GetRewardsRequest xmlns="urn:x"><LoyaltyID>4250</LoyaltyID></GetRewardsRequest>',
+    b'<GetRewardsRequest><!-- <LoyaltyID>1</LoyaltyID> --><LoyaltyID>4250</LoyaltyID></GetRewardsRequest>',
+    b'<GetRewardsRequest><LoyaltySequenceID>a\r\nb</LoyaltySequenceID></GetRewardsRequest>',
+])
+def test_scan_matches_full_parse(xml):
+    message = PassportHandler().build_message(xml)
+    assert parse_outcome(PassportHandler(fast_scan=True), message) == parse_outcome(PassportHandler(fast_scan=False), message)
+
+def test_scan_falls_back_when_ambiguous():
+    handler = PassportHandler()
+    assert handler.scan_fields(handler.build_message(b'<GetRewardsRequest><LoyaltyID><![CDATA[4250]]></LoyaltyID></GetRewardsRequest>')) is None
+    assert handler.scan_fields(conftest.GET_REWARDS_REQUEST) is not None
+
+class CountingThreadPoolExecutor(ThreadPoolExecutor):
+    submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+def large_basket_message() -> bytes:
+    handler = PassportHandler()
+    xml = bytes(handler.get_xml(conftest.FINALIZE_REWARDS_REQUEST))
+    line_start = xml.index(b'<TransactionLine ')
+    line = xml[line_start:xml.index(b'</TransactionLine>', line_start) + len(b'</TransactionLine>')]
+    return handler.build_message(xml[:line_start] + line * (200000 // len(line)) + xml[line_start:])
+
+async def read_from_bytes(handler, message):
+    reader = asyncio.StreamReader()
+    reader.feed_data(message)
+    reader.feed_eof()
+    return await handler.read_message(reader)
+
+@pytest.mark.asyncio
+async def test_large_message_classified_on_thread_pool():
+    message = large_basket_message()
+    with CountingThreadPoolExecutor(max_workers = 1) as executor:
+        handler = PassportHandler(offload_threshold = 65536, offload_executor = executor)
+        assert parse_outcome(handler, message) == parse_outcome(PassportHandler(), message)
+        parsed = await read_from_bytes(handler, message)
+        assert executor.submitted == 1
+        assert parsed.message == message
+        assert (parsed.handling_type, parsed.routing_id, parsed.session_id) == (MessageHandlingType.CARD_BASED_UNICAST, conftest.CARD_IN_FRR, conftest.SESSION_IN_FRR)
+
+        await read_from_bytes(handler, conftest.FINALIZE_REWARDS_REQUEST)
+        assert executor.submitted == 1 #small messages stay inline
+
+@pytest.mark.asyncio
+async def test_large_message_classified_on_process_pool():
+    message = large_basket_message()
+    with ProcessPoolExecutor(max_workers = 1) as executor:
+        handler = PassportHandler(offload_threshold = 65536, offload_executor = executor)
+        parsed = await read_from_bytes(handler, message)
+        assert parsed.message == message
+        assert (parsed.handling_type, parsed.routing_id, parsed.session_id, parsed.pos_sequence_id) == \
+            (MessageHandlingType.CARD_BASED_UNICAST, conftest.CARD_IN_FRR, conftest.SESSION_IN_FRR, handler.get_sequence_id(conftest.FINALIZE_REWARDS_REQUEST))
+
+def test_response_cache_keys():
+    handler = PassportHandler()
+    assert handler.response_cache_key(conftest.GOOD_PASSPORT_ONL_STATUS) == 'GetLoyaltyOnlineStatus'
+    assert handler.response_cache_key(handler.build_echo()) == 'PASSPORT_ECHO'
+    assert handler.response_cache_key(conftest.END_CUSTOMER_REQUEST) is None
+    assert handler.response_cache_key(conftest.GET_REWARDS_REQUEST) is None
+
+def test_rewrite_response_sets_sequence_id_and_crcs():
+    handler = PassportHandler()
+    request = handler.build_message(handler.get_xml(conftest.GOOD_PASSPORT_ONL_STATUS).replace(b'00-0^2319718^', b'07-1&amp;2'))
+    rewritten = handler.rewrite_response(conftest.GOOD_PASSPORT_ONL_STATUS, request)
+    assert handler.get_sequence_id(rewritten) == '07-1&2' #parse_message checks both CRCs
+    assert handler.get_xml(rewritten) == handler.get_xml(request)
+    assert handler.rewrite_response(handler.build_echo(), handler.build_echo()) == handler.build_echo()
+    assert handler.rewrite_response(handler.build_message(b'<GetLoyaltyOnlineStatusResponse/>'), request) is None
+
+class CountingHandler(PassportHandler):
+    unpacked = 0
+
+    def unpack_header(self, input):
+        self.unpacked += 1
+        return super().unpack_header(input)
+
+@pytest.mark.asyncio
+async def test_stream_read_verifies_header_once():
+    handler = CountingHandler()
+    parsed = await read_from_bytes(handler, conftest.GET_REWARDS_REQUEST)
+    assert parsed.message == conftest.GET_REWARDS_REQUEST
+    assert handler.unpacked == 1
+
+def test_expects_response():
+    handler = PassportHandler()
+    assert handler.expects_response(conftest.GET_REWARDS_REQUEST)
+    assert handler.expects_response(memoryview(bytearray(conftest.GOOD_PASSPORT_ONL_STATUS)))
+    assert handler.expects_response(handler.build_echo())
+    assert not handler.expects_response(conftest.END_CUSTOMER_REQUEST)
+
+class ThreadRecordingCounter(Counter):
+    __slots__ = ('threads',)
+
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def inc(self, amount = 1):
+        self.threads.add(threading.current_thread())
+        super().inc(amount)
+
+@pytest.mark.asyncio
+async def test_offloaded_crc_failure_counted_on_loop():
+    message = bytearray(large_basket_message())
+    message[-2] ^= 1 #breaks the XML CRC
+    crc_failures = ThreadRecordingCounter()
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        handler = PassportHandler(offload_threshold = 65536, offload_executor = executor, crc_failures = crc_failures)
+        with pytest.raises(CrcError):
+            await read_from_bytes(handler, bytes(message))
+    assert crc_failures.value == 1
+    assert crc_failures.threads == {threading.current_thread()}
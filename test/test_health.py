@@ -0,0 +1,78 @@
+import pytest
+import asyncio
+import time
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.health import RemoteHealth, HealthState
+from pos_proxy.client import SocketClient
+
+def test_backoff_grows_and_expires():
+    health = RemoteHealth(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, backoff_min = 0.05, backoff_max = 1, jitter = 0, failure_threshold = 1)
+    health.record_failure()
+    assert health.state == HealthState.DEAD
+    assert health.available is False
+    assert health.begin_attempt() is False
+    first_retry_at = health.retry_at
+    health.record_failure()
+    assert health.failures == 2
+    assert health.retry_at > first_retry_at
+    health.retry_at = 0
+    assert health.state == HealthState.HALF_OPEN
+    assert health.begin_attempt() is True
+    assert health.begin_attempt() is False #only one trial at a time
+    health.record_success()
+    assert health.state == HealthState.HEALTHY
+    assert health.failures == 0
+
+def test_one_failure_does_not_lock_out_remote():
+    health = RemoteHealth(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, jitter = 0, failure_threshold = 3)
+    health.record_failure() #e.g. one slow transaction timed out
+    health.record_failure()
+    assert health.state == HealthState.HEALTHY
+    health.record_success()
+    health.record_failure()
+    health.record_failure()
+    assert health.available is True #not consecutive
+    health.record_failure()
+    assert health.state == HealthState.DEAD
+    assert health.retry_at - time.time() <= health.backoff_min
+
+@pytest.mark.asyncio
+async def test_probe_revives_remote(mock_tcp_server):
+    health = RemoteHealth(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, backoff_min = 0.05, jitter = 0, failure_threshold = 1)
+    health.start()
+    health.record_failure()
+    await asyncio.sleep(0.3)
+    assert health.state == HealthState.HEALTHY
+    health.close()
+
+@pytest.mark.asyncio
+async def test_dispatcher_skips_dead_remote(multi_passport_dispatcher_server, mock_tcp_server, mock_tcp_server_2):
+    dead_pool = multi_passport_dispatcher_server.pools[0]
+    for _ in range(dead_pool.health.failure_threshold):
+        dead_pool.health.record_failure()
+    reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+    writer.write(conftest.GOOD_PASSPORT_ONL_STATUS)
+    await PassportHandler().wait_and_handle_response_message(reader, conftest.GOOD_PASSPORT_ONL_STATUS)
+    assert mock_tcp_server.message_received is False
+    assert mock_tcp_server_2.message_received is True
+    writer.close()
+    await writer.wait_closed()
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_is_released(slow_tcp_server):
+    health = RemoteHealth(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, probe = False, failure_threshold = 1)
+    client = SocketClient(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, health = health)
+    health.record_failure()
+    health.retry_at = 0
+    trial = asyncio.create_task(client.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST))
+    await asyncio.sleep(0.1)
+    assert health.available is False #the trial is testing the remote
+    trial.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await trial
+    assert health.state == HealthState.HALF_OPEN
+    assert health.available is True
+    await client.disconnect()
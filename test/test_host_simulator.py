@@ -0,0 +1,85 @@
+import pytest
+import asyncio
+import random
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/../benchmarks"))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.client import SocketClient, SocketClientError
+from host_simulator import LoyaltyHostSimulator, Faults, fixed, parse_latency
+
+@pytest.fixture()
+async def simulated_host():
+    host = await LoyaltyHostSimulator(conftest.PORT_NMB_MOCK).listen()
+    yield host
+    await host.close()
+
+@pytest.fixture()
+async def simulated_host_reader_writer(simulated_host):
+    reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_MOCK)
+    yield reader, writer
+    writer.close()
+
+@pytest.mark.asyncio
+async def test_simulator_frames_coalesced_requests(simulated_host_reader_writer):
+    reader, writer = simulated_host_reader_writer
+    handler = PassportHandler()
+    writer.write(conftest.GET_REWARDS_REQUEST + conftest.GOOD_PASSPORT_ONL_STATUS + conftest.END_CUSTOMER_REQUEST + conftest.FINALIZE_REWARDS_REQUEST)
+
+    responses = [await asyncio.wait_for(handler.read_message(reader), 2) for _ in range(3)] #verified and CRC checked on parse
+    expected = [conftest.GET_REWARDS_REQUEST, conftest.GOOD_PASSPORT_ONL_STATUS, conftest.FINALIZE_REWARDS_REQUEST]
+    assert sorted(response.pos_sequence_id for response in responses) == sorted(handler.get_sequence_id(request) for request in expected)
+    assert any(response.message[28:].startswith(b'<GetRewardsResponse>') for response in responses)
+
+@pytest.mark.asyncio
+async def test_simulator_answers_split_request(simulated_host_reader_writer):
+    reader, writer = simulated_host_reader_writer
+    handler = PassportHandler()
+    for offset in range(0, len(conftest.GET_REWARDS_REQUEST), 100):
+        writer.write(conftest.GET_REWARDS_REQUEST[offset:offset + 100])
+        await writer.drain()
+        await asyncio.sleep(0)
+
+    response = await asyncio.wait_for(handler.read_message(reader), 2)
+    assert handler.verify_sequence_id(conftest.GET_REWARDS_REQUEST, response)
+    assert response.loyalty_sequence_id == handler.parse_message(conftest.GET_REWARDS_REQUEST).loyalty_sequence_id
+
+@pytest.mark.asyncio
+async def test_simulator_echo(simulated_host_reader_writer):
+    reader, writer = simulated_host_reader_writer
+    handler = PassportHandler()
+    writer.write(handler.build_echo())
+    response = await asyncio.wait_for(handler.read_message(reader), 2)
+    assert handler.is_binary_echo(response.message)
+
+@pytest.mark.asyncio
+async def test_simulator_reset_fault():
+    host = await LoyaltyHostSimulator(conftest.PORT_NMB_MOCK, faults = Faults(reset = 1)).listen()
+    client = SocketClient(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK)
+    try:
+        with pytest.raises(SocketClientError):
+            await client.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+        assert host.injected['reset'] == 1
+    finally:
+        await client.disconnect()
+        await host.close()
+
+@pytest.mark.asyncio
+async def test_simulator_stall_fault():
+    host = await LoyaltyHostSimulator(conftest.PORT_NMB_MOCK, faults = Faults(stall = 1)).listen()
+    client = SocketClient(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, response_timeout = 0.5)
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await client.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+    finally:
+        await client.disconnect()
+        await host.close()
+
+def test_latency_distributions():
+    rng = random.Random(1)
+    assert fixed(0.01)(rng) == 0.01
+    samples = sorted(parse_latency('lognormal:0.01:0.5')(rng) for _ in range(2001))
+    assert 0.008 < samples[1000] < 0.012
+    slow = [parse_latency('bimodal:0.001:0.5:0.1')(rng) for _ in range(2000)].count(0.5)
+    assert 100 < slow < 300
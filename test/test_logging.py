@@ -0,0 +1,114 @@
+import pytest
+import asyncio
+import atexit
+import gc
+import logging
+import queue
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.client import SocketClient
+from pos_proxy.dispatcher import Dispatcher
+from pos_proxy.logging_setup import HexDump, get_context_logger, BoundedQueueHandler, setup_logging
+from pos_proxy.metrics import Counter
+
+def make_record(message):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, message, None, None)
+
+class CountingHexDump(HexDump):
+    conversions = 0
+
+    def __str__(self):
+        CountingHexDump.conversions += 1
+        return super().__str__()
+
+def test_hex_dump_only_when_enabled():
+    logger = get_context_logger(Dispatcher(None, None, [], PassportHandler(), session_handler = None), 'lane-1')
+    logger.logger.setLevel(logging.INFO)
+    try:
+        logger.debug('Sent: %s', CountingHexDump(conftest.GET_REWARDS_REQUEST))
+        assert CountingHexDump.conversions == 0
+
+        logger.logger.setLevel(logging.DEBUG)
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record)
+        logger.logger.addHandler(handler)
+        logger.debug('Sent: %s', CountingHexDump(b'\x01\xff'))
+        logger.logger.removeHandler(handler)
+        record, = records
+        assert record.getMessage() == '[lane-1] Sent: 01ff'
+        assert record.context_id == 'lane-1'
+        assert record.name == 'Dispatcher'
+        assert CountingHexDump.conversions > 0
+    finally:
+        logger.logger.setLevel(logging.NOTSET)
+
+@pytest.mark.asyncio
+async def test_connection_cycles_keep_memory_flat():
+    handler = PassportHandler()
+    remote = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0) #keeps nothing, unlike MockTCPServer
+    port = remote.sockets[0].getsockname()[1]
+
+    async def cycles(count):
+        for _ in range(count):
+            client = SocketClient(handler, '127.0.0.1', port)
+            async with Dispatcher(None, None, [client], handler, session_handler = None):
+                pass
+
+    async def connected_cycles(count):
+        for _ in range(count):
+            client = SocketClient(handler, '127.0.0.1', port)
+            async with Dispatcher(None, None, [client], handler, session_handler = None):
+                await client.connect()
+        await asyncio.sleep(0.1) #let the remote finish with the connections
+
+    quiet = [logging.getLogger(name) for name in ['SocketClient', 'Dispatcher']]
+    for logger in quiet:
+        logger.setLevel(logging.WARNING) #log capture keeps every record it gets
+    try:
+        await cycles(1000) #warm up caches and free lists
+        await connected_cycles(100)
+        loggers = len(logging.Logger.manager.loggerDict)
+        gc.collect()
+        objects = len(gc.get_objects())
+        await cycles(100000)
+        await connected_cycles(500)
+        gc.collect()
+        assert len(logging.Logger.manager.loggerDict) == loggers
+        assert len(gc.get_objects()) - objects < 1000
+    finally:
+        for logger in quiet:
+            logger.setLevel(logging.NOTSET)
+        remote.close()
+        await remote.wait_closed()
+
+def test_full_log_queue_drops_and_counts():
+    records = queue.Queue(maxsize = 2)
+    dropped = Counter()
+    handler = BoundedQueueHandler(records, dropped = dropped)
+    for index in range(5):
+        handler.handle(make_record('record {}'.format(index)))
+    assert records.qsize() == 2
+    assert dropped.value == 3
+    assert records.get_nowait().getMessage() == 'record 0'
+
+def test_setup_logging_writes_from_listener(tmp_path):
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    try:
+        listener = setup_logging(str(tmp_path), file_name = 'test.log', queue_size = 100, overflow = 'block')
+        queue_handler, = [handler for handler in root.handlers if isinstance(handler, BoundedQueueHandler)]
+        assert queue_handler.block is True
+        for index in range(500): #more than the queue holds, waits for the listener instead of dropping
+            logging.getLogger('LogTest').info('message %s', index)
+        listener.stop()
+        atexit.unregister(listener.stop)
+        with open(os.path.join(str(tmp_path), 'log', 'test.log')) as log_file:
+            lines = [line for line in log_file if 'message' in line]
+        assert len(lines) == 500
+        assert lines[-1].rstrip().endswith('message 499')
+    finally:
+        root.handlers[:] = handlers
+        root.setLevel(level)
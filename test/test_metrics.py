@@ -0,0 +1,82 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.metrics import MetricsRegistry, registry
+
+PORT_NMB_METRICS = 17998
+
+async def scrape(port = PORT_NMB_METRICS, path = '/metrics') -> (str, str):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(path).encode())
+    response = await asyncio.wait_for(reader.read(), 2)
+    writer.close()
+    head, body = response.decode().split('\r\n\r\n', 1)
+    return head.split('\r\n')[0], body
+
+def sample(body: str, line_start: str) -> float:
+    values = [float(line.rsplit(' ', 1)[1]) for line in body.splitlines() if line.startswith(line_start)]
+    assert len(values) == 1, line_start
+    return values[0]
+
+def test_histogram_render():
+    metrics = MetricsRegistry()
+    histogram = metrics.histogram('latency_seconds', 'Latency.', buckets = (0.1, 1), listener = 1)
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value)
+    metrics.counter('requests_total', 'Requests.', listener = 2).inc()
+
+    text = metrics.render()
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{listener="1",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{listener="1",le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{listener="1",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{listener="1"} 4' in text
+    assert 'requests_total{listener="2"} 1' in text
+
+    text = metrics.render(listener = 1)
+    assert 'latency_seconds_count' in text
+    assert 'requests_total' not in text
+
+@pytest.mark.asyncio
+async def test_listener_metrics_served(server_multi_passport_config, mock_tcp_server, mock_tcp_server_2):
+    server_multi_passport_config['HOST']['MetricsPort'] = str(PORT_NMB_METRICS)
+    async with DispatcherServer(server_multi_passport_config, session_handler = None) as server:
+        _, before = await scrape()
+        upstream = 'listener="{}",upstream="127.0.0.1:{}"'.format(conftest.PORT_NMB_DISPATCHER, conftest.PORT_NMB_MOCK)
+        latency_count = sample(before, 'posproxy_upstream_latency_seconds_count{' + upstream)
+
+        handler = PassportHandler()
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST)
+        await asyncio.wait_for(handler.wait_and_handle_response_message(reader, conftest.GET_REWARDS_REQUEST), 2)
+
+        status, body = await scrape()
+        assert status == 'HTTP/1.1 200 OK'
+        listener = 'listener="{}"'.format(conftest.PORT_NMB_DISPATCHER)
+        assert sample(body, 'posproxy_messages_total{' + listener + ',type="CARD_BASED_UNICAST"}') >= 1
+        assert sample(body, 'posproxy_pos_connections{' + listener + '}') == 1
+        assert sample(body, 'posproxy_dispatches_in_flight{' + listener + '}') == 0
+        assert sample(body, 'posproxy_upstream_latency_seconds_count{' + upstream) == latency_count + 1
+        assert 'posproxy_event_loop_lag_seconds_bucket' in body
+        assert (await scrape(path = '/other'))[0] == 'HTTP/1.1 404 Not Found'
+
+        writer.close()
+        await writer.wait_closed()
+        for _ in range(100):
+            if server.metrics.connections.value == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert server.metrics.connections.value == 0
+
+@pytest.mark.asyncio
+async def test_crc_failures_counted(server_multi_passport_reader_writer):
+    reader, writer, _, _ = server_multi_passport_reader_writer
+    crc_failures = registry.counter('posproxy_crc_failures_total', '', listener = conftest.PORT_NMB_DISPATCHER)
+    before = crc_failures.value
+    writer.write(conftest.GET_REWARDS_REQUEST_2_INVALID)
+    assert await asyncio.wait_for(reader.read(), 2) == b'' #closed by the proxy
+    assert crc_failures.value == before + 1
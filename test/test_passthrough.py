@@ -0,0 +1,80 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.client import SocketClientError
+
+@pytest.fixture()
+async def passthrough_reader_writer(server_good_passport_config, mock_tcp_server):
+    server_good_passport_config['HOST']['Passthrough'] = 'yes'
+    async with DispatcherServer(server_good_passport_config, session_handler = None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        yield reader, writer
+        writer.close()
+
+@pytest.fixture()
+async def verifying_passthrough_reader_writer(server_good_passport_config, mock_tcp_server):
+    server_good_passport_config['HOST']['Passthrough'] = 'yes'
+    server_good_passport_config['HOST']['PassthroughVerifyCrc'] = 'yes'
+    async with DispatcherServer(server_good_passport_config, session_handler = None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        yield reader, writer, mock_tcp_server
+        writer.close()
+
+def test_passthrough_auto(server_good_passport_config, server_multi_passport_config):
+    assert DispatcherServer(server_good_passport_config, session_handler = None).passthrough is False #opt-in
+    server_good_passport_config['HOST']['Passthrough'] = 'auto'
+    server_multi_passport_config['HOST']['Passthrough'] = 'auto'
+    assert DispatcherServer(server_good_passport_config, session_handler = None).passthrough is True
+    assert DispatcherServer(server_multi_passport_config, session_handler = None).passthrough is False
+
+def test_passthrough_needs_one_client(server_multi_passport_config):
+    server_multi_passport_config['HOST']['Passthrough'] = 'yes'
+    with pytest.raises(ValueError):
+        DispatcherServer(server_multi_passport_config, session_handler = None)
+
+@pytest.mark.asyncio
+async def test_passthrough_relays(passthrough_reader_writer):
+    reader, writer = passthrough_reader_writer
+    handler = PassportHandler()
+    for request in [conftest.GET_REWARDS_REQUEST, conftest.END_CUSTOMER_REQUEST, conftest.FINALIZE_REWARDS_REQUEST]:
+        writer.write(request)
+        xml_length, header = await asyncio.wait_for(handler.read_and_process_header(reader), 2)
+        assert header + await reader.readexactly(xml_length) == request #the mock remote echoes, even what would get no response
+
+@pytest.mark.asyncio
+async def test_passthrough_crc_check(verifying_passthrough_reader_writer):
+    reader, writer, mock_tcp_server = verifying_passthrough_reader_writer
+    writer.write(conftest.GET_REWARDS_REQUEST_2_INVALID)
+    with pytest.raises(SocketClientError):
+        await PassportHandler().read_and_process_header(reader)
+    assert mock_tcp_server.message_received is False
+
+@pytest.mark.asyncio
+async def test_passthrough_unreachable_remote(server_good_passport_config):
+    server_good_passport_config['HOST']['Passthrough'] = 'yes'
+    async with DispatcherServer(server_good_passport_config, session_handler = None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST)
+        with pytest.raises(SocketClientError):
+            await PassportHandler().read_and_process_header(reader)
+        writer.close()
+
+@pytest.mark.asyncio
+async def test_passthrough_response_timeout(server_good_passport_config, slow_tcp_server):
+    server_good_passport_config['HOST']['Passthrough'] = 'yes'
+    server_good_passport_config['TEST_CLIENT']['ResponseTimeout'] = '0.3'
+    server_good_passport_config['TEST_CLIENT']['FailureThreshold'] = '1'
+    async with DispatcherServer(server_good_passport_config, session_handler = None) as server:
+        pool = server.pools[0]
+        timeouts = pool.metrics.timeouts.value
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.END_CUSTOMER_REQUEST + conftest.GET_REWARDS_REQUEST)
+        with pytest.raises(SocketClientError):
+            await asyncio.wait_for(PassportHandler().read_and_process_header(reader), 2)
+        assert pool.metrics.timeouts.value == timeouts + 1
+        assert pool.health.available is False
+        writer.close()
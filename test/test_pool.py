@@ -0,0 +1,143 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.pool import UpstreamPool
+from pos_proxy.client import TimeoutNotExpiredError, MessageHandlingType
+from pos_proxy.dispatcher import DispatcherServer
+
+@pytest.fixture()
+async def passport_pool(mock_tcp_server):
+    pool = UpstreamPool(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, min_connections = 1, max_connections = 2)
+    yield pool
+    await pool.close()
+
+@pytest.mark.asyncio
+async def test_pool_reuses_connection(passport_pool):
+    for _ in range(3):
+        response, _, _ = await passport_pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+        assert response == conftest.GET_REWARDS_REQUEST
+    assert passport_pool.size == 1
+
+@pytest.mark.asyncio
+async def test_pool_respects_max_connections(passport_pool):
+    results = await asyncio.gather(*[passport_pool.send_and_wait_response_with_timeout(conftest.FINALIZE_REWARDS_REQUEST) for _ in range(6)])
+    assert all(response == conftest.FINALIZE_REWARDS_REQUEST for response, _, _ in results)
+    assert passport_pool.size == 2
+
+@pytest.mark.asyncio
+async def test_pool_keeps_connections_warm(passport_pool):
+    passport_pool.start()
+    await asyncio.sleep(0.1)
+    assert passport_pool.size == 1
+
+@pytest.mark.asyncio
+async def test_pool_locks_out_failed_remote(mock_tcp_server):
+    pool = UpstreamPool(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK + 1, failure_threshold = 2)
+    for _ in range(2):
+        with pytest.raises(ConnectionRefusedError):
+            await pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+    with pytest.raises(TimeoutNotExpiredError):
+        await pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+    await pool.close()
+
+@pytest.fixture()
+async def routing_passport_dispatcher_server(server_good_passport_config, mock_tcp_server):
+    server_good_passport_config['HOST']['Passthrough'] = 'no'
+    async with DispatcherServer(server_good_passport_config, session_handler = None) as server:
+        yield server
+
+@pytest.mark.asyncio
+async def test_server_shares_pool_between_pos_connections(routing_passport_dispatcher_server):
+    for _ in range(3):
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.GET_REWARDS_REQUEST)
+        await PassportHandler().wait_and_handle_response_message(reader, conftest.GET_REWARDS_REQUEST)
+        writer.close()
+        await writer.wait_closed()
+    assert routing_passport_dispatcher_server.pools[0].size == 1
+
+@pytest.mark.asyncio
+async def test_pipelined_pool_shares_connection(mock_tcp_server):
+    pool = UpstreamPool(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, max_connections = 2, pipeline_depth = 4)
+    results = await asyncio.gather(pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST),
+                                   pool.send_and_wait_response_with_timeout(conftest.FINALIZE_REWARDS_REQUEST))
+    assert [response for response, _, _ in results] == [conftest.GET_REWARDS_REQUEST, conftest.FINALIZE_REWARDS_REQUEST]
+    assert pool.size == 1
+    await pool.close()
+
+def test_pool_timeouts_from_config(server_good_passport_config):
+    section = server_good_passport_config['TEST_CLIENT']
+    section.update({'ConnectTimeout': '2', 'ResponseTimeout': '3', 'AdaptiveTimeout': 'yes', 'ResponseTimeoutFloor': '0.5'})
+    pool = UpstreamPool.from_config(PassportHandler(), section)
+    assert (pool.connect_timeout, pool.response_timeout, pool.response_timeout_floor) == (2, 3, 0.5)
+    assert pool.current_response_timeout() == 3 #nothing measured yet
+    for _ in range(20):
+        pool.latencies.record(0.1)
+    assert pool.current_response_timeout() == 0.5
+    for _ in range(20):
+        pool.latencies.record(5)
+    assert pool.current_response_timeout() == 3
+
+@pytest.mark.asyncio
+async def test_pool_gives_up_on_slow_remote_early(slow_tcp_server):
+    pool = UpstreamPool(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, adaptive_timeout = True, response_timeout_floor = 0.05)
+    for _ in range(20):
+        pool.latencies.record(0.01)
+    started = asyncio.get_running_loop().time()
+    with pytest.raises(asyncio.TimeoutError):
+        await pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST)
+    assert asyncio.get_running_loop().time() - started < 1
+    assert pool.latencies.samples[-1] == 0.05 #the timeout counts, so it grows while the remote stays slow
+    await pool.close()
+
+@pytest.mark.asyncio
+async def test_half_open_remote_gets_one_connection(slow_tcp_server):
+    pool = UpstreamPool(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, min_connections = 0, max_connections = 8, response_timeout = 0.3, health_probe = False, failure_threshold = 1)
+    pool.health.record_failure()
+    pool.health.retry_at = 0
+    results = await asyncio.gather(*[pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST) for _ in range(5)], return_exceptions = True)
+    assert sum(isinstance(result, TimeoutNotExpiredError) for result in results) == 4 #refused before connecting
+    assert sum(isinstance(result, asyncio.TimeoutError) for result in results) == 1
+    assert len(slow_tcp_server.writers) == 1
+    await pool.close()
+
+class Lane:
+    pass
+
+@pytest.mark.asyncio
+async def test_lane_pinned_after_request_without_response():
+    received = [] #(connection number, handling type) in arrival order
+    async def on_connection(reader, writer):
+        connection = len(connections)
+        connections.append(writer)
+        handler = PassportHandler()
+        while True:
+            try:
+                message = await handler.read_message(reader)
+            except Exception:
+                break
+            received.append((connection, message.handling_type))
+            if message.handling_type != MessageHandlingType.MULTICAST_NO_RESPONSE:
+                writer.write(bytes(message.message))
+    connections = []
+    server = await asyncio.start_server(on_connection, '127.0.0.1', conftest.PORT_NMB_MOCK)
+    pool = UpstreamPool(PassportHandler(), '127.0.0.1', conftest.PORT_NMB_MOCK, min_connections = 2, max_connections = 2)
+    pool.start()
+    await asyncio.sleep(0.1)
+    lane = Lane()
+    await pool.send_and_wait_response_with_timeout(conftest.END_CUSTOMER_REQUEST, lane = lane)
+    other = await pool.acquire() #another lane's request on the pinned connection
+    sending = asyncio.create_task(pool.send_and_wait_response_with_timeout(conftest.GET_REWARDS_REQUEST, lane = lane))
+    await asyncio.sleep(0.05)
+    assert not sending.done() #waits for the pinned connection although the other one is idle
+    await pool.release(other)
+    response, _, _ = await asyncio.wait_for(sending, 1)
+    assert response == conftest.GET_REWARDS_REQUEST
+    assert [connection for connection, _ in received] == [received[0][0]] * 2
+    assert [handling_type for _, handling_type in received] == [MessageHandlingType.MULTICAST_NO_RESPONSE, MessageHandlingType.CARD_BASED_UNICAST]
+    await pool.close()
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,52 @@
+import pytest
+import asyncio
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.response_cache import ResponseCache
+
+@pytest.fixture()
+async def caching_dispatcher_server(server_multi_passport_config, mock_tcp_server, mock_tcp_server_2):
+    server_multi_passport_config['HOST']['ResponseCacheTtl'] = '60'
+    async with DispatcherServer(server_multi_passport_config, session_handler = None) as server:
+        yield server, mock_tcp_server, mock_tcp_server_2
+
+def test_response_cache_expires():
+    now = [0.0]
+    cache = ResponseCache(5, clock = lambda: now[0])
+    cache.put('remote:1', 'PASSPORT_ECHO', memoryview(b'echo'))
+    assert cache.get('remote:1', 'PASSPORT_ECHO') == b'echo'
+    assert cache.get('remote:2', 'PASSPORT_ECHO') is None
+    now[0] = 5.0
+    assert cache.get('remote:1', 'PASSPORT_ECHO') is None
+
+def test_response_cache_turns_off_auto_passthrough(server_good_passport_config):
+    server_good_passport_config['HOST']['Passthrough'] = 'auto'
+    server_good_passport_config['HOST']['ResponseCacheTtl'] = '1'
+    assert DispatcherServer(server_good_passport_config, session_handler = None).passthrough is False
+
+@pytest.mark.asyncio
+async def test_status_answered_from_cache(caching_dispatcher_server):
+    server, mock_1, mock_2 = caching_dispatcher_server
+    handler = PassportHandler()
+    hits = server.metrics.response_cache_hits.value
+    reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+    writer.write(conftest.GOOD_PASSPORT_ONL_STATUS)
+    await asyncio.wait_for(handler.read_message(reader), 2)
+    assert mock_1.message_received and mock_2.message_received
+    await asyncio.sleep(0.05) #the slower remote's response is cached too
+
+    mock_1.message_received = mock_2.message_received = False
+    request = handler.build_message(handler.get_xml(conftest.GOOD_PASSPORT_ONL_STATUS).replace(b'00-0^2319718^', b'00-1^2319719^'))
+    writer.write(request)
+    response = await asyncio.wait_for(handler.read_message(reader), 2)
+    assert response.pos_sequence_id == '00-1^2319719^'
+    assert not mock_1.message_received and not mock_2.message_received
+    assert server.metrics.response_cache_hits.value == hits + 1
+
+    writer.write(conftest.GET_REWARDS_REQUEST) #other requests are still sent
+    response = await asyncio.wait_for(handler.read_message(reader), 2)
+    assert response.message == conftest.GET_REWARDS_REQUEST
+    writer.close()
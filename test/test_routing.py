@@ -0,0 +1,43 @@
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+from pos_proxy.routing import RoutingTable
+
+class Client:
+    def __init__(self, name, masks):
+        self.name = name
+        self.masks = masks
+
+def names(clients):
+    return [client.name for client in clients]
+
+def test_longest_prefix_wins():
+    table = RoutingTable([Client('short', ['425']), Client('long', ['425060', '7000'])])
+    assert names(table.match('425060597008')) == ['long', 'short']
+    assert names(table.match('425070597008')) == ['short']
+    assert names(table.match('700012')) == ['long']
+    assert table.match('5000') == []
+    assert table.match(None) == []
+
+def test_same_prefix_keeps_config_order():
+    table = RoutingTable([Client('first', ['4250']), Client('second', ['4250'])])
+    assert names(table.match('42501')) == ['first', 'second']
+
+def test_globs_are_fallback_and_empty_mask_matches_all():
+    table = RoutingTable([Client('default', ['']), Client('glob', ['4?50*9']), Client('prefix', ['6'])])
+    assert names(table.match('425009')) == ['glob', 'default']
+    assert names(table.match('61')) == ['prefix', 'default']
+    assert names(table.match('999')) == ['default']
+
+def test_single_string_mask():
+    table = RoutingTable([Client('client', '4250605')])
+    assert names(table.match('425060597008')) == ['client']
+
+def test_redundancy_groups():
+    first, second, other, alone = Client('first', ['4250']), Client('second', ['4250']), Client('other', ['7']), Client('alone', ['8'])
+    first.redundancy_group = second.redundancy_group = 'a'
+    other.redundancy_group = 'b'
+    table = RoutingTable([first, other, second, alone])
+    assert names(table.redundant(first)) == ['second']
+    assert names(table.redundant(second)) == ['first']
+    assert table.redundant(other) == []
+    assert table.redundant(alone) == []
@@ -0,0 +1,88 @@
+import pytest
+import asyncio
+import sqlite3
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.sessions import SessionHandler
+from pos_proxy.runner import read_session_settings
+from pos_proxy.dispatcher import DispatchedMessage
+from pos_proxy.client import MessageHandlingType
+
+@pytest.fixture()
+async def session_handler(tmp_path):
+    handler = SessionHandler(str(tmp_path), flush_interval = 0.05).open()
+    yield handler
+    handler.close()
+
+def stored_users(folder):
+    conn = sqlite3.connect(os.path.join(folder, 'sessions', 'sessions.db'))
+    try:
+        return dict(conn.execute("SELECT session_id, user_id FROM SessionUsers;").fetchall())
+    finally:
+        conn.close()
+
+@pytest.mark.asyncio
+async def test_write_is_cached_and_flushed(session_handler, tmp_path):
+    session_handler.write_user(conftest.SESSION_IN_FRR, conftest.CARD_IN_FRR)
+    assert await session_handler.get_user_for_session(conftest.SESSION_IN_FRR) == conftest.CARD_IN_FRR
+    await asyncio.sleep(0.2)
+    assert stored_users(str(tmp_path)) == {conftest.SESSION_IN_FRR: conftest.CARD_IN_FRR}
+
+@pytest.mark.asyncio
+async def test_lookup_falls_back_to_store(tmp_path):
+    handler = SessionHandler(str(tmp_path)).open()
+    handler.write_user(conftest.SESSION_IN_FRR_2, conftest.CARD_IN_FRR_2)
+    handler.close() #flushes
+    handler = SessionHandler(str(tmp_path)).open()
+    assert await handler.get_user_for_session(conftest.SESSION_IN_FRR_2) == conftest.CARD_IN_FRR_2
+    assert await handler.get_user_for_session('unknown') is None
+    handler.close()
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded(tmp_path):
+    handler = SessionHandler(str(tmp_path), cache_size = 2).open()
+    for index in range(5):
+        handler.write_user(str(index), 'user' + str(index))
+    await handler.flush()
+    assert await handler.get_user_for_session('0') == 'user0' #evicted from the cache, read from the store
+    handler.close()
+
+@pytest.mark.asyncio
+async def test_session_routing_uses_stored_user(good_passport_client, session_handler):
+    from pos_proxy.dispatcher import Dispatcher
+    from pos_proxy.passport_handler import PassportHandler
+    session_handler.write_user(conftest.SESSION_IN_FRR, conftest.CARD_IN_FRR)
+    async with Dispatcher(None, None, [good_passport_client], PassportHandler(), session_handler = session_handler) as dispatcher:
+        user = await dispatcher.resolve_session_user(conftest.SESSION_IN_FRR)
+        assert user == conftest.CARD_IN_FRR
+        valid_clients = dispatcher.get_valid_clients(DispatchedMessage(b''), MessageHandlingType.SESSION_BASED_UNICAST, user, conftest.SESSION_IN_FRR)
+        assert valid_clients == [good_passport_client]
+        user = await dispatcher.resolve_session_user('unknown')
+        assert user is None
+        valid_clients = dispatcher.get_valid_clients(DispatchedMessage(b''), MessageHandlingType.SESSION_BASED_UNICAST, user, 'unknown')
+        assert valid_clients == [good_passport_client] #default client
+
+@pytest.mark.asyncio
+async def test_expired_sessions_deleted_in_chunks(tmp_path):
+    handler = SessionHandler(str(tmp_path), expiry_chunk_size = 3).open()
+    for index in range(10):
+        handler.write_user(str(index), 'user' + str(index))
+    handler.write_user('fresh', 'user')
+    await handler.flush()
+    conn = sqlite3.connect(os.path.join(str(tmp_path), 'sessions', 'sessions.db'))
+    conn.execute("UPDATE SessionUsers SET Timestamp = DATE('now', '-3 days') WHERE session_id != 'fresh';")
+    conn.commit()
+    conn.close()
+    await handler.delete_expired()
+    assert stored_users(str(tmp_path)) == {'fresh': 'user'}
+    handler.close()
+
+def test_session_settings_from_proxy_files(tmp_path):
+    first, second = os.path.join(str(tmp_path), 'a.proxy'), os.path.join(str(tmp_path), 'b.proxy')
+    with open(first, 'w') as f:
+        f.write('[HOST]\nPort = 1\nSessionFlushInterval = 0.5\n')
+    with open(second, 'w') as f:
+        f.write('[HOST]\nPort = 2\nSessionFlushInterval = 3\nSessionCacheSize = 50\n')
+    assert read_session_settings([first, second]) == {'flush_interval': 0.5, 'cache_size': 50}
+    assert read_session_settings([]) == {}
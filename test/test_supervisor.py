@@ -0,0 +1,51 @@
+import pytest
+import asyncio
+import threading
+import time
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.supervisor import WorkerSupervisor
+
+async def request_until_answered(timeout = 30) -> bytes:
+    handler = PassportHandler()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+            try:
+                writer.write(conftest.GET_REWARDS_REQUEST)
+                response, _, _ = await asyncio.wait_for(handler.wait_and_handle_response_message(reader, conftest.GET_REWARDS_REQUEST), 5)
+                return response
+            finally:
+                writer.close()
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+@pytest.fixture(params = [True, False], ids = ['reuse_port', 'shared_sockets'])
+async def supervisor(request, tmp_path, mock_tcp_server):
+    with open(os.path.join(tmp_path, 'test.proxy'), 'w') as proxy_file:
+        proxy_file.write('[HOST]\nPort = {}\n\n[TEST_CLIENT]\nRemote = 127.0.0.1\nPort = {}\n'.format(conftest.PORT_NMB_DISPATCHER, conftest.PORT_NMB_MOCK))
+    supervisor = WorkerSupervisor(str(tmp_path), workers = 2, restart_delay = 0.1, poll_interval = 0.1, reuse_port = request.param)
+    thread = threading.Thread(target = supervisor.run)
+    thread.start()
+    yield supervisor
+    supervisor.stop()
+    await asyncio.get_running_loop().run_in_executor(None, thread.join)
+
+@pytest.mark.asyncio
+async def test_workers_serve_and_restart(supervisor):
+    assert await request_until_answered() == conftest.GET_REWARDS_REQUEST
+
+    crashed = supervisor.processes[0]
+    crashed.kill()
+    for _ in range(300):
+        if supervisor.restarts > 0 and supervisor.processes[0] is not crashed and supervisor.processes[0].is_alive():
+            break
+        await asyncio.sleep(0.1)
+    assert supervisor.processes[0] is not crashed
+    assert all(process.is_alive() for process in supervisor.processes)
+    assert await request_until_answered() == conftest.GET_REWARDS_REQUEST
@@ -0,0 +1,76 @@
+import pytest
+import asyncio
+import json
+import sys, os
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+import conftest
+from pos_proxy.passport_handler import PassportHandler
+from pos_proxy.dispatcher import DispatcherServer
+from pos_proxy.tracing import MessageTrace, Tracer
+
+@pytest.fixture()
+async def tracing_dispatcher_server(server_good_passport_config, mock_tcp_server, tmp_path):
+    server_good_passport_config['HOST']['Trace'] = 'yes'
+    server_good_passport_config['HOST']['TraceFile'] = os.path.join(str(tmp_path), 'trace-{pid}.jsonl')
+    async with DispatcherServer(server_good_passport_config, session_handler = None) as server:
+        yield server
+
+def test_trace_turns_off_auto_passthrough(server_good_passport_config):
+    server_good_passport_config['HOST']['Passthrough'] = 'auto'
+    server_good_passport_config['HOST']['Trace'] = 'yes'
+    server = DispatcherServer(server_good_passport_config, session_handler = None)
+    assert server.passthrough is False
+    server.tracer.close()
+
+def test_tracer_keeps_newest():
+    tracer = Tracer(capacity = 2)
+    for sequence_id in ['1', '2', '3']:
+        tracer.record(MessageTrace(sequence_id, 'remote:1'))
+    assert [trace.pos_sequence_id for trace in tracer.recent()] == ['2', '3']
+    assert [trace.pos_sequence_id for trace in tracer.recent(1)] == ['3']
+
+@pytest.mark.asyncio
+async def test_request_stages_traced(tracing_dispatcher_server):
+    handler = PassportHandler()
+    reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+    writer.write(conftest.GET_REWARDS_REQUEST)
+    response, _, _ = await asyncio.wait_for(handler.wait_and_handle_response_message(reader, conftest.GET_REWARDS_REQUEST), 2)
+    assert response == conftest.GET_REWARDS_REQUEST
+    writer.close()
+
+    tracer = tracing_dispatcher_server.tracer
+    for _ in range(100):
+        if tracer.recent():
+            break
+        await asyncio.sleep(0.01)
+    trace, = tracer.recent()
+    assert trace.pos_sequence_id == handler.get_sequence_id(conftest.GET_REWARDS_REQUEST)
+    assert trace.upstream == '127.0.0.1:{}'.format(conftest.PORT_NMB_MOCK)
+    assert trace.outcome == 'responded'
+    stamps = [getattr(trace, stage) for stage in MessageTrace.STAGES]
+    assert None not in stamps
+    assert stamps == sorted(stamps)
+    assert 0 < trace.upstream_rtt_ns <= trace.responded - trace.header_read
+
+    await tracing_dispatcher_server.close()
+    with open(tracer.file_name) as trace_file:
+        line, = trace_file.readlines()
+    traced = json.loads(line)
+    assert traced['pos_sequence_id'] == trace.pos_sequence_id
+    assert list(traced['stages_us']) == list(MessageTrace.STAGES)
+
+@pytest.mark.asyncio
+async def test_multicast_traced_per_upstream(server_multi_passport_config, mock_tcp_server, mock_tcp_server_2):
+    server_multi_passport_config['HOST']['Trace'] = 'yes'
+    async with DispatcherServer(server_multi_passport_config, session_handler = None) as server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', conftest.PORT_NMB_DISPATCHER)
+        writer.write(conftest.END_CUSTOMER_REQUEST)
+        for _ in range(100):
+            if len(server.tracer.recent()) == 2:
+                break
+            await asyncio.sleep(0.01)
+        writer.close()
+        traces = server.tracer.recent()
+        assert sorted(trace.upstream for trace in traces) == ['127.0.0.1:{}'.format(conftest.PORT_NMB_MOCK), '127.0.0.1:{}'.format(conftest.PORT_NMB_MOCK_2)]
+        assert sorted(trace.outcome for trace in traces) == ['late', 'no_response']
+        assert all(trace.upstream_write is not None and trace.first_response is None for trace in traces)